@@ -34,6 +34,14 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        # vectorized weekday aggregation
+        'numpy': ['numpy'],
+        # asyncio serving mode, Python 3 only
+        'asgi': ['uvicorn'],
+    },
     entry_points="""
+    [console_scripts]
+    presence-stats = presence_analyzer.stats:main
     """,
 )
@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio (ASGI) serving mode.
+
+JSON API is served by coroutines which never block the event loop:
+getting presence and users data, which may parse whole files, and
+computing and serializing results run in a thread pool executor. Other
+requests, e.g. HTML pages rendered with Mako, are passed to the Flask
+app, also in the executor.
+
+Requires Python 3. Usage: python -m presence_analyzer.asgi (needs
+uvicorn), or any ASGI server with presence_analyzer.asgi:application.
+"""
+
+import argparse
+import asyncio
+import calendar
+import contextvars
+import io
+import json
+import logging
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
+from werkzeug.http import parse_accept_header, parse_etags
+
+from presence_analyzer import metrics, utils, views
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    CachedJSON,
+    cache,
+    get_data,
+    get_range_data,
+    get_weekdays,
+    get_xml_users,
+    json_etag,
+    occupancy_heatmap,
+    parse_date_range,
+    present_between,
+    presence_version,
+    time_spent_by_day,
+)
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+GZIP_MIN_SIZE = 512
+
+_executor = None  # pylint: disable=invalid-name
+
+# stage timings of instrumented API request served by current task
+stage_timings = contextvars.ContextVar(  # pylint: disable=invalid-name
+    'stage_timings', default=None
+)
+
+
+def executor():
+    """
+    Returns thread pool running blocking calls.
+    """
+    global _executor  # pylint: disable=global-statement,invalid-name
+    if _executor is None:
+        _executor = ThreadPoolExecutor(app.config['ASGI_THREADS'])
+    return _executor
+
+
+def offload(func, *args):
+    """
+    Runs func(*args) in thread pool, returns awaitable result.
+
+    Stages of instrumented API request are added to its timings.
+    """
+    timings = stage_timings.get()
+    if timings is not None:
+        func, args = metrics.collect, (timings, func) + args
+    return asyncio.get_event_loop().run_in_executor(executor(), func, *args)
+
+
+class ApiRequest(object):
+    """
+    Path, query arguments and headers of ASGI HTTP request.
+    """
+
+    def __init__(self, scope):
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('latin-1')
+        self.args = {}
+        for name, value in parse_qsl(self.query_string, True):
+            self.args.setdefault(name, value)
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name in self.headers:
+                value = self.headers[name] + ',' + value
+            self.headers[name] = value
+
+    @property
+    def full_path(self):
+        """
+        Returns path with query string, the same as Flask request.full_path.
+        """
+        return self.path + '?' + self.query_string
+
+
+def request_range(request):
+    """
+    Returns requested date range.
+
+    Raises BadRequest for malformed dates.
+    """
+    try:
+        return parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        raise BadRequest()
+
+
+def user_weekdays(weekdays, user_id):
+    """
+    Returns WeekdayIndex of existing user.
+
+    Raises NotFound for unknown user.
+    """
+    if user_id not in weekdays:
+        log.debug('User %s not found!', user_id)
+        raise NotFound()
+    return weekdays[user_id]
+
+
+async def range_weekdays(request):
+    """
+    Returns (presence version, weekdays of requested date range).
+    """
+    first, last = request_range(request)
+    version = await offload(presence_version)
+    return version, await offload(get_weekdays, first, last)
+
+
+async def mean_time_weekday_view(request, user_id):
+    """
+    Returns mean presence time of given user grouped by weekday.
+    """
+    version, weekdays = await range_weekdays(request)
+    return version, lambda: views.weekday_means(
+        user_weekdays(weekdays, user_id)
+    )
+
+
+async def presence_quantiles_view(request):
+    """
+    Returns quantiles of presence of all users grouped by weekday.
+    """
+    data = await offload(get_data)
+
+    def result():
+        """
+        Reads quantiles of requested fractions.
+        """
+        try:
+            return views.weekday_quantiles(data.sketches(), request.args)
+        except ValueError:
+            log.debug('Invalid quantiles: %s', request.args)
+            raise BadRequest()
+    return await offload(presence_version), result
+
+
+async def user_presence_quantiles_view(request, user_id):
+    """
+    Returns quantiles of presence of given user grouped by weekday.
+    """
+    first, last = request_range(request)
+    version = await offload(presence_version)
+    data = await offload(get_range_data, first, last)
+
+    def result():
+        """
+        Computes quantiles of requested fractions and date range.
+        """
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            raise NotFound()
+        try:
+            return views.weekday_quantiles(
+                data[user_id].weekday_values(first, last), request.args
+            )
+        except ValueError:
+            log.debug('Invalid quantiles: %s', request.args)
+            raise BadRequest()
+    return version, result
+
+
+async def presence_weekday_view(request, user_id):
+    """
+    Returns total presence time of given user grouped by weekday.
+    """
+    version, weekdays = await range_weekdays(request)
+    return version, lambda: views.weekday_totals(
+        user_weekdays(weekdays, user_id)
+    )
+
+
+async def presence_start_end_view(request, user_id):
+    """
+    Returns mean start and end time of given user grouped by weekday.
+    """
+    version, weekdays = await range_weekdays(request)
+    return version, lambda: views.weekday_start_end(
+        user_weekdays(weekdays, user_id)
+    )
+
+
+async def presence_days_view(request, user_id):
+    """
+    Returns presence time of given user on every day.
+    """
+    first, last = request_range(request)
+    version = await offload(presence_version)
+    data = await offload(get_range_data, first, last)
+
+    def result():
+        """
+        Lists presence days in requested date range.
+        """
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            raise NotFound()
+        return time_spent_by_day(data[user_id].between(first, last))
+    return version, result
+
+
+async def bulk_presence_weekday_view(request):
+    """
+    Returns weekday statistics of many users.
+    """
+    version, weekdays = await range_weekdays(request)
+
+    def result():
+        """
+        Collects statistics of requested users.
+        """
+        try:
+            return views.bulk_weekdays(weekdays, request.args)
+        except ValueError:
+            log.debug('Invalid query: %s', request.args)
+            raise BadRequest()
+    return version, result
+
+
+async def occupancy_heatmap_view(request):
+    """
+    Returns mean number of people present in every 15 minute slot of
+    every weekday.
+    """
+    first, last = request_range(request)
+    version = await offload(presence_version)
+    data = await offload(get_range_data, first, last)
+
+    def result():
+        """
+        Computes heatmap of requested date range.
+        """
+        heatmap = occupancy_heatmap(data, first, last)
+        heatmap['weekdays'] = list(calendar.day_abbr)
+        return heatmap
+    return version, result
+
+
+async def present_at_view(request):
+    """
+    Returns users present at given time or during given window.
+    """
+    try:
+        since, until = views.parse_window(request.args)
+    except ValueError:
+        log.debug('Invalid query: %s', request.args)
+        raise BadRequest()
+    version = await offload(presence_version)
+    data = await offload(get_range_data, since[0], (until or since)[0])
+    users = await offload(get_xml_users)
+
+    def result():
+        """
+        Searches interval indexes of requested dates.
+        """
+        return present_between(data, users, since, until)
+    return '{}-{}'.format(version, users.version), result
+
+
+async def top_view(request):
+    """
+    Returns users leading in requested metric.
+    """
+    version, weekdays = await range_weekdays(request)
+    users = await offload(get_xml_users)
+
+    def result():
+        """
+        Selects leaders from weekday totals of users.
+        """
+        try:
+            return views.top(weekdays, users, request.args)
+        except ValueError:
+            log.debug('Invalid query: %s', request.args)
+            raise BadRequest()
+    return '{}-{}'.format(version, users.version), result
+
+
+async def users_data_view(request):  # pylint: disable=unused-argument
+    """
+    Returns users id, name and avatar.
+    """
+    users = await offload(get_xml_users)
+    return users.version, lambda: views.users_list(users)
+
+
+ROUTES = [
+    (re.compile(r'/api/v1/mean_time_weekday/(\d+)$'), mean_time_weekday_view),
+    (re.compile(r'/api/v1/presence_weekday/(\d+)$'), presence_weekday_view),
+    (re.compile(r'/api/v1/presence_quantiles$'), presence_quantiles_view),
+    (
+        re.compile(r'/api/v1/presence_quantiles/(\d+)$'),
+        user_presence_quantiles_view,
+    ),
+    (
+        re.compile(r'/api/v1/presence_start_end/(\d+)$'),
+        presence_start_end_view,
+    ),
+    (re.compile(r'/api/v1/presence_days/(\d+)$'), presence_days_view),
+    (
+        re.compile(r'/api/v1/bulk/presence_weekday$'),
+        bulk_presence_weekday_view,
+    ),
+    (re.compile(r'/api/v1/users_data$'), users_data_view),
+    (re.compile(r'/api/v1/occupancy_heatmap$'), occupancy_heatmap_view),
+    (re.compile(r'/api/v1/present_at$'), present_at_view),
+    (re.compile(r'/api/v1/top$'), top_view),
+]
+
+
+def find_route(method, path):
+    """
+    Returns (async view, int path arguments) of API request or None.
+    """
+    if method not in ('GET', 'HEAD'):
+        return None
+    for pattern, view in ROUTES:
+        match = pattern.match(path)
+        if match:
+            return view, [int(group) for group in match.groups()]
+    return None
+
+
+class Rendering(object):
+    """
+    Pending JSON response of API view.
+
+    Compared and hashed only by its key, (view name, data version, values
+    of query arguments read by the view, path arguments), so render()
+    caches responses like cached_jsonify() does. The result function is
+    dropped once called, so cached keys do not keep old data alive.
+    """
+
+    def __init__(self, key, result):
+        self.key = key
+        self.result = result
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+@cache(max_entries=1024, max_bytes=utils.RESPONSE_CACHE_BYTES)
+def render(rendering):
+    """
+    Returns CachedJSON of result of pending response.
+
+    Runs in thread pool, as computing and serializing a result may take
+    long.
+    """
+    result, rendering.result = rendering.result, None
+    with metrics.stage('aggregate'):
+        result = result()
+    with metrics.stage('serialize'):
+        return CachedJSON(json.dumps(result).encode('utf-8'))
+
+
+async def serve_api(scope, send, view, params):
+    """
+    Responds to API request with JSON result of async view.
+
+    Like cached_jsonify(), answers 304 to matching If-None-Match, caches
+    serialized responses per data version and query arguments read by the
+    view and compresses large bodies for clients accepting gzip. With
+    instrumentation on, responses carry Server-Timing header and stage
+    timings are recorded under the name of the view, the same as Flask
+    endpoint.
+    """
+    started = metrics.start_request()
+    if started is not None:
+        stage_timings.set({})
+    request = ApiRequest(scope)
+    headers = [
+        (b'cache-control', b'no-cache'),
+        (b'vary', b'Accept-Encoding'),
+    ]
+    try:
+        version, result = await view(request, *params)
+        etag = json_etag(version, request.full_path)
+        gzip_etag = etag + '-gzip'
+        if_none_match = parse_etags(request.headers.get('if-none-match'))
+        if if_none_match.contains(gzip_etag):
+            status, body, etag = 304, b'', gzip_etag
+        elif if_none_match.contains(etag):
+            status, body = 304, b''
+        else:
+            status = 200
+            query_args = getattr(views, view.__name__).query_args
+            rendering = Rendering(
+                (
+                    view.__name__,
+                    version,
+                    tuple(request.args.get(name) for name in query_args),
+                    tuple(params),
+                ),
+                result,
+            )
+            cached = await offload(render, rendering)
+            headers.append((b'content-type', b'application/json'))
+            if len(cached.body) >= GZIP_MIN_SIZE and parse_accept_header(
+                    request.headers.get('accept-encoding')
+            )['gzip']:
+                headers.append((b'content-encoding', b'gzip'))
+                if cached._gzipped is None:
+                    body = await offload(getattr, cached, 'gzipped')
+                    render.resize(rendering)
+                else:
+                    body = cached.gzipped
+                etag = gzip_etag
+            else:
+                body = cached.body
+        headers.append((b'etag', '"{}"'.format(etag).encode('latin-1')))
+        if started is not None:
+            headers.append((b'server-timing', metrics.record_request(
+                started, view.__name__, stage_timings.get()
+            ).encode('latin-1')))
+    except HTTPException as error:
+        status, body = error.code, error.get_body().encode('utf-8')
+        headers = [(b'content-type', b'text/html; charset=utf-8')]
+
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b'' if scope['method'] == 'HEAD' else body,
+    })
+
+
+def wsgi_environ(scope, body):
+    """
+    Creates WSGI environ of ASGI HTTP request.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def call_wsgi(environ):
+    """
+    Calls Flask app, returns (status, headers, body).
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        """
+        Remembers status and headers of response.
+        """
+        # pylint: disable=unused-argument
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ]
+
+    chunks = app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+
+async def serve_wsgi(scope, receive, send):
+    """
+    Responds to request with Flask app running in thread pool.
+    """
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    status, headers, body = await offload(
+        call_wsgi, wsgi_environ(scope, body)
+    )
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def warm_up():
+    """
+    Loads presence and users data before first request.
+    """
+    await offload(utils.try_warm_up)
+
+
+async def serve_lifespan(receive, send):
+    """
+    Handles server startup and shutdown.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await warm_up()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI application serving API and Flask pages.
+    """
+    if scope['type'] == 'lifespan':
+        await serve_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    route = find_route(scope['method'], scope['path'])
+    if route is None:
+        await serve_wsgi(scope, receive, send)
+    else:
+        await serve_api(scope, send, *route)
+
+
+def main(argv=None):
+    """
+    Serves application with uvicorn.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(
+        application, host=args.host, port=args.port, log_level='warning'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,674 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Usage: python -m presence_analyzer.benchmark <benchmark> [options]
+"""
+
+import argparse
+import csv
+import datetime
+import gc
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None  # pylint: disable=invalid-name
+
+from presence_analyzer.main import MAIN_DATA_CSV, app
+from presence_analyzer import store, utils
+
+
+def scale_csv(source, target, factor):
+    """
+    Writes source CSV to target repeated factor times.
+
+    Every copy gets its own range of user ids, so the scaled file keeps
+    the shape of the original data with factor times more users.
+    """
+    with open(source, 'r') as source_file:
+        lines = [line.rstrip('\r\n') for line in source_file]
+
+    offset = max(int(line.split(',', 1)[0]) for line in lines if line) + 1
+    with open(target, 'w') as target_file:
+        for copy in range(factor):
+            for line in lines:
+                user_id, rest = line.split(',', 1)
+                target_file.write('{},{}\n'.format(
+                    int(user_id) + copy * offset, rest
+                ))
+
+
+def read_sample_times(source):
+    """
+    Returns list of (start, end) text pairs of source CSV.
+    """
+    with open(source, 'r') as source_file:
+        return [
+            (row[2], row[3]) for row in csv.reader(source_file)
+            if len(row) == 4 and row[2] < row[3]
+        ]
+
+
+def generate_csv(target, users, years, source=MAIN_DATA_CSV, seed=0,
+                 presence=0.9):
+    """
+    Writes synthetic presence CSV of given users over given years.
+
+    Users get ids 1..users. Every weekday of the years, starting in 2011,
+    a user is present with given probability, with start and end times
+    drawn from entries of source file. Returns number of rows.
+    """
+    generator = random.Random(seed)
+    times = read_sample_times(source)
+    first = datetime.date(2011, 1, 3).toordinal()
+    days = [
+        datetime.date.fromordinal(ordinal).isoformat()
+        for ordinal in range(first, first + years * 364)
+        if (ordinal - 1) % 7 < 5
+    ]
+    rows = 0
+    with open(target, 'w') as target_file:
+        target_file.write('user_id,date,start,end\n')
+        for user_id in range(1, users + 1):
+            for day in days:
+                if generator.random() >= presence:
+                    continue
+                start, end = generator.choice(times)
+                target_file.write('{},{},{},{}\n'.format(
+                    user_id, day, start, end
+                ))
+                rows += 1
+    return rows
+
+
+def generate_xml(target, users):
+    """
+    Writes synthetic users.xml with users of ids 1..users.
+    """
+    with open(target, 'w') as target_file:
+        target_file.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in range(1, users + 1):
+            target_file.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}.</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        target_file.write('    </users>\n</intranet>\n')
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximates memory used by an object and everything it references.
+
+    Objects of presence_analyzer classes are measured by walking their
+    attributes, not by their own __sizeof__(), which counts only columns.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if type(obj).__module__.startswith('presence_analyzer.'):
+        return object.__sizeof__(obj) + deep_sizeof(vars(obj), seen)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def to_nested_dict(data):
+    """
+    Converts presence store to plain {user_id: {date: {...}}} dicts.
+    """
+    return {
+        user_id: dict(user.items())
+        for user_id, user in data.items()
+    }
+
+
+def bench_memory(args):
+    """
+    Compares memory used by presence store and nested dicts.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        scale_csv(args.source, csv_path, args.scale)
+        app.config['DATA_CSV'] = csv_path
+
+        data, traced = live_memory(utils.get_data)
+        rows = sum(len(user) for user in data.values())
+        columnar = deep_sizeof(data)
+        nested = deep_sizeof(to_nested_dict(data))
+    finally:
+        shutil.rmtree(directory)
+
+    print('rows: {}'.format(rows))
+    print('nested dict: {:.1f} MiB ({:.1f} B/row)'.format(
+        nested / 2.0 ** 20, float(nested) / rows
+    ))
+    print('presence store: {:.1f} MiB ({:.1f} B/row)'.format(
+        columnar / 2.0 ** 20, float(columnar) / rows
+    ))
+    if traced is not None:
+        print('presence store, traced: {:.1f} MiB ({:.1f} B/row)'.format(
+            traced / 2.0 ** 20, float(traced) / rows
+        ))
+
+
+def read_rows_strptime(csvfile):
+    """
+    Parses CSV rows with datetime.strptime only, like get_data() used to.
+    """
+    for row in csv.reader(csvfile, delimiter=','):
+        if len(row) != 4:
+            continue
+        try:
+            yield utils.parse_presence_row(row)
+        except (ValueError, TypeError):
+            pass
+
+
+def bench_ingest(args):
+    """
+    Compares rows per second of strptime and fast CSV parsing.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        scale_csv(args.source, csv_path, args.scale)
+
+        for name, reader in (
+                ('strptime', read_rows_strptime),
+                ('fast', utils.read_presence_rows),
+        ):
+            def parse(reader=reader):
+                """
+                Parses whole scaled file.
+                """
+                with open(csv_path, 'r') as csvfile:
+                    return sum(1 for _ in reader(csvfile))
+
+            rows = parse()
+            seconds = min(timeit.repeat(parse, number=1, repeat=args.repeat))
+            print('{}: {} rows in {:.3f} s, {:.0f} rows/s'.format(
+                name, rows, seconds, rows / seconds
+            ))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_parallel(args):
+    """
+    Compares time of loading CSV from scratch with different worker counts.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        scale_csv(args.source, csv_path, args.scale)
+
+        serial = None
+        for workers in args.workers:
+            def load(workers=workers):
+                """
+                Loads whole scaled file with a fresh loader.
+                """
+                loader = utils.PresenceLoader()
+                loader.parallel_min_size = 0
+                return loader.load(csv_path, workers=workers)
+
+            seconds = min(timeit.repeat(load, number=1, repeat=args.repeat))
+            if serial is None:
+                serial = seconds
+            print('{} workers: {:.3f} s, {:.2f}x'.format(
+                workers, seconds, serial / seconds
+            ))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_aggregate(args):
+    """
+    Compares weekday aggregation of all users with and without NumPy.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        scale_csv(args.source, csv_path, args.scale)
+        with open(csv_path, 'r') as csvfile:
+            columns = store.group_columns(utils.read_presence_rows(csvfile))
+    finally:
+        shutil.rmtree(directory)
+    columns = {
+        user_id: store.unique_columns(*user_columns)
+        for user_id, user_columns in columns.items()
+    }
+    rows = sum(len(user_columns[0]) for user_columns in columns.values())
+
+    numpy = store.numpy
+    for name, engine in (('python', None), ('numpy', numpy)):
+        if name == 'numpy' and numpy is None:
+            print('numpy: not installed')
+            continue
+        store.numpy = engine
+        try:
+            seconds = min(timeit.repeat(
+                lambda: store.weekday_indexes(columns),
+                number=1,
+                repeat=args.repeat,
+            ))
+        finally:
+            store.numpy = numpy
+        print('{}: {} rows in {:.3f} s, {:.0f} rows/s'.format(
+            name, rows, seconds, rows / seconds
+        ))
+
+
+def bench_snapshot(args):
+    """
+    Compares time to first response with CSV parsing and snapshot loading.
+    """
+    import presence_analyzer.views  # pylint: disable=unused-variable
+
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        scale_csv(args.source, csv_path, args.scale)
+        app.config['DATA_CSV'] = csv_path
+        client = app.test_client()
+        runs = itertools.count()
+
+        def first_response(snapshot):
+            """
+            Times first API request of a fresh worker.
+            """
+            app.config['DATA_SNAPSHOT'] = snapshot
+            utils.presence_loader = utils.PresenceLoader()
+            utils.get_data.invalidate()
+            started = timeit.default_timer()
+            # unique query string bypasses cached responses
+            client.get('/api/v1/presence_weekday/10?run={}'.format(next(runs)))
+            return timeit.default_timer() - started
+
+        utils.PresenceLoader().load(csv_path, snapshot=True)
+        for name, snapshot in (('csv', False), ('snapshot', True)):
+            seconds = min(
+                first_response(snapshot) for _ in range(args.repeat)
+            )
+            print('{}: first response after {:.3f} s'.format(name, seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+def percentile(ordered, fraction):
+    """
+    Returns nearest-rank percentile of sorted values.
+    """
+    return ordered[max(int(math.ceil(len(ordered) * fraction)) - 1, 0)]
+
+
+def live_memory(func):
+    """
+    Returns (result of func, bytes allocated by func and still in use).
+
+    Needs tracemalloc, so on Python 2 the amount of bytes is None.
+    """
+    if tracemalloc is None:
+        return func(), None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def peak_memory(func):
+    """
+    Returns peak amount of bytes allocated while calling func.
+
+    Needs tracemalloc, so on Python 2 returns None; peak resident set size
+    of the whole run is reported by max_rss_bytes() instead.
+    """
+    if tracemalloc is None:
+        func()
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss_bytes():
+    """
+    Returns peak resident set size of the process so far.
+    """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(func, repeat, items=1, setup=None):
+    """
+    Times repeat calls of func processing given number of items each.
+
+    setup() is called before every call, outside of timing. Returns dict
+    with items per second, latency percentiles and peak memory of one
+    more, untimed call.
+    """
+    latencies = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = timeit.default_timer()
+        func()
+        latencies.append(timeit.default_timer() - started)
+    latencies.sort()
+    if setup is not None:
+        setup()
+    return {
+        'calls': repeat,
+        'items': items,
+        'throughput': items * repeat / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'peak_bytes': peak_memory(func),
+    }
+
+
+ENDPOINTS = [
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/1'),
+    ('presence_weekday', '/api/v1/presence_weekday/1'),
+    ('presence_weekday_range',
+     '/api/v1/presence_weekday/1?from=2012-01-01&to=2012-12-31'),
+    ('presence_quantiles', '/api/v1/presence_quantiles'),
+    ('user_presence_quantiles', '/api/v1/presence_quantiles/1'),
+    ('presence_start_end', '/api/v1/presence_start_end/1'),
+    ('presence_days', '/api/v1/presence_days/1'),
+    ('bulk_presence_weekday', '/api/v1/bulk/presence_weekday'),
+    ('users_data', '/api/v1/users_data'),
+    ('occupancy_heatmap', '/api/v1/occupancy_heatmap'),
+    ('top', '/api/v1/top?metric=mean_presence&n=10'),
+    ('top_range',
+     '/api/v1/top?metric=arrival&from=2012-01-01&to=2012-06-30'),
+    ('present_at', '/api/v1/present_at?ts=2012-03-06T11:00:00'),
+    ('present_at_window',
+     '/api/v1/present_at?ts=2012-03-05T12:00:00&until=2012-03-09T12:00:00'),
+]
+
+
+def suite_cases(csv_path, rows, users, args):
+    """
+    Yields (name, function, items, setup, repeat) of benchmark suite.
+    """
+    import presence_analyzer.views  # pylint: disable=unused-variable
+
+    yield (
+        'parse.csv',
+        lambda: utils.PresenceLoader().load(csv_path),
+        rows, None, args.parse_repeat,
+    )
+    yield (
+        'parse.xml', utils.get_xml_users, users,
+        utils.get_xml_users.invalidate, args.parse_repeat,
+    )
+
+    data = utils.get_data()
+    user = data[1]
+    entries = dict(user.items())
+    times = list(entries.values())
+    intervals = [utils.interval(**entry) for entry in times]
+    first = datetime.date(2012, 1, 1).toordinal()
+    last = datetime.date(2012, 12, 31).toordinal()
+    for name, func, items in (
+            ('group_by_weekday', lambda: utils.group_by_weekday(user),
+             len(user)),
+            ('group_by_weekday.dict',
+             lambda: utils.group_by_weekday(entries), len(user)),
+            ('group_start_end_by_weekday',
+             lambda: utils.group_start_end_by_weekday(user), len(user)),
+            ('group_start_end_by_weekday.dict',
+             lambda: utils.group_start_end_by_weekday(entries), len(user)),
+            ('time_spent_by_day', lambda: utils.time_spent_by_day(user),
+             len(user)),
+            ('time_spent_by_day.dict',
+             lambda: utils.time_spent_by_day(entries), len(user)),
+            ('mean', lambda: utils.mean(intervals), len(user)),
+            ('interval',
+             lambda: [utils.interval(**entry) for entry in times],
+             len(user)),
+            ('seconds_since_midnight',
+             lambda: [
+                 utils.seconds_since_midnight(entry['start'])
+                 for entry in times
+             ],
+             len(user)),
+            ('weekdays_between',
+             lambda: user.weekdays_between(first, last), 1),
+            ('bulk_weekday_stats',
+             lambda: utils.bulk_weekday_stats(
+                 store.RangeWeekdays([(data, None, None)]), sorted(data)
+             ),
+             len(data)),
+    ):
+        yield 'helper.' + name, func, items, None, args.repeat
+
+    client = app.test_client()
+    runs = itertools.count()
+    for name, path in ENDPOINTS:
+        separator = '&' if '?' in path else '?'
+        yield (
+            'endpoint.' + name,
+            # unique query string bypasses cached responses
+            lambda path=path, separator=separator: client.get(
+                '{}{}run={}'.format(path, separator, next(runs))
+            ),
+            1, None, args.repeat,
+        )
+        yield (
+            'endpoint.{}.cached'.format(name),
+            lambda path=path: client.get(path),
+            1, None, args.repeat,
+        )
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compares results with baseline run.
+
+    Returns list of (name, baseline p50, p50, relative change) for every
+    benchmark of both runs, and list of names whose p50 latency grew more
+    than threshold.
+    """
+    changes = []
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_ms']
+        after = results[name]['p50_ms']
+        change = after / before - 1 if before else 0.0
+        changes.append((name, before, after, change))
+        if change > threshold:
+            regressions.append(name)
+    return changes, regressions
+
+
+def bench_generate(args):
+    """
+    Writes synthetic CSV and XML data of given users over given years.
+    """
+    rows = generate_csv(args.csv, args.users, args.years, args.source)
+    generate_xml(args.xml, args.users)
+    print('{} rows of {} users'.format(rows, args.users))
+
+
+def bench_suite(args):
+    """
+    Times parsers, aggregation helpers and API endpoints on synthetic data.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'data.csv')
+        xml_path = os.path.join(directory, 'users.xml')
+        rows = generate_csv(csv_path, args.users, args.years, args.source)
+        generate_xml(xml_path, args.users)
+        app.config.update(
+            DATA_CSV=csv_path, DATA_XML=xml_path, DEBUG=False
+        )
+        utils.presence_loader = utils.PresenceLoader()
+        utils.get_data.invalidate()
+        utils.get_xml_users.invalidate()
+
+        results = {}
+        for name, func, items, setup, repeat in suite_cases(
+                csv_path, rows, args.users, args
+        ):
+            results[name] = measure(func, repeat, items, setup)
+            peak = results[name]['peak_bytes']
+            print('{:<42} {:>12.0f}/s  p50 {:>9.3f} ms  p99 {:>9.3f} ms  '
+                  'peak {:>10} KiB'.format(
+                      name,
+                      results[name]['throughput'],
+                      results[name]['p50_ms'],
+                      results[name]['p99_ms'],
+                      'n/a' if peak is None else '{:.1f}'.format(
+                          peak / 1024.0
+                      ),
+                  ))
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': args.users,
+            'years': args.years,
+            'rows': rows,
+            'max_rss_bytes': max_rss_bytes(),
+            'time': datetime.datetime.utcnow().isoformat(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        changes, regressions = compare_results(
+            results, baseline, args.threshold
+        )
+        print('\ncompared with {}:'.format(args.baseline))
+        for name, before, after, change in changes:
+            print('{:<42} p50 {:>9.3f} -> {:>9.3f} ms {:>+7.1%}{}'.format(
+                name, before, after, change,
+                '  REGRESSION' if name in regressions else '',
+            ))
+        if regressions:
+            sys.exit(1)
+
+
+def main(argv=None):
+    """
+    Runs benchmark chosen from command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    memory = benchmarks.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--source', default=MAIN_DATA_CSV)
+    memory.add_argument('--scale', type=int, default=100)
+    memory.set_defaults(run=bench_memory)
+
+    ingest = benchmarks.add_parser('ingest', help=bench_ingest.__doc__)
+    ingest.add_argument('--source', default=MAIN_DATA_CSV)
+    ingest.add_argument('--scale', type=int, default=10)
+    ingest.add_argument('--repeat', type=int, default=3)
+    ingest.set_defaults(run=bench_ingest)
+
+    parallel = benchmarks.add_parser('parallel', help=bench_parallel.__doc__)
+    parallel.add_argument('--source', default=MAIN_DATA_CSV)
+    parallel.add_argument('--scale', type=int, default=50)
+    parallel.add_argument('--repeat', type=int, default=3)
+    parallel.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4, 8]
+    )
+    parallel.set_defaults(run=bench_parallel)
+
+    aggregate = benchmarks.add_parser(
+        'aggregate', help=bench_aggregate.__doc__
+    )
+    aggregate.add_argument('--source', default=MAIN_DATA_CSV)
+    aggregate.add_argument('--scale', type=int, default=50)
+    aggregate.add_argument('--repeat', type=int, default=3)
+    aggregate.set_defaults(run=bench_aggregate)
+
+    suite = benchmarks.add_parser('suite', help=bench_suite.__doc__)
+    suite.add_argument('--source', default=MAIN_DATA_CSV)
+    suite.add_argument('--users', type=int, default=50)
+    suite.add_argument('--years', type=int, default=2)
+    suite.add_argument('--repeat', type=int, default=50)
+    suite.add_argument('--parse-repeat', type=int, default=3)
+    suite.add_argument('--output', help='write results to JSON file')
+    suite.add_argument('--baseline', help='compare with results JSON file')
+    suite.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative p50 growth reported as regression',
+    )
+    suite.set_defaults(run=bench_suite)
+
+    generate = benchmarks.add_parser('generate', help=bench_generate.__doc__)
+    generate.add_argument('csv')
+    generate.add_argument('xml')
+    generate.add_argument('--source', default=MAIN_DATA_CSV)
+    generate.add_argument('--users', type=int, default=50)
+    generate.add_argument('--years', type=int, default=2)
+    generate.set_defaults(run=bench_generate)
+
+    snapshot = benchmarks.add_parser('snapshot', help=bench_snapshot.__doc__)
+    snapshot.add_argument('--source', default=MAIN_DATA_CSV)
+    snapshot.add_argument('--scale', type=int, default=10)
+    snapshot.add_argument('--repeat', type=int, default=3)
+    snapshot.set_defaults(run=bench_snapshot)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
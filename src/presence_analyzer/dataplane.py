@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data shared by worker processes through memory mapped files.
+
+One loader process parses DATA_CSV and publishes every new version of the
+data as a snapshot generation in DATA_PLANE directory. Name of the newest
+generation is switched atomically in CURRENT file, workers map the
+snapshot read-only, so all of them share the same pages of memory.
+
+Usage: PRESENCE_ANALYZER_DATA_PLANE=<directory> python -m
+presence_analyzer.dataplane; configuration is read like by the WSGI entry
+point.
+"""
+
+import logging
+import os
+import time
+
+from presence_analyzer.main import app, configure
+from presence_analyzer.snapshot import read_snapshot, write_snapshot
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CURRENT = 'CURRENT'
+
+
+def generation_path(directory, generation):
+    """
+    Returns path of snapshot of given generation.
+    """
+    return os.path.join(directory, 'generation-{}.snapshot'.format(generation))
+
+
+def current_generation(directory):
+    """
+    Returns number of newest published generation or None.
+    """
+    try:
+        with open(os.path.join(directory, CURRENT), 'r') as current:
+            return int(current.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def publish(directory, data):
+    """
+    Publishes presence store as new generation.
+
+    Generations older than the previous one are removed; workers which
+    still map them keep their pages until they attach to a newer one.
+    """
+    generation = (current_generation(directory) or 0) + 1
+    write_snapshot(
+        generation_path(directory, generation),
+        data,
+        {'generation': generation},
+    )
+
+    current = os.path.join(directory, CURRENT)
+    temporary = '{}.{}.tmp'.format(current, os.getpid())
+    with open(temporary, 'w') as current_file:
+        current_file.write(str(generation))
+    os.rename(temporary, current)
+
+    for name in os.listdir(directory):
+        if not name.startswith('generation-'):
+            continue
+        try:
+            old = int(name[len('generation-'):-len('.snapshot')])
+        except ValueError:
+            continue
+        if old < generation - 1:
+            os.remove(os.path.join(directory, name))
+    return generation
+
+
+def attach(directory, attempts=3):
+    """
+    Maps newest published generation read-only.
+
+    Returns PresenceStore or None if nothing was published yet.
+    """
+    for _ in range(attempts):
+        generation = current_generation(directory)
+        if generation is None:
+            return None
+        restored = read_snapshot(generation_path(directory, generation))
+        if restored is not None:
+            log.debug('Attached to generation %d', generation)
+            return restored[0]
+        # generation removed between reading CURRENT and opening it
+    return None
+
+
+def run_loader(source, directory, interval, workers=1):
+    """
+    Loads source file every interval seconds and publishes changed data.
+    """
+    from presence_analyzer.utils import PresenceLoader
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    loader = PresenceLoader()
+    version = None
+    while True:
+        try:
+            data = loader.load(source, workers=workers)
+        except (IOError, OSError):
+            log.exception('Cannot load %s', source)
+        else:
+            if data.version != version:
+                generation = publish(directory, data)
+                version = data.version
+                log.info('Published generation %d of %s', generation, source)
+        time.sleep(interval)
+
+
+def main(config=app.config, environ=os.environ):
+    """
+    Runs loader with configuration of the WSGI application, see
+    presence_analyzer.main.configure().
+    """
+    configure(config, environ)
+    if not config['DATA_PLANE']:
+        raise SystemExit(
+            'DATA_PLANE is not set, e.g. set PRESENCE_ANALYZER_DATA_PLANE '
+            'to the directory shared with workers'
+        )
+    logging.basicConfig(level=logging.INFO)
+    run_loader(
+        config['DATA_CSV'],
+        config['DATA_PLANE'],
+        config['CACHE_CHECK_INTERVAL'],
+        config['INGEST_WORKERS'],
+    )
+
+
+if __name__ == '__main__':
+    main()
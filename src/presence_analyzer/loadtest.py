@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP load test comparing presence analyzer servers.
+
+Every connection sends GET requests for the given paths in turn, for a
+fixed time; prints requests per second and latency percentiles of every
+server URL.
+
+Requires Python 3. Usage:
+python -m presence_analyzer.loadtest http://127.0.0.1:5000 \\
+    http://127.0.0.1:8000 [--connections 32] [--duration 10]
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+from urllib.parse import urlsplit
+
+
+DEFAULT_PATHS = [
+    '/api/v1/mean_time_weekday/10',
+    '/api/v1/presence_weekday/11',
+    '/api/v1/presence_start_end/10',
+    '/api/v1/presence_days/11',
+    '/api/v1/users_data',
+]
+
+
+def percentile(ordered, fraction):
+    """
+    Returns value below which given fraction of sorted values lies.
+    """
+    if not ordered:
+        return float('nan')
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def read_response(reader):
+    """
+    Reads HTTP response, returns (status, keep connection alive).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed')
+    version, status = status_line.split(None, 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.split(b':', 1)
+        headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = (
+        version == b'HTTP/1.1' and headers.get(b'connection') != b'close'
+    )
+    if b'content-length' in headers:
+        await reader.readexactly(int(headers[b'content-length']))
+    else:
+        await reader.read()
+        keep_alive = False
+    return int(status), keep_alive
+
+
+async def connection(host, port, paths, deadline, latencies, errors):
+    """
+    Sends requests until deadline, reconnecting when server closes.
+    """
+    reader = writer = None
+    for path in itertools.cycle(paths):
+        if time.perf_counter() >= deadline:
+            break
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write((
+                'GET {} HTTP/1.1\r\nHost: {}:{}\r\n\r\n'
+            ).format(path, host, port).encode('latin-1'))
+            status, keep_alive = await read_response(reader)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            errors.append(path)
+            keep_alive = False
+        else:
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append(path)
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(url, paths, connections, duration):
+    """
+    Loads server at url, returns (requests per second, latencies, errors).
+    """
+    parts = urlsplit(url)
+    deadline = time.perf_counter() + duration
+    latencies = []
+    errors = []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        connection(
+            parts.hostname, parts.port or 80, paths, deadline, latencies,
+            errors,
+        )
+        for _ in range(connections)
+    ])
+    elapsed = time.perf_counter() - started
+    return len(latencies) / elapsed, sorted(latencies), errors
+
+
+def main(argv=None):
+    """
+    Runs load test of servers given in command line.
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('urls', nargs='+', help='base URLs of servers')
+    parser.add_argument('--path', action='append', dest='paths')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    for url in args.urls:
+        rate, latencies, errors = asyncio.get_event_loop().run_until_complete(
+            run_load(
+                url, args.paths or DEFAULT_PATHS, args.connections,
+                args.duration,
+            )
+        )
+        print(
+            '{}: {:.0f} req/s, p50 {:.1f} ms, p99 {:.1f} ms, '
+            '{} errors'.format(
+                url,
+                rate,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                len(errors),
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 """
 Flask app initialization.
 """
+import os
 import os.path
 from flask import Flask
 from flask_mako import MakoTemplates
@@ -18,7 +19,58 @@ app = Flask(__name__)  # pylint: disable=invalid-name
 app.config.update(
     DEBUG=True,
     DATA_CSV=MAIN_DATA_CSV,
-    DATA_XML=MAIN_DATA_XML
+    DATA_XML=MAIN_DATA_XML,
+    # seconds between checks if data files changed
+    CACHE_CHECK_INTERVAL=5,
+    # keep memory mapped snapshot of parsed data next to DATA_CSV
+    DATA_SNAPSHOT=False,
+    # directory of data shared by workers, see presence_analyzer.dataplane
+    DATA_PLANE=None,
+    # glob of time partitioned CSV files used instead of DATA_CSV, see
+    # presence_analyzer.partitions
+    DATA_PARTITIONS=None,
+    # processes parsing DATA_CSV when it is loaded from scratch
+    INGEST_WORKERS=1,
+    # threads loading data and rendering pages in asyncio serving mode
+    ASGI_THREADS=8,
+    # stage timings, Server-Timing header and /metrics endpoint
+    INSTRUMENTATION=False,
 )
 
 mako = MakoTemplates(app)
+
+# prefix of environment variables overriding configuration
+ENV_PREFIX = 'PRESENCE_ANALYZER_'
+
+
+def parse_env_value(text, default):
+    """
+    Converts environment variable text to type of default value.
+    """
+    if isinstance(default, bool):
+        return text.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(text)
+    if isinstance(default, float):
+        return float(text)
+    if default is None and not text:
+        return None
+    return text
+
+
+def configure(config, environ=os.environ):
+    """
+    Loads production configuration.
+
+    Turns debug off, then reads the Python file named in
+    PRESENCE_ANALYZER_SETTINGS variable, if any, and finally overrides
+    keys with PRESENCE_ANALYZER_<KEY> variables, e.g.
+    PRESENCE_ANALYZER_DATA_CSV.
+    """
+    config['DEBUG'] = False
+    settings = environ.get(ENV_PREFIX + 'SETTINGS')
+    if settings:
+        config.from_pyfile(settings)
+    for key, default in list(config.items()):
+        if ENV_PREFIX + key in environ:
+            config[key] = parse_env_value(environ[ENV_PREFIX + key], default)
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of API requests and caches.
+
+With app.config['INSTRUMENTATION'] on, time spent in stages of every API
+request (data load, aggregation, serialization and the rest, mostly cache
+lookups) is sent in Server-Timing header and, together with time spent
+waiting for cache locks, collected in histograms. render() presents them
+and cache counters in Prometheus text format. When instrumentation is off
+every hook costs a single flag check.
+"""
+
+import threading
+import timeit
+from bisect import bisect_left
+
+from flask import g, has_request_context
+
+from presence_analyzer.main import app
+
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# order of stages in Server-Timing header
+STAGES = ('load', 'aggregate', 'serialize', 'cache')
+
+HISTOGRAMS = {
+    'presence_analyzer_stage_seconds':
+        'Time spent in stages of API requests.',
+    'presence_analyzer_cache_lock_wait_seconds':
+        'Time spent waiting for cache locks.',
+}
+
+CACHE_COUNTERS = (
+    ('hits', 'Results served from cache.'),
+    ('misses', 'Results loaded by the caller.'),
+    ('stale', 'Stale results served while reloading in background.'),
+    ('loads', 'Completed loads.'),
+    ('load_errors', 'Failed loads.'),
+    ('evictions', 'Results evicted to respect size limits.'),
+)
+
+CACHE_GAUGES = (
+    ('entries', 'Cached results.'),
+    ('bytes', 'Approximate size of cached results.'),
+)
+
+
+def enabled():
+    """
+    Checks if instrumentation is on.
+    """
+    return app.config['INSTRUMENTATION']
+
+
+class Histogram(object):
+    """
+    Counts of observed values in BUCKETS, with their sum.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Records one value.
+        """
+        index = bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        """
+        Yields (upper bound text, cumulative count) of buckets.
+        """
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            total += count
+            yield str(bound), total
+
+
+class Registry(object):
+    """
+    Histograms by name and labels, and stats of registered caches.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.caches = {}
+
+    def histogram(self, name, **labels):
+        """
+        Returns histogram of given name and labels, creating it if needed.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        try:
+            return self.histograms[key]
+        except KeyError:
+            with self.lock:
+                return self.histograms.setdefault(key, Histogram())
+
+    def register_cache(self, name, stats):
+        """
+        Exposes stats dict of cache decorator.
+        """
+        with self.lock:
+            self.caches[name] = stats
+
+
+registry = Registry()  # pylint: disable=invalid-name
+
+
+def format_labels(labels):
+    """
+    Returns Prometheus label set text.
+    """
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in labels
+    ) + '}'
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    lines = []
+    histograms = {}
+    for (name, labels), histogram in sorted(registry.histograms.items()):
+        histograms.setdefault(name, []).append((labels, histogram))
+    for name, series in sorted(histograms.items()):
+        lines.append('# HELP {} {}'.format(name, HISTOGRAMS.get(name, '')))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in series:
+            count = 0
+            for bound, count in histogram.samples():
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', bound),)), count
+                ))
+            lines.append('{}_sum{} {!r}'.format(
+                name, format_labels(labels), histogram.sum
+            ))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), count
+            ))
+
+    caches = sorted(registry.caches.items())
+    for kind, suffix, stats_names in (
+            ('counter', '_total', CACHE_COUNTERS),
+            ('gauge', '', CACHE_GAUGES),
+    ):
+        for stat, description in stats_names:
+            name = 'presence_analyzer_cache_{}{}'.format(stat, suffix)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for cache_name, stats in caches:
+                lines.append('{}{} {}'.format(
+                    name, format_labels((('cache', cache_name),)),
+                    stats[stat],
+                ))
+    return '\n'.join(lines) + '\n'
+
+
+# stage timings of request served outside of Flask request context
+local = threading.local()  # pylint: disable=invalid-name
+
+
+def request_timings():
+    """
+    Returns dict of stage timings of current request or None.
+    """
+    if not has_request_context():
+        return getattr(local, 'timings', None)
+    timings = getattr(g, 'stage_timings', None)
+    if timings is None:
+        timings = g.stage_timings = {}
+    return timings
+
+
+def collect(timings, func, *args):
+    """
+    Calls func(*args) adding its stage timings to given dict.
+
+    Used by requests served without Flask request context, e.g. in thread
+    pool of asyncio serving mode.
+    """
+    previous = getattr(local, 'timings', None)
+    local.timings = timings
+    try:
+        return func(*args)
+    finally:
+        local.timings = previous
+
+
+class Stage(object):
+    """
+    Context manager adding its duration to timings of current request.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = request_timings()
+        if timings is None:
+            return
+        timings[self.name] = (
+            timings.get(self.name, 0.0) +
+            timeit.default_timer() - self.started
+        )
+
+
+class NoStage(object):
+    """
+    Context manager doing nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_STAGE = NoStage()
+
+
+def stage(name):
+    """
+    Returns context manager timing stage of current request.
+    """
+    if not enabled():
+        return NO_STAGE
+    return Stage(name)
+
+
+def start_request():
+    """
+    Returns start time of instrumented request or None.
+    """
+    if not enabled():
+        return None
+    if has_request_context():
+        g.stage_timings = {}
+    return timeit.default_timer()
+
+
+def record_request(started, endpoint, timings):
+    """
+    Records stage timings of request, returns Server-Timing header value.
+
+    Time not spent in other stages is counted as 'cache'.
+    """
+    total = timeit.default_timer() - started
+    timings['cache'] = max(total - sum(timings.values()), 0.0)
+    for name, seconds in timings.items():
+        registry.histogram(
+            'presence_analyzer_stage_seconds', endpoint=endpoint, stage=name
+        ).observe(seconds)
+    return ', '.join(
+        '{};dur={:.3f}'.format(name, timings[name] * 1000)
+        for name in STAGES if name in timings
+    )
+
+
+def finish_request(started, endpoint, response):
+    """
+    Records stage timings of Flask request and adds Server-Timing header.
+    """
+    if started is None:
+        return
+    response.headers['Server-Timing'] = record_request(
+        started, endpoint, getattr(g, 'stage_timings', {})
+    )
+
+
+class TimedLock(object):
+    """
+    Context manager acquiring lock and recording time spent waiting.
+    """
+
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def __enter__(self):
+        started = timeit.default_timer()
+        self.lock.acquire()
+        self.histogram.observe(timeit.default_timer() - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def timed_lock(lock, cache_name):
+    """
+    Returns lock itself, or when instrumentation is on, context manager
+    also recording wait for it.
+    """
+    if not enabled():
+        return lock
+    return TimedLock(lock, registry.histogram(
+        'presence_analyzer_cache_lock_wait_seconds', cache=cache_name
+    ))
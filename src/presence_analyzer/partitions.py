@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data split into time partitioned CSV files.
+
+Every file matching DATA_PARTITIONS glob holds entries of one period,
+e.g. one month, and its name contains the first date of the period as
+YYYY-MM or YYYY-MM-DD, e.g. presence-2013-09.csv. A partition ends the
+day before the next one starts; the newest one has no end.
+
+Weekday totals of every user of a partition, its rollup, are written
+next to the file, so queries of whole old partitions do not need to
+parse them again.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+from datetime import date
+
+from presence_analyzer.store import WeekdayIndex
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PARTITION_DATE = re.compile(r'(\d{4})-(\d{2})(?:-(\d{2}))?')
+
+
+Partition = namedtuple('Partition', ['first', 'last', 'path'])
+
+
+def partition_start(path):
+    """
+    Returns ordinal of last date found in file name or None.
+    """
+    found = PARTITION_DATE.findall(os.path.basename(path))
+    if not found:
+        return None
+    year, month, day = found[-1]
+    try:
+        return date(int(year), int(month), int(day or 1)).toordinal()
+    except ValueError:
+        return None
+
+
+def list_partitions(pattern):
+    """
+    Returns Partitions of files matching glob pattern, ordered by date.
+
+    Files without a date in their name are skipped. The last partition
+    has None instead of last date ordinal.
+    """
+    starts = []
+    for path in glob.glob(pattern):
+        first = partition_start(path)
+        if first is None:
+            log.warning('No date in name of partition %s, skipping', path)
+            continue
+        starts.append((first, path))
+    starts.sort()
+    return [
+        Partition(first, next_first - 1 if next_first else None, path)
+        for (first, path), (next_first, _) in zip(
+            starts, starts[1:] + [(None, None)]
+        )
+    ]
+
+
+def overlapping(partitions, first=None, last=None):
+    """
+    Returns partitions with dates between first and last ordinal; None
+    means no limit.
+    """
+    return [
+        partition for partition in partitions
+        if (first is None or partition.last is None or
+            partition.last >= first) and
+        (last is None or partition.first <= last)
+    ]
+
+
+def covers(partition, first=None, last=None):
+    """
+    Checks if all dates of partition are between first and last ordinal.
+    """
+    return (
+        (first is None or partition.first >= first) and
+        (last is None or partition.last is not None and partition.last <= last)
+    )
+
+
+def rollup_path(source):
+    """
+    Returns path of rollup kept next to partition file.
+    """
+    return source + '.rollup.json'
+
+
+def read_rollup(source, signature):
+    """
+    Reads {user_id: WeekdayIndex} rollup of partition file.
+
+    Returns None if there is no rollup or it was made of other version of
+    the file, as given by its (path, modification time, size) signature.
+    """
+    try:
+        with open(rollup_path(source), 'r') as rollup_file:
+            rollup = json.load(rollup_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if [rollup.get('mtime'), rollup.get('size')] != list(signature[1:]):
+        log.debug('Rollup of %s is outdated', source)
+        return None
+
+    users = {}
+    for user_id, counts, intervals, starts, ends in rollup['users']:
+        weekdays = users[user_id] = WeekdayIndex()
+        weekdays.counts = counts
+        weekdays.intervals = intervals
+        weekdays.starts = starts
+        weekdays.ends = ends
+    return users
+
+
+def write_rollup(source, signature, users):
+    """
+    Writes {user_id: WeekdayIndex} rollup of partition file of given
+    signature.
+
+    The file is written under temporary name and renamed; failures are
+    logged, as the rollup can always be computed again.
+    """
+    target = rollup_path(source)
+    temporary = '{}.{}.tmp'.format(target, os.getpid())
+    try:
+        with open(temporary, 'w') as rollup_file:
+            json.dump({
+                'mtime': signature[1],
+                'size': signature[2],
+                'users': [
+                    [
+                        user_id,
+                        weekdays.counts,
+                        weekdays.intervals,
+                        weekdays.starts,
+                        weekdays.ends,
+                    ]
+                    for user_id, weekdays in sorted(users.items())
+                ],
+            }, rollup_file)
+        os.rename(temporary, target)
+    except (IOError, OSError):
+        log.warning('Cannot write rollup of %s', source, exc_info=True)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of presence data.
+
+QuantileSketch is a KLL sketch (Karnin, Lang, Liberty: Optimal Quantile
+Approximation in Streams, 2016). Values are kept in levels; a value on
+level h stands for 2 ** h original values. When a level fills up it is
+sorted and every other value, starting at a random offset, moves one
+level up. Level capacities shrink geometrically by 2/3 going down from
+the top level, so a sketch keeps O(k) values however many it has seen.
+
+Error bounds: rank of the value returned for fraction q differs from
+q * count by at most about 1.7% of count with 99% probability for the
+default k=200, and the error falls as 1/k. A sketch of fewer than k
+values is exact. Merging sketches gives the same guarantees as building
+one from all values.
+
+WeekdayValues keeps all values instead, for exact quantiles of few
+entries, e.g. of one user.
+"""
+
+import math
+
+
+DEFAULT_K = 200
+MIN_CAPACITY = 8
+
+# quantiles reported when none are requested
+DEFAULT_FRACTIONS = (0.5, 0.9, 0.99)
+
+
+class QuantileSketch(object):
+    """
+    KLL sketch of a stream of numbers.
+    """
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.levels = [[]]
+        self.capacities = [k]
+        self.count = 0
+        # state of generator of compaction offsets, results are repeatable
+        self.seed = 1
+
+    def add_level(self):
+        """
+        Adds empty top level, shrinking capacities of levels below.
+        """
+        self.levels.append([])
+        depth = len(self.levels)
+        self.capacities = [
+            max(MIN_CAPACITY, int(math.ceil(
+                self.k * (2.0 / 3) ** (depth - level - 1)
+            )))
+            for level in range(depth)
+        ]
+
+    def update(self, value):
+        """
+        Adds one value.
+        """
+        self.levels[0].append(value)
+        self.count += 1
+        if len(self.levels[0]) >= self.capacities[0]:
+            self.compress()
+
+    def update_many(self, values):
+        """
+        Adds values of a sequence.
+
+        While enough values are left to fill a level above level 0, a block
+        of them is sorted and halved straight to the highest such level:
+        the same compactions adding them one by one would do, but on
+        bigger blocks and with much less bookkeeping.
+        """
+        position = 0
+        while position < len(values):
+            left = len(values) - position
+            level = len(self.levels) - 1
+            while level > 0 and self.capacities[level] << level > left:
+                level -= 1
+            if level:
+                size = self.capacities[level] << level
+                block = sorted(values[position:position + size])
+                for _ in range(level):
+                    block = block[self.coin()::2]
+                self.levels[level].extend(block)
+                self.count += size
+                position += size
+                self.compress(full=True)
+                continue
+            room = max(self.capacities[0] - len(self.levels[0]), 1)
+            chunk = values[position:position + room]
+            position += room
+            self.levels[0].extend(chunk)
+            self.count += len(chunk)
+            if len(self.levels[0]) >= self.capacities[0]:
+                self.compress()
+
+    def coin(self):
+        """
+        Returns pseudo random offset, 0 or 1, of the next compaction.
+        """
+        self.seed = (self.seed * 1103515245 + 12345) & 0x7fffffff
+        return self.seed >> 16 & 1
+
+    def compress(self, full=False):
+        """
+        Compacts full levels into the ones above them.
+
+        Stops at the first level that is not full, unless full is set or
+        a level was added and capacities changed.
+        """
+        depth = len(self.levels)
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) >= self.capacities[level]:
+                if level + 1 == len(self.levels):
+                    self.add_level()
+                values.sort()
+                # odd value out stays, so weights add up exactly
+                kept = [values.pop()] if len(values) % 2 else []
+                self.levels[level + 1].extend(values[self.coin()::2])
+                self.levels[level] = kept
+            elif not full and len(self.levels) == depth:
+                break
+            level += 1
+
+    def merge(self, other):
+        """
+        Adds all values seen by other sketch.
+        """
+        while len(self.levels) < len(other.levels):
+            self.add_level()
+        for values, other_values in zip(self.levels, other.levels):
+            values.extend(other_values)
+        self.count += other.count
+        self.compress(full=True)
+
+    def copy(self):
+        """
+        Returns independent sketch of the same values.
+        """
+        result = QuantileSketch(self.k)
+        result.levels = [list(values) for values in self.levels]
+        result.capacities = list(self.capacities)
+        result.count = self.count
+        result.seed = self.seed
+        return result
+
+    def quantiles(self, fractions):
+        """
+        Returns approximate value below which each fraction of values lies.
+
+        Returns zeros for a sketch without values.
+        """
+        if not self.count:
+            return [0] * len(fractions)
+        weighted = sorted(
+            (value, 1 << level)
+            for level, values in enumerate(self.levels)
+            for value in values
+        )
+        result = []
+        for fraction in fractions:
+            target = fraction * self.count
+            rank = 0
+            for value, weight in weighted:
+                rank += weight
+                if rank >= target:
+                    break
+            result.append(value)
+        return result
+
+
+def exact_quantiles(ordered, fractions):
+    """
+    Returns value below which each fraction of sorted values lies.
+
+    Ranks are rounded like in QuantileSketch.quantiles(); returns zeros
+    for no values.
+    """
+    if not ordered:
+        return [0] * len(fractions)
+    return [
+        ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+        for fraction in fractions
+    ]
+
+
+class WeekdaySketches(object):
+    """
+    Sketches of daily presence time and start and end times, all in
+    seconds, for every weekday.
+    """
+
+    def __init__(self, k=DEFAULT_K):
+        self.presence = [QuantileSketch(k) for _ in range(7)]
+        self.starts = [QuantileSketch(k) for _ in range(7)]
+        self.ends = [QuantileSketch(k) for _ in range(7)]
+
+    def extend(self, weekday, presence, starts, ends):
+        """
+        Adds presence times, start times and end times of entries of one
+        weekday, given as lists.
+        """
+        self.presence[weekday].update_many(presence)
+        self.starts[weekday].update_many(starts)
+        self.ends[weekday].update_many(ends)
+
+    def merge(self, other):
+        """
+        Adds all entries seen by other sketches.
+        """
+        for name in ('presence', 'starts', 'ends'):
+            for mine, theirs in zip(getattr(self, name), getattr(other, name)):
+                mine.merge(theirs)
+
+    def copy(self):
+        """
+        Returns independent sketches of the same entries.
+        """
+        result = WeekdaySketches()
+        for name in ('presence', 'starts', 'ends'):
+            setattr(result, name, [
+                sketch.copy() for sketch in getattr(self, name)
+            ])
+        return result
+
+    def quantiles(self, fractions=DEFAULT_FRACTIONS):
+        """
+        Returns dict with number of entries and, for presence, start and
+        end, list of quantiles of given fractions for each weekday.
+        """
+        return {
+            'days': [sketch.count for sketch in self.presence],
+            'presence': [
+                sketch.quantiles(fractions) for sketch in self.presence
+            ],
+            'start': [sketch.quantiles(fractions) for sketch in self.starts],
+            'end': [sketch.quantiles(fractions) for sketch in self.ends],
+        }
+
+
+class WeekdayValues(object):
+    """
+    Daily presence times and start and end times, all in seconds, for
+    every weekday; like WeekdaySketches, but keeps every value and gives
+    exact quantiles.
+    """
+
+    def __init__(self):
+        self.presence = [[] for _ in range(7)]
+        self.starts = [[] for _ in range(7)]
+        self.ends = [[] for _ in range(7)]
+
+    def extend(self, weekday, presence, starts, ends):
+        """
+        Adds presence times, start times and end times of entries of one
+        weekday, given as lists.
+        """
+        self.presence[weekday].extend(presence)
+        self.starts[weekday].extend(starts)
+        self.ends[weekday].extend(ends)
+
+    def quantiles(self, fractions=DEFAULT_FRACTIONS):
+        """
+        Returns dict with number of entries and, for presence, start and
+        end, list of quantiles of given fractions for each weekday.
+        """
+        return {
+            'days': [len(values) for values in self.presence],
+            'presence': [
+                exact_quantiles(sorted(values), fractions)
+                for values in self.presence
+            ],
+            'start': [
+                exact_quantiles(sorted(values), fractions)
+                for values in self.starts
+            ],
+            'end': [
+                exact_quantiles(sorted(values), fractions)
+                for values in self.ends
+            ],
+        }
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot file starts with MAGIC, length of JSON header and the header
+itself. Header describes the source file and, for every user, number of
+entries and weekday totals. Then, aligned to 8 bytes, come date, start
+and end columns of all users as native int32 values, which are memory
+mapped when the snapshot is read.
+"""
+
+import ctypes
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from presence_analyzer.store import PresenceStore, UserPresence, WeekdayIndex
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = b'PRESNAP\x01'
+LENGTH = struct.Struct('<Q')
+ALIGNMENT = 8
+
+
+def snapshot_path(source):
+    """
+    Returns path of snapshot kept next to source file.
+    """
+    return source + '.snapshot'
+
+
+# Python 2 memoryview cannot be cast, ctypes arrays view the mapping
+# instead; they need it writable, so it is mapped copy-on-write
+CAST_VIEWS = hasattr(memoryview, 'cast')
+ACCESS = mmap.ACCESS_READ if CAST_VIEWS else mmap.ACCESS_COPY
+
+
+def int_column(buf, offset, count):
+    """
+    Returns int32 column of count items starting at offset of buffer.
+
+    The column is a view of the buffer, not a copy, so pages of a mapped
+    snapshot are shared by all processes which read it.
+    """
+    if CAST_VIEWS:
+        return memoryview(buf)[offset:offset + count * 4].cast('i')
+    return (ctypes.c_int * count).from_buffer(buf, offset)
+
+
+def column_bytes(column):
+    """
+    Returns raw bytes of int32 column.
+    """
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    if isinstance(column, array):  # Python 2
+        return column.tostring()
+    return ctypes.string_at(ctypes.addressof(column), ctypes.sizeof(column))
+
+
+def write_snapshot(target, data, state):
+    """
+    Writes presence store and loader state to snapshot file.
+
+    The file is written under temporary name and renamed, so readers never
+    see partially written snapshot.
+    """
+    users = [
+        [
+            user_id,
+            len(user),
+            user.weekdays.counts,
+            user.weekdays.intervals,
+            user.weekdays.starts,
+            user.weekdays.ends,
+        ]
+        for user_id, user in sorted(data.items())
+    ]
+    header = dict(
+        state,
+        byteorder=sys.byteorder,
+        itemsize=array('i').itemsize,
+        version=data.version,
+        users=users,
+    )
+    header = json.dumps(header).encode('utf-8')
+    padding = -(len(MAGIC) + LENGTH.size + len(header)) % ALIGNMENT
+
+    temporary = '{}.{}.tmp'.format(target, os.getpid())
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(LENGTH.pack(len(header)))
+        snapshot.write(header)
+        snapshot.write(b'\0' * padding)
+        for user_id, _, _, _, _, _ in users:
+            user = data[user_id]
+            for column in (user.dates, user.starts, user.ends):
+                snapshot.write(column_bytes(column))
+    os.rename(temporary, target)
+
+
+def read_snapshot(target):
+    """
+    Memory maps snapshot file.
+
+    Returns (PresenceStore, loader state) or None if there is no usable
+    snapshot.
+    """
+    try:
+        with open(target, 'rb') as snapshot:
+            buf = mmap.mmap(snapshot.fileno(), 0, access=ACCESS)
+    except (IOError, OSError, ValueError):
+        return None
+
+    try:
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a presence snapshot')
+        offset = len(MAGIC) + LENGTH.size
+        length, = LENGTH.unpack(buf[len(MAGIC):offset])
+        header = json.loads(buf[offset:offset + length].decode('utf-8'))
+        if (
+                header.pop('byteorder') != sys.byteorder or
+                header.pop('itemsize') != array('i').itemsize
+        ):
+            raise ValueError('Snapshot written on other platform')
+        offset += length
+        offset += -offset % ALIGNMENT
+        if offset + sum(user[1] for user in header['users']) * 12 > len(buf):
+            raise ValueError('Truncated snapshot')
+    except (ValueError, KeyError, struct.error):
+        log.warning('Ignoring malformed snapshot %s', target, exc_info=True)
+        return None
+
+    users = {}
+    for user_id, count, counts, intervals, starts, ends in header.pop('users'):
+        weekdays = WeekdayIndex()
+        weekdays.counts = counts
+        weekdays.intervals = intervals
+        weekdays.starts = starts
+        weekdays.ends = ends
+        users[user_id] = UserPresence(
+            int_column(buf, offset, count),
+            int_column(buf, offset + count * 4, count),
+            int_column(buf, offset + count * 8, count),
+            weekdays,
+        )
+        offset += count * 12
+    return PresenceStore(users, header.pop('version')), header
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Computes weekday statistics of presence CSV export in constant memory.
+
+Rows are streamed from the file straight into per-user weekday totals,
+so exports of any size can be processed; only totals of every user are
+kept. Prints one JSON object per user.
+
+Usage: python -m presence_analyzer.stats <export.csv>
+"""
+
+import argparse
+import json
+import sys
+
+from presence_analyzer.utils import load_weekday_totals
+
+
+def main(argv=None):
+    """
+    Prints weekday statistics of CSV file given in command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='presence CSV file')
+    args = parser.parse_args(argv)
+
+    totals = load_weekday_totals(args.path)
+    for user_id in sorted(totals):
+        weekdays = totals[user_id]
+        sys.stdout.write(json.dumps({
+            'user_id': user_id,
+            'days': weekdays.counts,
+            'presence': weekdays.totals(),
+            'mean': weekdays.means(),
+            'start_end': weekdays.start_end_means(),
+        }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,806 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented storage of presence data.
+"""
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, time
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+try:
+    import numpy
+except ImportError:  # aggregation falls back to pure Python
+    numpy = None
+
+from presence_analyzer.sketch import WeekdaySketches, WeekdayValues
+
+
+DAY_SECONDS = 24 * 60 * 60
+
+# bytes of one item of date, start and end columns
+ITEMSIZE = array('i').itemsize
+
+
+def ordinal_weekday(ordinal):
+    """
+    Returns weekday (Monday is 0) of a proleptic Gregorian ordinal.
+    """
+    return (ordinal - 1) % 7
+
+
+def time_from_seconds(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class WeekdayIndex(object):
+    """
+    Presence totals of one user grouped by weekday.
+
+    For every weekday keeps number of days, sum of presence intervals and
+    sums of start and end times, all in seconds.
+    """
+
+    def __init__(self, dates=(), starts=(), ends=()):
+        self.counts = [0] * 7
+        self.intervals = [0] * 7
+        self.starts = [0] * 7
+        self.ends = [0] * 7
+        for ordinal, start, end in zip(dates, starts, ends):
+            weekday = (ordinal - 1) % 7
+            self.counts[weekday] += 1
+            self.intervals[weekday] += end - start
+            self.starts[weekday] += start
+            self.ends[weekday] += end
+
+    def add(self, ordinal, start, end):
+        """
+        Adds one presence entry.
+        """
+        weekday = (ordinal - 1) % 7
+        self.counts[weekday] += 1
+        self.intervals[weekday] += end - start
+        self.starts[weekday] += start
+        self.ends[weekday] += end
+
+    def __add__(self, other):
+        result = WeekdayIndex()
+        for name in ('counts', 'intervals', 'starts', 'ends'):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            setattr(result, name, [a + b for a, b in zip(mine, theirs)])
+        return result
+
+    def totals(self):
+        """
+        Returns total presence time in (s) for each weekday.
+        """
+        return list(self.intervals)
+
+    def means(self):
+        """
+        Returns mean presence time in (s) for each weekday.
+        """
+        return [
+            float(total) / count if count else 0
+            for total, count in zip(self.intervals, self.counts)
+        ]
+
+    def start_end_means(self):
+        """
+        Returns [mean start, mean end] in (s) for each weekday.
+        """
+        return [
+            [int(float(start) / count), int(float(end) / count)]
+            if count else [0, 0]
+            for start, end, count in zip(self.starts, self.ends, self.counts)
+        ]
+
+
+class WeekdayPrefixSums(object):
+    """
+    Prefix sums of presence columns of one user, separate for each weekday.
+
+    Let WeekdayIndex of any date range be computed with two binary
+    searches per weekday instead of scanning the range.
+    """
+
+    def __init__(self, dates, starts, ends):
+        self.dates = [array('i') for _ in range(7)]
+        self.intervals = [array('l', [0]) for _ in range(7)]
+        self.starts = [array('l', [0]) for _ in range(7)]
+        self.ends = [array('l', [0]) for _ in range(7)]
+        for ordinal, start, end in zip(dates, starts, ends):
+            weekday = ordinal_weekday(ordinal)
+            self.dates[weekday].append(ordinal)
+            self.intervals[weekday].append(
+                self.intervals[weekday][-1] + end - start
+            )
+            self.starts[weekday].append(self.starts[weekday][-1] + start)
+            self.ends[weekday].append(self.ends[weekday][-1] + end)
+
+    def between(self, first, last):
+        """
+        Returns WeekdayIndex of dates between first and last ordinals.
+        """
+        result = WeekdayIndex()
+        for weekday in range(7):
+            low = bisect_left(self.dates[weekday], first)
+            high = bisect_right(self.dates[weekday], last)
+            if high <= low:
+                continue
+            result.counts[weekday] = high - low
+            for name in ('intervals', 'starts', 'ends'):
+                sums = getattr(self, name)[weekday]
+                getattr(result, name)[weekday] = sums[high] - sums[low]
+        return result
+
+
+class UserPresence(Mapping):
+    """
+    Read-only presence entries of one user.
+
+    Behaves like {date: {'start': time, 'end': time}} mapping, but keeps
+    only three parallel, date sorted columns: date ordinals and start / end
+    times as seconds since midnight. Weekday totals are computed once,
+    when the columns are created, and kept in weekdays attribute.
+
+    Date ranges are found with binary search; weekday totals of a range
+    come from prefix sums built on first range query.
+    """
+
+    def __init__(self, dates, starts, ends, weekdays=None):
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        if weekdays is None:
+            weekdays = WeekdayIndex(dates, starts, ends)
+        self.weekdays = weekdays
+        self._prefix_sums = None
+
+    def _index(self, day):
+        """
+        Returns position of given date in columns or -1.
+        """
+        try:
+            ordinal = day.toordinal()
+        except AttributeError:
+            return -1
+        index = bisect_left(self.dates, ordinal)
+        if index < len(self.dates) and self.dates[index] == ordinal:
+            return index
+        return -1
+
+    def __getitem__(self, day):
+        index = self._index(day)
+        if index < 0:
+            raise KeyError(day)
+        return {
+            'start': time_from_seconds(self.starts[index]),
+            'end': time_from_seconds(self.ends[index]),
+        }
+
+    def __contains__(self, day):
+        return self._index(day) >= 0
+
+    def __iter__(self):
+        return (date.fromordinal(ordinal) for ordinal in self.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(
+            len(column) * ITEMSIZE
+            for column in (self.dates, self.starts, self.ends)
+        )
+
+    def rows(self):
+        """
+        Iterates over (date ordinal, start, end) rows in date order.
+        """
+        return zip(self.dates, self.starts, self.ends)
+
+    def span(self, first=None, last=None):
+        """
+        Returns (low, high) column positions of dates between first and
+        last ordinal, both inclusive; None means no limit.
+        """
+        low = 0 if first is None else bisect_left(self.dates, first)
+        high = (
+            len(self.dates) if last is None
+            else bisect_right(self.dates, last)
+        )
+        return low, max(low, high)
+
+    def weekdays_between(self, first=None, last=None):
+        """
+        Returns WeekdayIndex of dates between first and last ordinal.
+        """
+        if first is None and last is None:
+            return self.weekdays
+        if self._prefix_sums is None:
+            self._prefix_sums = WeekdayPrefixSums(
+                self.dates, self.starts, self.ends
+            )
+        return self._prefix_sums.between(
+            1 if first is None else first,
+            date.max.toordinal() if last is None else last,
+        )
+
+    def weekday_values(self, first=None, last=None):
+        """
+        Returns WeekdayValues of entries between first and last ordinal.
+        """
+        user = self.between(first, last)
+        return update_sketches(
+            WeekdayValues(), {None: (user.dates, user.starts, user.ends)}
+        )
+
+    def between(self, first=None, last=None):
+        """
+        Returns UserPresence with dates between first and last ordinal.
+        """
+        if first is None and last is None:
+            return self
+        low, high = self.span(first, last)
+        return UserPresence(
+            self.dates[low:high],
+            self.starts[low:high],
+            self.ends[low:high],
+            self.weekdays_between(first, last),
+        )
+
+
+class IntervalIndex(object):
+    """
+    Presence intervals of many users on one date.
+
+    Entries are sorted by start time and an implicit segment tree keeps
+    the latest end time of every range of entries. Entries overlapping a
+    window are reported in O((k + 1) log n) for k results: binary search
+    over start times limits candidates to a prefix and subtrees ending
+    before the window are skipped.
+    """
+
+    def __init__(self, user_ids, starts, ends):
+        order = sorted(
+            range(len(starts)), key=lambda i: (starts[i], user_ids[i])
+        )
+        self.user_ids = array('l', (user_ids[i] for i in order))
+        self.starts = array('i', (starts[i] for i in order))
+        self.ends = array('i', (ends[i] for i in order))
+        self.size = 1
+        while self.size < len(order):
+            self.size *= 2
+        # latest end in subtree of every node, leaves from position size
+        self.latest = array('i', [-1]) * (2 * self.size)
+        self.latest[self.size:self.size + len(order)] = self.ends
+        for node in range(self.size - 1, 0, -1):
+            self.latest[node] = max(
+                self.latest[2 * node], self.latest[2 * node + 1]
+            )
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, start, end):
+        """
+        Returns (user_id, start, end) of entries overlapping [start, end)
+        window of seconds since midnight, ordered by start.
+        """
+        high = bisect_left(self.starts, end)
+        result = []
+        # (node, first position, number of positions) of subtrees to visit
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, low, width = stack.pop()
+            if low >= high or self.latest[node] <= start:
+                continue
+            if width == 1:
+                result.append(
+                    (self.user_ids[low], self.starts[low], self.ends[low])
+                )
+                continue
+            width //= 2
+            stack.append((2 * node + 1, low + width, width))
+            stack.append((2 * node, low, width))
+        return result
+
+    def present_at(self, seconds):
+        """
+        Returns (user_id, start, end) of entries including given second.
+        """
+        return self.overlapping(seconds, seconds + 1)
+
+
+class PresenceStore(Mapping):
+    """
+    Read-only mapping of user_id to UserPresence.
+
+    Version identifies content of the store; stores with the same version
+    hold the same data, also in different processes.
+
+    IntervalIndex of a date is built on first query of that date; indexes
+    of max_interval_dates most recently queried dates are kept.
+    WeekdaySketches of all entries can be given when the store is created,
+    otherwise they are built on first use.
+    """
+
+    max_interval_dates = 64
+
+    def __init__(self, users, version=None, sketches=None):
+        self._users = users
+        self.version = version
+        self._sketches = sketches
+        self._intervals = OrderedDict()
+        self._intervals_lock = threading.Lock()
+
+    def __getitem__(self, user_id):
+        return self._users[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def __len__(self):
+        return len(self._users)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self._users.__sizeof__() + sum(
+            user.__sizeof__() for user in self._users.values()
+        )
+
+    def sketches(self):
+        """
+        Returns WeekdaySketches of entries of all users.
+        """
+        if self._sketches is None:
+            self._sketches = update_sketches(WeekdaySketches(), {
+                user_id: (user.dates, user.starts, user.ends)
+                for user_id, user in self._users.items()
+            })
+        return self._sketches
+
+    def intervals(self, ordinal):
+        """
+        Returns IntervalIndex of entries on given date ordinal.
+        """
+        with self._intervals_lock:
+            index = self._intervals.pop(ordinal, None)
+            if index is not None:
+                self._intervals[ordinal] = index
+                return index
+
+        index = date_intervals(self, ordinal)
+        with self._intervals_lock:
+            self._intervals[ordinal] = index
+            while len(self._intervals) > self.max_interval_dates:
+                self._intervals.popitem(last=False)
+        return index
+
+
+class RangeWeekdays(Mapping):
+    """
+    Read-only mapping of user_id to WeekdayIndex of a date range.
+
+    Made of parts, each a (mapping, first, last) tuple: either a mapping of
+    user_id to WeekdayIndex covering only dates of the range, or a store
+    whose users are limited to dates between first and last ordinal.
+    WeekdayIndex of a user is added up from all parts on every access.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __getitem__(self, user_id):
+        result = None
+        for users, first, last in self.parts:
+            user = users.get(user_id)
+            if user is None:
+                continue
+            if not isinstance(user, WeekdayIndex):
+                user = user.weekdays_between(first, last)
+            result = user if result is None else result + user
+        if result is None:
+            raise KeyError(user_id)
+        return result
+
+    def __contains__(self, user_id):
+        return any(user_id in users for users, _, _ in self.parts)
+
+    def __iter__(self):
+        seen = set()
+        for users, _, _ in self.parts:
+            for user_id in users:
+                if user_id not in seen:
+                    seen.add(user_id)
+                    yield user_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def is_increasing(values):
+    """
+    Checks if values are strictly increasing.
+    """
+    return all(values[i] < values[i + 1] for i in range(len(values) - 1))
+
+
+def unique_columns(dates, starts, ends):
+    """
+    Returns (dates, starts, ends) columns sorted by date.
+
+    If a date repeats, the last entry wins.
+    """
+    if is_increasing(dates):
+        return dates, starts, ends
+
+    latest = {}
+    for index, ordinal in enumerate(dates):
+        latest[ordinal] = index
+    order = [latest[ordinal] for ordinal in sorted(latest)]
+    return (
+        array('i', (dates[i] for i in order)),
+        array('i', (starts[i] for i in order)),
+        array('i', (ends[i] for i in order)),
+    )
+
+
+def build_user_presence(dates, starts, ends):
+    """
+    Creates UserPresence from unordered columns.
+
+    Entries are sorted by date; if a date repeats, the last entry wins.
+    """
+    return UserPresence(*unique_columns(dates, starts, ends))
+
+
+def int_array(column):
+    """
+    Returns NumPy view of int32 column, or copy of other int sequence,
+    e.g. list made by slicing a ctypes array.
+    """
+    if not len(column):
+        return numpy.zeros(0, numpy.intc)
+    try:
+        return numpy.frombuffer(column, numpy.intc)
+    except (AttributeError, TypeError, ValueError):
+        return numpy.array(column, numpy.intc)
+
+
+def joined_columns(columns, user_ids):
+    """
+    Returns int64 NumPy arrays of (dates, starts, ends) of given users
+    from {user_id: (dates, starts, ends)}, joined in order of user_ids.
+    """
+    return [
+        numpy.concatenate([numpy.zeros(0, numpy.int64)] + [
+            int_array(columns[user_id][position]) for user_id in user_ids
+        ]).astype(numpy.int64)
+        for position in range(3)
+    ]
+
+
+def weekday_indexes(columns):
+    """
+    Computes WeekdayIndex of every user of {user_id: (dates, starts, ends)}.
+
+    With NumPy installed, int32 columns of all users are joined and every
+    per-user, per-weekday sum is computed by one bincount call; otherwise
+    WeekdayIndex is built for each user in turn.
+    """
+    if numpy is None or not columns:
+        return {
+            user_id: WeekdayIndex(*user_columns)
+            for user_id, user_columns in columns.items()
+        }
+
+    user_ids = list(columns)
+    dates, starts, ends = joined_columns(columns, user_ids)
+    lengths = [len(columns[user_id][0]) for user_id in user_ids]
+    # one bin for every weekday of every user
+    bins = numpy.repeat(numpy.arange(len(user_ids)) * 7, lengths)
+    bins += (dates - 1) % 7
+    size = len(user_ids) * 7
+
+    def sums(weights=None):
+        """
+        Returns per-user lists of per-weekday sums of weights.
+        """
+        result = numpy.bincount(bins, weights, minlength=size)
+        return result.astype(numpy.int64).reshape(-1, 7).tolist()
+
+    totals = zip(
+        sums(), sums(ends - starts), sums(starts), sums(ends)
+    )
+    result = {}
+    for user_id, (counts, intervals, user_starts, user_ends) in zip(
+            user_ids, totals
+    ):
+        weekdays = result[user_id] = WeekdayIndex()
+        weekdays.counts = counts
+        weekdays.intervals = intervals
+        weekdays.starts = user_starts
+        weekdays.ends = user_ends
+    return result
+
+
+def update_sketches(sketches, columns):
+    """
+    Adds entries of {user_id: (dates, starts, ends)} to WeekdaySketches or
+    WeekdayValues.
+
+    Entries are grouped by weekday first, so every sketch gets all its
+    values at once. With NumPy the values are also sorted, which makes
+    sorting blocks of them in the sketches take linear time.
+    """
+    if numpy is not None:
+        dates, starts, ends = joined_columns(columns, list(columns))
+        weekdays = (dates - 1) % 7
+        for weekday in range(7):
+            present = weekdays == weekday
+            weekday_starts, weekday_ends = starts[present], ends[present]
+            sketches.extend(weekday, *[
+                numpy.sort(values).tolist() for values in (
+                    weekday_ends - weekday_starts, weekday_starts,
+                    weekday_ends,
+                )
+            ])
+        return sketches
+
+    grouped = [([], [], []) for _ in range(7)]
+    for dates, starts, ends in columns.values():
+        for ordinal, start, end in zip(dates, starts, ends):
+            presence, weekday_starts, weekday_ends = grouped[(ordinal - 1) % 7]
+            presence.append(end - start)
+            weekday_starts.append(start)
+            weekday_ends.append(end)
+    for weekday, values in enumerate(grouped):
+        sketches.extend(weekday, *values)
+    return sketches
+
+
+def slot_occupancy(data, first=None, last=None, slot_seconds=900):
+    """
+    Counts presence entries overlapping every time slot of every weekday.
+
+    Only dates between first and last ordinal are included. Every entry
+    adds one at its first slot and subtracts one after its last slot in a
+    difference array of its weekday, and a running sum over the slots
+    turns the differences into counts, so the work is O(entries + slots).
+    Returns (number of distinct dates of every weekday, 7 lists of counts
+    per slot).
+    """
+    slots = -(-DAY_SECONDS // slot_seconds)
+    width = slots + 1
+    spans = [(user, user.span(first, last)) for user in data.values()]
+
+    if numpy is not None:
+        dates, starts, ends = [
+            numpy.concatenate([numpy.zeros(0, numpy.intc)] + [
+                int_array(getattr(user, name))[low:high]
+                for user, (low, high) in spans
+            ]).astype(numpy.int64)
+            for name in ('dates', 'starts', 'ends')
+        ]
+        present = ends > starts
+        bins = (dates[present] - 1) % 7 * width
+        diff = numpy.bincount(
+            bins + starts[present] // slot_seconds, minlength=7 * width
+        ) - numpy.bincount(
+            bins + (ends[present] - 1) // slot_seconds + 1,
+            minlength=7 * width,
+        )
+        counts = numpy.cumsum(diff.reshape(7, width), axis=1)[:, :slots]
+        days = numpy.bincount((numpy.unique(dates) - 1) % 7, minlength=7)
+        return days.tolist(), counts.tolist()
+
+    diff = [[0] * width for _ in range(7)]
+    dates = set()
+    for user, (low, high) in spans:
+        user_dates, starts, ends = user.dates, user.starts, user.ends
+        for index in range(low, high):
+            ordinal, start, end = user_dates[index], starts[index], ends[index]
+            dates.add(ordinal)
+            if end <= start:
+                continue
+            weekday_diff = diff[(ordinal - 1) % 7]
+            weekday_diff[start // slot_seconds] += 1
+            weekday_diff[(end - 1) // slot_seconds + 1] -= 1
+
+    counts = []
+    for weekday_diff in diff:
+        count = 0
+        weekday_counts = []
+        for change in weekday_diff[:slots]:
+            count += change
+            weekday_counts.append(count)
+        counts.append(weekday_counts)
+    days = [0] * 7
+    for ordinal in dates:
+        days[(ordinal - 1) % 7] += 1
+    return days, counts
+
+
+def date_intervals(data, ordinal):
+    """
+    Creates IntervalIndex of entries of all users on given date ordinal.
+
+    Every user's entry is found by binary search over their dates.
+    """
+    user_ids, starts, ends = [], [], []
+    for user_id, user in data.items():
+        low, high = user.span(ordinal, ordinal)
+        for index in range(low, high):
+            user_ids.append(user_id)
+            starts.append(user.starts[index])
+            ends.append(user.ends[index])
+    return IntervalIndex(user_ids, starts, ends)
+
+
+def concat(column, other):
+    """
+    Returns new int32 array with items of both columns.
+
+    First column can be any sequence of ints, e.g. a memory mapped view.
+    """
+    return array('i', column) + other
+
+
+def group_columns(rows):
+    """
+    Groups (user_id, date ordinal, start, end) rows into per-user columns.
+    """
+    columns = {}
+    for user_id, ordinal, start, end in rows:
+        try:
+            dates, starts, ends = columns[user_id]
+        except KeyError:
+            dates, starts, ends = columns[user_id] = (
+                array('i'), array('i'), array('i')
+            )
+        dates.append(ordinal)
+        starts.append(start)
+        ends.append(end)
+    return columns
+
+
+def extend_columns(columns, other):
+    """
+    Appends per-user columns of other to columns, in place.
+    """
+    for user_id, other_columns in other.items():
+        try:
+            user_columns = columns[user_id]
+        except KeyError:
+            columns[user_id] = other_columns
+            continue
+        for column, other_column in zip(user_columns, other_columns):
+            column.extend(other_column)
+    return columns
+
+
+def store_from_columns(columns):
+    """
+    Creates PresenceStore from per-user columns in row order.
+
+    Weekday totals of all users are computed at once by weekday_indexes()
+    and quantile sketches of all entries by update_sketches().
+    """
+    columns = {
+        user_id: unique_columns(*user_columns)
+        for user_id, user_columns in columns.items()
+    }
+    weekdays = weekday_indexes(columns)
+    return PresenceStore({
+        user_id: UserPresence(dates, starts, ends, weekdays[user_id])
+        for user_id, (dates, starts, ends) in columns.items()
+    }, sketches=update_sketches(WeekdaySketches(), columns))
+
+
+def build_store(rows):
+    """
+    Creates PresenceStore from (user_id, date ordinal, start, end) rows.
+    """
+    return store_from_columns(group_columns(rows))
+
+
+def merge_store(data, rows):
+    """
+    Creates PresenceStore with rows added to existing store.
+
+    Existing store is left untouched and users without new rows are
+    shared with it. New rows override entries for the same dates.
+    When rows only add dates after the existing ones, copy of existing
+    WeekdaySketches is updated with them; otherwise sketches are built
+    again on first use.
+    """
+    users = dict(data.items())
+    added = {}
+    appended = True
+    for user_id, (dates, starts, ends) in group_columns(rows).items():
+        old = users.get(user_id)
+        if old is None:
+            user = users[user_id] = build_user_presence(dates, starts, ends)
+            added[user_id] = (user.dates, user.starts, user.ends)
+        elif is_increasing(dates) and (
+                not old.dates or old.dates[-1] < dates[0]
+        ):
+            users[user_id] = UserPresence(
+                concat(old.dates, dates),
+                concat(old.starts, starts),
+                concat(old.ends, ends),
+                old.weekdays + WeekdayIndex(dates, starts, ends),
+            )
+            added[user_id] = (dates, starts, ends)
+        else:
+            users[user_id] = build_user_presence(
+                concat(old.dates, dates),
+                concat(old.starts, starts),
+                concat(old.ends, ends),
+            )
+            appended = False
+
+    sketches = getattr(data, '_sketches', None)
+    if sketches is not None and appended:
+        sketches = update_sketches(sketches.copy(), added)
+    else:
+        sketches = None
+    return PresenceStore(users, sketches=sketches)
+
+
+def join_stores(stores):
+    """
+    Creates PresenceStore of entries of stores of consecutive date ranges.
+
+    Columns of every user are concatenated in order of stores and sorted
+    again only if the ranges overlap. Weekday totals are added up, so are
+    quantile sketches if all stores have them.
+    """
+    parts = {}
+    for data in stores:
+        for user_id, user in data.items():
+            parts.setdefault(user_id, []).append(user)
+
+    users = {}
+    for user_id, user_parts in parts.items():
+        if len(user_parts) == 1:
+            users[user_id] = user_parts[0]
+            continue
+        columns = array('i'), array('i'), array('i')
+        for user in user_parts:
+            for column, user_column in zip(
+                    columns, (user.dates, user.starts, user.ends)
+            ):
+                column.extend(array('i', user_column))
+        if all(
+                len(previous) and len(user) and
+                previous.dates[-1] < user.dates[0]
+                for previous, user in zip(user_parts, user_parts[1:])
+        ):
+            weekdays = user_parts[0].weekdays
+            for user in user_parts[1:]:
+                weekdays = weekdays + user.weekdays
+            users[user_id] = UserPresence(*columns, weekdays=weekdays)
+        else:
+            users[user_id] = build_user_presence(*columns)
+
+    sketches = None
+    # pylint: disable=protected-access
+    if all(data._sketches is not None for data in stores):
+        sketches = WeekdaySketches()
+        for data in stores:
+            sketches.merge(data._sketches)
+    return PresenceStore(users, sketches=sketches)
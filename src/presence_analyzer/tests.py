@@ -5,11 +5,28 @@ Presence analyzer unit tests.
 import os.path
 import json
 import datetime
+import importlib
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
 
+from flask import request
 from mock import patch, MagicMock
 
-from presence_analyzer import main, utils, views
+try:
+    import asyncio
+except ImportError:  # Python 2, asyncio serving tests are skipped
+    asyncio = None
+
+from presence_analyzer import (
+    benchmark, dataplane, main, metrics, partitions, sketch, snapshot, store,
+    utils, views
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -202,6 +219,110 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         for _ in result:
             self.assertIn(_, data)
 
+    def test_api_bulk_presence_weekday(self):
+        """
+        Test weekday statistics of many users.
+        """
+        resp = self.client.get('/api/v1/bulk/presence_weekday?ids=11,10,1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['weekdays'][0], 'Mon')
+        self.assertItemsEqual(data['users'].keys(), ['10', '11'])
+        self.assertEqual(data['missing'], [1])
+        self.assertEqual(
+            data['users']['10']['presence'],
+            [0, 30047, 24465, 23705, 0, 0, 0]
+        )
+        self.assertEqual(data['users']['10']['mean'][1], 30047)
+        self.assertEqual(data['users']['11']['start_end'][0], [33134, 57257])
+
+        resp = self.client.get('/api/v1/bulk/presence_weekday')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data['users'].keys(), ['10', '11'])
+
+    @patch('presence_analyzer.views.log')
+    def test_api_bulk_presence_weekday_wrong_ids(self, mock_log):
+        """
+        Test weekday statistics for malformed ids.
+        """
+        resp = self.client.get('/api/v1/bulk/presence_weekday?ids=1,x')
+        self.assertTrue(mock_log.debug.called)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_date_range(self):
+        """
+        Test per-user endpoints limited to from / to dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_days/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(json.loads(resp.data), [['2013-09-11', 407]])
+
+        resp = self.client.get('/api/v1/presence_weekday/10?from=2013-09-11')
+        self.assertEqual(
+            json.loads(resp.data)[1:],
+            [
+                ['Mon', 0],
+                ['Tue', 0],
+                ['Wed', 24465],
+                ['Thu', 23705],
+                ['Fri', 0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ]
+        )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?to=2013-09-10')
+        self.assertEqual(json.loads(resp.data)[1], ['Tue', 30047])
+        self.assertEqual(json.loads(resp.data)[2], ['Wed', 0])
+
+        resp = self.client.get(
+            '/api/v1/presence_start_end/11?from=2013-09-12&to=2013-09-13'
+        )
+        self.assertEqual(
+            json.loads(resp.data),
+            [['Thu', 37116, 60085], ['Fri', 47816, 54242]]
+        )
+
+    @patch('presence_analyzer.views.log')
+    def test_api_wrong_date_range(self, mock_log):
+        """
+        Test per-user endpoints with malformed dates.
+        """
+        for url in (
+                '/api/v1/presence_days/10?from=2013-9-11',
+                '/api/v1/presence_weekday/10?to=yesterday',
+                '/api/v1/mean_time_weekday/10?from=2013-02-30',
+                '/api/v1/presence_start_end/11?to=2013',
+                '/api/v1/bulk/presence_weekday?from=2013',
+        ):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 400)
+        self.assertEqual(mock_log.debug.call_count, 5)
+
+    def test_api_etag(self):
+        """
+        Test API responses carry ETag and honour If-None-Match.
+        """
+        resp = self.client.get('/api/v1/presence_days/10')
+        etag = resp.headers['ETag']
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+        resp = self.client.get(
+            '/api/v1/presence_days/10',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        resp = self.client.get(
+            '/api/v1/presence_days/11',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
     @patch('presence_analyzer.views.log')
     def test_api_days_of_presence_wrong_data(self, mock_log):
         """
@@ -211,6 +332,254 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         mock_log.debug.assert_called_with('User %s not found!', 1)
         self.assertEqual(resp.status_code, 404)
 
+    def test_instrumentation(self):
+        """
+        Test stage timings and metrics endpoint.
+        """
+        resp = self.client.get('/api/v1/presence_days/11')
+        self.assertNotIn('Server-Timing', resp.headers)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        main.app.config.update({'INSTRUMENTATION': True})
+        try:
+            resp = self.client.get('/api/v1/presence_days/11?from=2013-09-01')
+            stages = [
+                item.split(';')[0]
+                for item in resp.headers['Server-Timing'].split(', ')
+            ]
+            self.assertEqual(stages[-3:], ['aggregate', 'serialize', 'cache'])
+
+            resp = self.client.get('/api/v1/presence_days/11?from=2013-09-01')
+            self.assertEqual(resp.headers['Server-Timing'][:6], 'cache;')
+
+            resp = self.client.get('/metrics')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/plain')
+            text = resp.get_data(as_text=True)
+        finally:
+            main.app.config.update({'INSTRUMENTATION': False})
+
+        self.assertIn(
+            'presence_analyzer_stage_seconds_count{endpoint='
+            '"presence_days_view",stage="serialize"} ',
+            text,
+        )
+        self.assertIn(
+            'presence_analyzer_stage_seconds_bucket{endpoint='
+            '"presence_days_view",stage="cache",le="+Inf"} ',
+            text,
+        )
+        self.assertIn(
+            'presence_analyzer_cache_lock_wait_seconds_count'
+            '{cache="get_data"} ',
+            text,
+        )
+        self.assertIn(
+            'presence_analyzer_cache_hits_total{cache="get_data"}', text
+        )
+        self.assertIn('# TYPE presence_analyzer_cache_entries gauge', text)
+
+    def test_api_occupancy_heatmap(self):
+        """
+        Test mean occupancy of 15 minute slots by weekday.
+        """
+        resp = self.client.get('/api/v1/occupancy_heatmap')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['weekdays'][1], 'Tue')
+        self.assertEqual(len(data['slots']), 96)
+        self.assertEqual(data['slots'][37], '09:15')
+        self.assertEqual(data['days'], [1, 1, 1, 2, 1, 0, 0])
+        # Tuesday: user 11 from 09:19:50, user 10 from 09:39:05
+        self.assertEqual(data['occupancy'][1][36:39], [0, 1, 2])
+        # Thursday: user 11 from 09:28:08 on 2013-09-05, both users from
+        # 10:48:46 on 2013-09-12
+        self.assertEqual(data['occupancy'][3][36:38], [0, 0.5])
+        self.assertEqual(data['occupancy'][3][43], 1.5)
+        self.assertEqual(data['occupancy'][5], [0] * 96)
+
+        resp = self.client.get(
+            '/api/v1/occupancy_heatmap?from=2013-09-06&to=2013-09-12'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data['days'], [1, 1, 1, 1, 0, 0, 0])
+        self.assertEqual(data['occupancy'][3][36:38], [0, 0])
+        self.assertEqual(data['occupancy'][3][43], 2)
+
+    @patch('presence_analyzer.views.log')
+    def test_api_occupancy_heatmap_wrong_range(self, mock_log):
+        """
+        Test occupancy heatmap with malformed dates.
+        """
+        resp = self.client.get('/api/v1/occupancy_heatmap?to=2013-9-1')
+        self.assertTrue(mock_log.debug.called)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_presence_quantiles(self):
+        """
+        Test quantiles of all users and of one user.
+        """
+        resp = self.client.get('/api/v1/presence_quantiles')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['quantiles'], [0.5, 0.9, 0.99])
+        self.assertEqual(data['weekdays'][1], 'Tue')
+        self.assertEqual(data['days'], [1, 2, 2, 3, 1, 0, 0])
+        self.assertEqual(data['presence'][1], [16564, 30047, 30047])
+        self.assertEqual(data['start'][1], [33590, 34745, 34745])
+        self.assertEqual(data['end'][5], [0, 0, 0])
+
+        resp = self.client.get('/api/v1/presence_quantiles/11?q=0,1')
+        data = json.loads(resp.data)
+        self.assertEqual(data['quantiles'], [0, 1])
+        self.assertEqual(data['days'], [1, 1, 1, 2, 1, 0, 0])
+        self.assertEqual(data['presence'][0], [24123, 24123])
+        self.assertEqual(data['start'][3], [34088, 37116])
+
+        resp = self.client.get(
+            '/api/v1/presence_quantiles/11?q=1&from=2013-09-10&to=2013-09-12'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data['days'], [0, 1, 1, 1, 0, 0, 0])
+
+    @patch('presence_analyzer.views.log')
+    def test_api_presence_quantiles_wrong_data(self, mock_log):
+        """
+        Test quantiles of unknown user and malformed fractions.
+        """
+        resp = self.client.get('/api/v1/presence_quantiles/1')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/presence_quantiles?q=0.5,2')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_quantiles/10?q=median')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_quantiles/10?from=2013')
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue(mock_log.debug.called)
+
+    def test_api_top(self):
+        """
+        Test users leading in presence metrics.
+        """
+        resp = self.client.get('/api/v1/top')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['metric'], 'presence')
+        self.assertEqual(data['users'], [
+            {'user_id': 11, 'name': None, 'value': 118402},
+            {'user_id': 10, 'name': None, 'value': 78217},
+        ])
+
+        resp = self.client.get('/api/v1/top?metric=mean_presence&n=1')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['users']), 1)
+        self.assertEqual(data['users'][0]['user_id'], 10)
+        self.assertAlmostEqual(data['users'][0]['value'], 26072.33, 2)
+
+        for query, expected in (
+                ('metric=arrival', [10, 11]),
+                ('metric=arrival&order=desc', [11, 10]),
+                ('metric=departure&order=asc', [11, 10]),
+                ('from=2013-09-13', [11]),
+                ('from=2013-09-14', []),
+        ):
+            resp = self.client.get('/api/v1/top?' + query)
+            self.assertEqual(
+                [user['user_id'] for user in json.loads(resp.data)['users']],
+                expected,
+            )
+
+    @patch('presence_analyzer.views.log')
+    def test_api_top_wrong_query(self, mock_log):
+        """
+        Test top users with malformed queries.
+        """
+        for query in (
+                'metric=salary', 'n=0', 'n=ten', 'order=up', 'to=2013-9-1'
+        ):
+            resp = self.client.get('/api/v1/top?' + query)
+            self.assertEqual(resp.status_code, 400)
+        self.assertTrue(mock_log.debug.called)
+
+    def test_api_present_at(self):
+        """
+        Test users present at given time and during given window.
+        """
+        users = utils.UserDirectory({11: {'name': 'Jan N.', 'avatar': ''}})
+        with patch('presence_analyzer.views.get_xml_users') as xml_users:
+            xml_users.return_value = users
+            resp = self.client.get(
+                '/api/v1/present_at?ts=2013-09-10T09:30:00'
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data), [{
+                'user_id': 11,
+                'name': 'Jan N.',
+                'date': '2013-09-10',
+                'start': '09:19:50',
+                'end': '13:55:54',
+            }])
+
+            resp = self.client.get(
+                '/api/v1/present_at?ts=2013-09-10 17:00:00'
+                '&until=2013-09-11T09:15:00'
+            )
+            data = json.loads(resp.data)
+            self.assertEqual(
+                [(entry['user_id'], entry['date']) for entry in data],
+                [(10, '2013-09-10'), (11, '2013-09-11')],
+            )
+            self.assertIsNone(data[0]['name'])
+
+            resp = self.client.get(
+                '/api/v1/present_at?ts=2013-09-14T12:00:00'
+            )
+            self.assertEqual(json.loads(resp.data), [])
+
+    @patch('presence_analyzer.views.log')
+    def test_api_present_at_wrong_query(self, mock_log):
+        """
+        Test present_at with malformed timestamps and windows.
+        """
+        for query in (
+                '',
+                '?ts=2013-09-10',
+                '?ts=2013-09-10T25:00:00',
+                '?ts=2013-09-10T10:00:00&until=2013-09-10T10:00:00',
+                '?ts=2013-09-10T10:00:00&until=2013-12-10T10:00:00',
+        ):
+            resp = self.client.get('/api/v1/present_at' + query)
+            self.assertEqual(resp.status_code, 400)
+        self.assertTrue(mock_log.debug.called)
+
+    def test_readiness(self):
+        """
+        Test readiness endpoint reports finished warm-up.
+        """
+        with patch('presence_analyzer.views.readiness') as readiness:
+            readiness.is_set.return_value = False
+            resp = self.client.get('/health/ready')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(json.loads(resp.data), {'ready': False})
+
+            readiness.is_set.return_value = True
+            resp = self.client.get('/health/ready')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data), {'ready': True})
+
+    @patch('presence_analyzer.views.retry_warm_up')
+    def test_readiness_retry(self, retry_warm_up):
+        """
+        Test readiness check retries warm-up while not ready.
+        """
+        with patch('presence_analyzer.views.readiness') as readiness:
+            readiness.is_set.return_value = True
+            self.client.get('/health/ready')
+            self.assertFalse(retry_warm_up.called)
+            readiness.is_set.return_value = False
+            self.client.get('/health/ready')
+            self.assertTrue(retry_warm_up.called)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -236,7 +605,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -258,6 +627,220 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         utils.get_data()
         self.assertTrue(mock_log.debug.called)
 
+    @patch.dict(
+        'presence_analyzer.main.app.config',
+        {'DATA_CSV': MALF_DATA_CSV}
+    )
+    @patch('presence_analyzer.utils.log')
+    def test_malformed_lines_skipped(self, mock_log):
+        """
+        Test get_data() keeps only well formed lines.
+        """
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [43])
+        self.assertEqual(len(data[43]), 1)
+        problems = [
+            call for call in mock_log.debug.call_args_list
+            if call[0][0].startswith('Problem with line')
+        ]
+        self.assertEqual([call[0][1] for call in problems], [1, 2, 3])
+
+    def test_read_presence_rows(self):
+        """
+        Test fast and strict paths of CSV rows parsing.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-11,9:19:52,16:07:37\n',
+            '"11",2013-09-10,09:39:05,00:00:00\n',
+            '11,2013-09-11,24:00:00,16:07:37\n',
+            '11,2013-02-30,09:00:00,16:07:37\n',
+            '\n',
+        ]
+        ordinal = datetime.date(2013, 9, 10).toordinal()
+        with patch('presence_analyzer.utils.log') as mock_log:
+            rows = list(utils.read_presence_rows(lines))
+            self.assertEqual(mock_log.debug.call_count, 3)
+        self.assertEqual(
+            rows,
+            [
+                (10, ordinal, 34745, 64792),
+                (10, ordinal + 1, 33592, 58057),
+                (11, ordinal, 34745, 0),
+            ]
+        )
+
+    def test_group_by_user(self):
+        """
+        Test streaming rows into per-user accumulators.
+        """
+        rows = [(10, 1, 0, 10), (11, 2, 5, 10), (10, 8, 20, 50)]
+        totals = utils.group_by_user(iter(rows), store.WeekdayIndex)
+        self.assertItemsEqual(totals.keys(), [10, 11])
+        self.assertEqual(totals[10].counts, [2, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(totals[10].intervals, [40, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(totals[11].ends, [0, 10, 0, 0, 0, 0, 0])
+
+    def test_load_weekday_totals(self):
+        """
+        Test aggregate-only loading matches weekday index of get_data().
+        """
+        totals = utils.load_weekday_totals(TEST_DATA_CSV)
+        data = utils.get_data()
+        self.assertItemsEqual(totals.keys(), data.keys())
+        for user_id in data:
+            self.assertEqual(
+                vars(totals[user_id]), vars(data[user_id].weekdays)
+            )
+
+    def test_histogram(self):
+        """
+        Test histogram buckets and disabled instrumentation hooks.
+        """
+        histogram = metrics.Histogram()
+        for value in (0.00005, 0.002, 0.002, 20):
+            histogram.observe(value)
+        samples = dict(histogram.samples())
+        self.assertEqual(samples['0.0001'], 1)
+        self.assertEqual(samples['0.001'], 1)
+        self.assertEqual(samples['0.0025'], 3)
+        self.assertEqual(samples['10.0'], 3)
+        self.assertEqual(samples['+Inf'], 4)
+        self.assertAlmostEqual(histogram.sum, 20.00405)
+
+        lock = MagicMock()
+        self.assertIs(metrics.timed_lock(lock, 'test'), lock)
+        self.assertIs(metrics.stage('load'), metrics.NO_STAGE)
+
+    def test_warm_up(self):
+        """
+        Test warm-up loads data and sets readiness.
+        """
+        self.assertFalse(utils.readiness.is_set())
+        utils.warm_up()
+        self.assertTrue(utils.readiness.is_set())
+        self.assertEqual(utils.get_data.stats['misses'], 1)
+        self.assertEqual(utils.get_xml_users.stats['misses'], 1)
+        utils.get_data()
+        self.assertEqual(utils.get_data.stats['hits'], 1)
+
+    def test_retry_warm_up(self):
+        """
+        Test failed warm-up is retried until data can be loaded.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'data.csv')
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            with patch('presence_analyzer.utils.log') as mock_log:
+                utils.retry_warm_up()
+                utils.warm_up_thread.join()
+                self.assertTrue(mock_log.exception.called)
+            self.assertFalse(utils.readiness.is_set())
+
+            shutil.copy(TEST_DATA_CSV, path)
+            utils.retry_warm_up()
+            utils.warm_up_thread.join()
+            self.assertTrue(utils.readiness.is_set())
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+
+            thread = utils.warm_up_thread
+            utils.retry_warm_up()
+            self.assertIs(utils.warm_up_thread, thread)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_configure(self):
+        """
+        Test production configuration from file and environment.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            settings = os.path.join(directory, 'settings.py')
+            with open(settings, 'w') as settings_file:
+                settings_file.write(
+                    "DATA_XML = 'users.xml'\nDATA_PLANE = 'x'\n"
+                )
+            config = main.app.config.__class__(directory, main.app.config)
+            main.configure(config, {
+                'PRESENCE_ANALYZER_SETTINGS': settings,
+                'PRESENCE_ANALYZER_DATA_CSV': 'data.csv',
+                'PRESENCE_ANALYZER_DATA_SNAPSHOT': 'yes',
+                'PRESENCE_ANALYZER_INGEST_WORKERS': '4',
+                'PRESENCE_ANALYZER_DATA_PLANE': '',
+            })
+        finally:
+            shutil.rmtree(directory)
+        self.assertFalse(config['DEBUG'])
+        self.assertEqual(config['DATA_CSV'], 'data.csv')
+        self.assertEqual(config['DATA_XML'], 'users.xml')
+        self.assertIs(config['DATA_SNAPSHOT'], True)
+        self.assertEqual(config['INGEST_WORKERS'], 4)
+        self.assertEqual(config['DATA_PLANE'], '')
+        self.assertEqual(main.parse_env_value('', None), None)
+        self.assertTrue(main.app.config['DEBUG'])
+
+    def test_parse_seconds(self):
+        """
+        Test parse_seconds() function.
+        """
+        self.assertEqual(0, utils.parse_seconds('00:00:00'))
+        self.assertEqual(86399, utils.parse_seconds('23:59:59'))
+        for text in ('9:00:00', '09:00', '24:00:00', '09:60:00', '+9:00:00'):
+            with self.assertRaises(ValueError):
+                utils.parse_seconds(text)
+
+    def test_top_users(self):
+        """
+        Test selecting leaders with ties broken by user id.
+        """
+        monday = datetime.date(2019, 3, 4).toordinal()
+        data = store.build_store([
+            (user_id, monday + day, 28800, 28800 + 3600 * (user_id % 3))
+            for user_id in range(1, 10)
+            for day in range(user_id % 2 + 1)
+        ])
+        weekdays = store.RangeWeekdays([(data, None, None)])
+        self.assertEqual(
+            utils.top_users(weekdays, 'presence', 3),
+            [(5, 14400), (1, 7200), (2, 7200)],
+        )
+        self.assertEqual(
+            utils.top_users(weekdays, 'mean_presence', 2, largest=False),
+            [(3, 0.0), (6, 0.0)],
+        )
+        self.assertEqual(
+            utils.top_users(
+                store.RangeWeekdays([(data, monday + 1, None)]),
+                'presence', 9,
+            ),
+            [(5, 7200), (1, 3600), (7, 3600), (3, 0), (9, 0)],
+        )
+
+    def test_parse_date_range(self):
+        """
+        Test parse_date_range() function.
+        """
+        self.assertEqual(utils.parse_date_range({}), (None, None))
+        self.assertEqual(
+            utils.parse_date_range({'from': '2013-09-10', 'to': ''}),
+            (datetime.date(2013, 9, 10).toordinal(), None)
+        )
+        self.assertRaises(ValueError, utils.parse_date_range, {'to': '2013'})
+
+    def test_parse_date_ordinal(self):
+        """
+        Test parse_date_ordinal() function.
+        """
+        self.assertEqual(
+            datetime.date(2013, 9, 10).toordinal(),
+            utils.parse_date_ordinal('2013-09-10')
+        )
+        for text in ('20130910', '2013-9-10', '2013-13-10', '2013-02-30'):
+            with self.assertRaises(ValueError):
+                utils.parse_date_ordinal(text)
+
     def test_get_xml_users(self):
         """
         Test parsing of xml file.
@@ -275,6 +858,20 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_get_xml_users_cached(self):
+        """
+        Test users file is parsed once and served with its version.
+        """
+        data = utils.get_xml_users()
+        self.assertIsInstance(data, utils.UserDirectory)
+        self.assertTrue(data.version)
+        self.assertIs(utils.get_xml_users(), data)
+        self.assertEqual(utils.users_version(), data.version)
+
+        utils.get_xml_users.invalidate()
+        self.assertIsNot(utils.get_xml_users(), data)
+        self.assertEqual(utils.get_xml_users(), data)
+
     def test_mean(self):
         """
         Test mean() function.
@@ -404,33 +1001,1454 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             wrapped(1)
             self.assertEqual(moc.call_count, 3)
 
-    def test_time_spent_by_day(self):
+    def test_cache_kwargs(self):
         """
-        Test result of time_spent_by_day().
+        Test keyword arguments are part of cache key.
         """
-        fake_data = {
-            datetime.date(2019, 3, 4): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2019, 3, 5): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-            datetime.date(2019, 3, 11): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
-        result_data = utils.time_spent_by_day(fake_data)
+        moc = MagicMock(side_effect=lambda user_id, weekday=None: weekday)
+        wrapped = utils.cache()(
+            lambda *args, **kwargs: moc(*args, **kwargs)
+        )
 
-        result = [
-            ['2019-03-04', 510],
-            ['2019-03-05', 495],
-            ['2019-03-11', 495]
-        ]
-        for _ in result:
-            self.assertIn(_, result_data)
+        self.assertEqual(wrapped(1, weekday=2), 2)
+        self.assertEqual(wrapped(1, weekday=3), 3)
+        self.assertEqual(wrapped(1, weekday=2), 2)
+        self.assertEqual(moc.call_count, 2)
+
+    def test_cache_lru(self):
+        """
+        Test least recently used results are evicted first.
+        """
+        moc = MagicMock(side_effect=lambda value: value)
+        wrapped = utils.cache(max_entries=2)(lambda value: moc(value))
+
+        wrapped(1)
+        wrapped(2)
+        wrapped(1)
+        wrapped(3)
+        self.assertEqual(moc.call_count, 3)
+        self.assertEqual(wrapped.stats['evictions'], 1)
+        self.assertEqual(wrapped.stats['entries'], 2)
+
+        wrapped(1)
+        self.assertEqual(moc.call_count, 3)
+        wrapped(2)
+        self.assertEqual(moc.call_count, 4)
+
+    def test_cache_max_bytes(self):
+        """
+        Test cache keeps results within approximate size limit.
+        """
+        moc = MagicMock(side_effect=lambda value: 'x' * value)
+        wrapped = utils.cache(max_bytes=10, sizeof=len)(
+            lambda value: moc(value)
+        )
+
+        wrapped(4)
+        wrapped(5)
+        self.assertEqual(wrapped.stats['bytes'], 9)
+        wrapped(6)
+        self.assertEqual(wrapped.stats['bytes'], 6)
+        self.assertEqual(wrapped.stats['evictions'], 2)
+
+        wrapped(11)
+        wrapped(11)
+        self.assertEqual(wrapped.stats['bytes'], 6)
+        self.assertEqual(moc.call_count, 5)
+
+    def test_cache_forget_and_resize(self):
+        """
+        Test dropping one result and measuring a grown result again.
+        """
+        wrapped = utils.cache(max_bytes=10, sizeof=len)(
+            lambda value: ['x'] * value
+        )
+        first = wrapped(2)
+        wrapped(3)
+        first.extend(['x'] * 3)
+        wrapped.resize(2)
+        self.assertEqual(wrapped.stats['bytes'], 8)
+        first.extend(['x'] * 3)
+        wrapped.resize(2)
+        self.assertEqual(wrapped.stats['bytes'], 3)
+        self.assertEqual(wrapped.stats['evictions'], 1)
+        wrapped.resize(2)
+
+        wrapped.forget(3)
+        wrapped.forget(4)
+        self.assertEqual(wrapped.stats['entries'], 0)
+        self.assertEqual(wrapped.stats['bytes'], 0)
+
+    def test_cache_purge_expired(self):
+        """
+        Test expired results are removed when new result is loaded.
+        """
+        wrapped = utils.cache(10)(lambda value: value)
+        wrapped(1)
+        wrapped(2)
+        with patch('presence_analyzer.utils.datetime') as dt:
+            now = datetime.datetime.now()
+            dt.now.return_value = now + datetime.timedelta(seconds=60)
+            wrapped(3)
+        self.assertEqual(wrapped.stats['entries'], 1)
+
+    def test_cached_jsonify(self):
+        """
+        Test serialized responses are reused until data version changes.
+        """
+        moc = MagicMock(return_value=['x'] * 10)
+        version = ['1']
+        view = utils.cached_jsonify(lambda: version[0], gzip_min_size=0)(
+            lambda: moc()
+        )
+        with main.app.test_request_context('/x'):
+            first = view()
+            self.assertEqual(json.loads(first.get_data()), ['x'] * 10)
+            self.assertEqual(first.mimetype, 'application/json')
+            view()
+            self.assertEqual(moc.call_count, 1)
+
+            version[0] = '2'
+            second = view()
+            self.assertEqual(moc.call_count, 2)
+            self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+        with main.app.test_request_context(
+                '/x', headers={'Accept-Encoding': 'gzip'}
+        ):
+            resp = view()
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                json.loads(zlib.decompress(resp.get_data(), 31)),
+                ['x'] * 10
+            )
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            etag = resp.headers['ETag']
+
+        with main.app.test_request_context(
+                '/x', headers={'If-None-Match': etag}
+        ):
+            resp = view()
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(moc.call_count, 2)
+
+    def test_cached_jsonify_query_args(self):
+        """
+        Test responses are cached per query arguments read by view.
+        """
+        moc = MagicMock(return_value=['x'] * 10)
+        view = utils.cached_jsonify(lambda: '1', ('from',))(lambda: moc())
+        for path in ('/x?from=1', '/x?from=1&junk=1', '/x?junk=2&from=1'):
+            with main.app.test_request_context(path):
+                view()
+        self.assertEqual(moc.call_count, 1)
+
+        with main.app.test_request_context('/x?from=2'):
+            view()
+        self.assertEqual(moc.call_count, 2)
+        self.assertEqual(view.query_args, ('from',))
+
+    def test_cached_jsonify_max_bytes(self):
+        """
+        Test cached responses and their compressed bodies are bounded.
+        """
+        moc = MagicMock(side_effect=lambda: [request.args['n']] * 100)
+        view = utils.cached_jsonify(
+            lambda: '1', ('n',), max_bytes=1000, gzip_min_size=0,
+        )(lambda: moc())
+        for number in (1, 2, 1):
+            with main.app.test_request_context(
+                    '/x?n={}'.format(number),
+                    headers={'Accept-Encoding': 'gzip'},
+            ):
+                view()
+        self.assertEqual(moc.call_count, 3)
+
+        cached = utils.CachedJSON(b'x' * 100)
+        self.assertEqual(
+            cached.__sizeof__(), object.__sizeof__(cached) + 100
+        )
+        gzipped = cached.gzipped
+        self.assertEqual(
+            cached.__sizeof__(),
+            object.__sizeof__(cached) + 100 + len(gzipped),
+        )
+
+    def test_cache_validator(self):
+        """
+        Test cache reloads data when validator result changes.
+        """
+        moc = MagicMock()
+        token = ['a']
+        wrapped = utils.cache(validator=lambda: token[0])(lambda: moc())
+
+        wrapped()
+        wrapped()
+        self.assertEqual(moc.call_count, 1)
+
+        token[0] = 'b'
+        wrapped()
+        self.assertEqual(moc.call_count, 2)
+
+        wrapped.invalidate()
+        wrapped()
+        self.assertEqual(moc.call_count, 3)
+
+    @patch('presence_analyzer.utils.threading.Thread')
+    def test_cache_stale_while_revalidate(self, thread):
+        """
+        Test expired result is served while one thread loads new one.
+        """
+        results = iter(['old', 'new'])
+        token = ['a']
+        wrapped = utils.cache(
+            validator=lambda: token[0],
+            stale_while_revalidate=True,
+        )(lambda: next(results))
+
+        self.assertEqual(wrapped(), 'old')
+        self.assertFalse(thread.called)
+
+        token[0] = 'b'
+        self.assertEqual(wrapped(), 'old')
+        self.assertEqual(wrapped(), 'old')
+        self.assertEqual(thread.call_count, 1)
+        self.assertEqual(wrapped.stats['stale'], 2)
+
+        _, kwargs = thread.call_args
+        kwargs['target'](*kwargs['args'])
+        self.assertEqual(wrapped(), 'new')
+        self.assertEqual(wrapped.stats['hits'], 1)
+        self.assertEqual(wrapped.stats['misses'], 1)
+        self.assertEqual(wrapped.stats['loads'], 2)
+
+    @patch('presence_analyzer.utils.log')
+    @patch('presence_analyzer.utils.threading.Thread')
+    def test_cache_failed_refresh(self, thread, mock_log):
+        """
+        Test failed background load keeps serving expired result.
+        """
+        moc = MagicMock(side_effect=['old', ValueError, 'new'])
+        token = ['a']
+        wrapped = utils.cache(
+            validator=lambda: token[0],
+            stale_while_revalidate=True,
+        )(lambda: moc())
+
+        wrapped()
+        token[0] = 'b'
+        self.assertEqual(wrapped(), 'old')
+        _, kwargs = thread.call_args
+        kwargs['target'](*kwargs['args'])
+        self.assertTrue(mock_log.exception.called)
+        self.assertEqual(wrapped.stats['load_errors'], 1)
+
+        self.assertEqual(wrapped(), 'old')
+        self.assertEqual(thread.call_count, 2)
+
+    def test_file_signature(self):
+        """
+        Test file validator checks file at most once per interval.
+        """
+        validator = utils.file_signature('DATA_CSV')
+        with patch('presence_analyzer.utils.os.stat') as stat:
+            stat.return_value.st_mtime = 1
+            stat.return_value.st_size = 2
+            self.assertEqual(validator(), (TEST_DATA_CSV, 1, 2))
+            stat.return_value.st_size = 3
+            self.assertEqual(validator(), (TEST_DATA_CSV, 1, 2))
+            self.assertEqual(stat.call_count, 1)
+
+            with patch.dict(
+                'presence_analyzer.main.app.config',
+                {'CACHE_CHECK_INTERVAL': 0}
+            ):
+                self.assertEqual(validator(), (TEST_DATA_CSV, 1, 3))
+
+    def test_time_spent_by_day(self):
+        """
+        Test result of time_spent_by_day().
+        """
+        fake_data = {
+            datetime.date(2019, 3, 4): {
+                'start': datetime.time(9, 0, 0),
+                'end': datetime.time(17, 30, 0),
+            },
+            datetime.date(2019, 3, 5): {
+                'start': datetime.time(8, 30, 0),
+                'end': datetime.time(16, 45, 0),
+            },
+            datetime.date(2019, 3, 11): {
+                'start': datetime.time(8, 30, 0),
+                'end': datetime.time(16, 45, 0),
+            },
+        }
+        result_data = utils.time_spent_by_day(fake_data)
+
+        result = [
+            ['2019-03-04', 510],
+            ['2019-03-05', 495],
+            ['2019-03-11', 495]
+        ]
+        for _ in result:
+            self.assertIn(_, result_data)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.rows = [
+            (10, datetime.date(2019, 3, 5).toordinal(), 30600, 59400),
+            (10, datetime.date(2019, 3, 4).toordinal(), 32400, 61200),
+            (11, datetime.date(2019, 3, 4).toordinal(), 28800, 57600),
+            (10, datetime.date(2019, 3, 5).toordinal(), 30000, 60000),
+        ]
+
+    def test_build_store(self):
+        """
+        Test building sorted, deduplicated columns.
+        """
+        data = store.build_store(self.rows)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(
+            list(data[10]),
+            [datetime.date(2019, 3, 4), datetime.date(2019, 3, 5)]
+        )
+        self.assertEqual(list(data[10].starts), [32400, 30000])
+        self.assertEqual(list(data[10].ends), [61200, 60000])
+
+    def test_user_presence_mapping(self):
+        """
+        Test dict-like access to user presence entries.
+        """
+        user = store.build_store(self.rows)[10]
+        self.assertEqual(len(user), 2)
+        self.assertIn(datetime.date(2019, 3, 4), user)
+        self.assertNotIn(datetime.date(2019, 3, 6), user)
+        self.assertNotIn('2019-03-04', user)
+        self.assertEqual(
+            user[datetime.date(2019, 3, 4)],
+            {'start': datetime.time(9, 0, 0), 'end': datetime.time(17, 0, 0)}
+        )
+        self.assertRaises(
+            KeyError, user.__getitem__, datetime.date(2019, 3, 6)
+        )
+
+    def test_helpers_on_columns(self):
+        """
+        Test grouping helpers give the same results for columns and dicts.
+        """
+        user = store.build_store(self.rows)[10]
+        items = dict(user.items())
+        self.assertEqual(
+            utils.group_by_weekday(user),
+            utils.group_by_weekday(items)
+        )
+        self.assertEqual(
+            utils.group_start_end_by_weekday(user),
+            utils.group_start_end_by_weekday(items)
+        )
+        self.assertItemsEqual(
+            utils.time_spent_by_day(user),
+            utils.time_spent_by_day(items)
+        )
+
+    def test_weekday_index(self):
+        """
+        Test weekday totals match grouping helpers.
+        """
+        user = store.build_store(self.rows)[10]
+        weekdays = utils.group_by_weekday(user)
+        self.assertEqual(user.weekdays.totals(), [sum(i) for i in weekdays])
+        self.assertEqual(
+            user.weekdays.means(),
+            [utils.mean(intervals) for intervals in weekdays]
+        )
+        self.assertEqual(
+            user.weekdays.start_end_means(),
+            utils.group_start_end_by_weekday(user)
+        )
+
+    def test_weekday_indexes(self):
+        """
+        Test aggregation of all users matches helpers on test data.
+        """
+        with open(TEST_DATA_CSV, 'r') as csvfile:
+            columns = store.group_columns(utils.read_presence_rows(csvfile))
+        columns = {
+            user_id: store.unique_columns(*user_columns)
+            for user_id, user_columns in columns.items()
+        }
+        with patch('presence_analyzer.store.numpy', None):
+            fallback = store.weekday_indexes(columns)
+        indexes = store.weekday_indexes(columns)
+        self.assertItemsEqual(indexes.keys(), columns.keys())
+
+        for user_id, user_columns in columns.items():
+            items = dict(store.UserPresence(*user_columns).items())
+            weekdays = utils.group_by_weekday(items)
+            for index in (indexes[user_id], fallback[user_id]):
+                self.assertEqual(index.totals(), [sum(i) for i in weekdays])
+                self.assertEqual(
+                    index.means(),
+                    [utils.mean(intervals) for intervals in weekdays]
+                )
+                self.assertEqual(
+                    index.start_end_means(),
+                    utils.group_start_end_by_weekday(items)
+                )
+                self.assertEqual(
+                    index.counts, [len(intervals) for intervals in weekdays]
+                )
+
+    @unittest.skipIf(store.numpy is None, 'NumPy is not installed')
+    def test_weekday_indexes_numpy(self):
+        """
+        Test NumPy aggregation returns plain ints, also for empty columns.
+        """
+        indexes = store.weekday_indexes({
+            10: store.unique_columns(
+                *store.group_columns(self.rows)[10]
+            ),
+            12: (array('i'), array('i'), array('i')),
+        })
+        self.assertEqual(indexes[10].counts, [1, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(indexes[10].intervals, [28800, 30000, 0, 0, 0, 0, 0])
+        self.assertIs(type(indexes[10].starts[0]), int)
+        self.assertEqual(indexes[12].counts, [0] * 7)
+
+    def test_slot_occupancy(self):
+        """
+        Test difference array counts match checking every slot.
+        """
+        monday = datetime.date(2019, 3, 4).toordinal()
+        rows = [
+            (user_id, monday + day, start, end)
+            for user_id in range(5)
+            for day in range(0, 20, user_id + 1)
+            for start, end in [(
+                (user_id * 7919 + day * 104729) % 60000,
+                (user_id * 7919 + day * 104729) % 60000 + 3600 * user_id,
+            )]
+        ] + [(9, monday + 1, 900, 1800), (9, monday + 2, 86399, 86399)]
+        data = store.build_store(rows)
+        first, last = monday + 1, monday + 15
+
+        expected = [[0] * 96 for _ in range(7)]
+        dates = set()
+        for user in data.values():
+            for ordinal, start, end in user.rows():
+                if not first <= ordinal <= last:
+                    continue
+                dates.add(ordinal)
+                for slot in range(96):
+                    if slot * 900 < end and start < min(end, (slot + 1) * 900):
+                        expected[(ordinal - 1) % 7][slot] += 1
+        days = [0] * 7
+        for ordinal in dates:
+            days[(ordinal - 1) % 7] += 1
+
+        with patch('presence_analyzer.store.numpy', None):
+            fallback = store.slot_occupancy(data, first, last)
+        self.assertEqual(fallback, (days, expected))
+        self.assertEqual(store.slot_occupancy(data, first, last), fallback)
+        self.assertEqual(fallback[1][1][1], 1)
+        self.assertEqual(
+            store.slot_occupancy(data, monday + 100, monday + 100),
+            ([0] * 7, [[0] * 96] * 7)
+        )
+
+    def test_interval_index(self):
+        """
+        Test overlapping entries match checking every entry.
+        """
+        entries = [
+            (user_id, (user_id * 7919) % 80000, (user_id * 7919) % 80000 +
+             (user_id * 104729) % 20000)
+            for user_id in range(100)
+        ]
+        index = store.IntervalIndex(*zip(*entries))
+        for start, end in [(0, 1), (30000, 30001), (40000, 50000),
+                           (0, store.DAY_SECONDS), (99999, 100000)]:
+            self.assertEqual(
+                index.overlapping(start, end),
+                sorted(
+                    [entry for entry in entries
+                     if entry[1] < end and start < entry[2]],
+                    key=lambda entry: (entry[1], entry[0]),
+                ),
+            )
+        self.assertEqual(
+            index.present_at(7919), index.overlapping(7919, 7920)
+        )
+        self.assertIn((1, 7919, 12648), index.present_at(7919))
+        self.assertEqual(store.IntervalIndex([], [], []).present_at(0), [])
+
+    def test_store_intervals(self):
+        """
+        Test interval indexes of recently queried dates are kept.
+        """
+        data = store.build_store(self.rows)
+        monday = datetime.date(2019, 3, 4).toordinal()
+        index = data.intervals(monday)
+        self.assertEqual(
+            index.present_at(30000), [(11, 28800, 57600)]
+        )
+        self.assertEqual(len(data.intervals(monday + 1)), 1)
+        self.assertIs(data.intervals(monday), index)
+
+        data.max_interval_dates = 1
+        self.assertEqual(len(data.intervals(monday + 2)), 0)
+        self.assertIsNot(data.intervals(monday), index)
+
+    def test_merge_store(self):
+        """
+        Test merging keeps weekday totals up to date.
+        """
+        data = store.build_store(self.rows[:2])
+        merged = store.merge_store(data, self.rows[2:])
+        expected = store.build_store(self.rows)
+        self.assertItemsEqual(merged.keys(), [10, 11])
+        self.assertEqual(list(merged[10].rows()), list(expected[10].rows()))
+        self.assertEqual(len(data[10]), 2)
+        for user_id in (10, 11):
+            self.assertEqual(
+                vars(merged[user_id].weekdays),
+                vars(expected[user_id].weekdays)
+            )
+
+        appended = store.merge_store(
+            data, [(10, self.rows[0][1] + 7, 28800, 57600)]
+        )
+        self.assertEqual(appended[10].weekdays.counts, [1, 2, 0, 0, 0, 0, 0])
+        self.assertEqual(
+            appended[10].weekdays.intervals, [28800, 57600, 0, 0, 0, 0, 0]
+        )
+        self.assertEqual(data.sketches().presence[1].count, 1)
+        self.assertEqual(appended.sketches().presence[1].count, 2)
+        self.assertEqual(data.sketches().presence[1].count, 1)
+        self.assertEqual(merged.sketches().presence[1].count, 1)
+        with patch('presence_analyzer.store.numpy', None):
+            fallback = store.build_store(self.rows).sketches()
+        self.assertEqual(
+            fallback.quantiles(), expected.sketches().quantiles()
+        )
+
+    def test_date_range(self):
+        """
+        Test restricting user presence to date range.
+        """
+        monday = datetime.date(2019, 3, 4).toordinal()
+        rows = [
+            (10, monday + day, 30000 + day, 60000 + day * 2)
+            for day in range(30)
+        ]
+        user = store.build_store(rows)[10]
+        self.assertEqual(user.span(), (0, 30))
+        self.assertEqual(user.span(monday + 5, monday + 9), (5, 10))
+        self.assertEqual(user.span(monday + 9, monday + 5), (9, 9))
+
+        for first, last in (
+                (None, None),
+                (monday + 3, None),
+                (None, monday + 12),
+                (monday + 3, monday + 12),
+                (monday + 40, None),
+        ):
+            part = user.between(first, last)
+            expected = store.WeekdayIndex(part.dates, part.starts, part.ends)
+            self.assertEqual(
+                vars(user.weekdays_between(first, last)), vars(expected)
+            )
+            self.assertEqual(vars(part.weekdays), vars(expected))
+
+        self.assertEqual(
+            list(user.between(monday + 28).rows()),
+            [(monday + 28, 30028, 60056), (monday + 29, 30029, 60058)]
+        )
+
+
+class PresenceAnalyzerSketchTestCase(unittest.TestCase):
+    """
+    Quantile sketch tests.
+    """
+
+    def assert_rank_error(self, quantiles, fractions, ordered, bound):
+        """
+        Checks ranks of quantiles differ from expected at most by bound.
+        """
+        for fraction, value in zip(fractions, quantiles):
+            low = bisect_left(ordered, value)
+            high = bisect_right(ordered, value)
+            target = fraction * len(ordered)
+            error = max(low - target, target - high, 0)
+            self.assertLessEqual(error, bound * len(ordered))
+
+    def test_exact_below_k(self):
+        """
+        Test small sketches return exact quantiles.
+        """
+        quantiles = sketch.QuantileSketch()
+        quantiles.update_many(list(range(100, 0, -1)))
+        quantiles.update(0)
+        self.assertEqual(quantiles.count, 101)
+        self.assertEqual(quantiles.quantiles([0, 0.5, 1]), [0, 50, 100])
+        self.assertEqual(sketch.QuantileSketch().quantiles([0.5]), [0])
+
+    def test_rank_error(self):
+        """
+        Test quantiles of large and merged sketches are within error bound.
+        """
+        values = [(i * 7919) % 100003 for i in range(100000)]
+        fractions = [0.01, 0.1, 0.5, 0.9, 0.99]
+        whole = sketch.QuantileSketch()
+        whole.update_many(values)
+        self.assertEqual(whole.count, len(values))
+        self.assertLess(sum(len(level) for level in whole.levels), 1000)
+        self.assert_rank_error(
+            whole.quantiles(fractions), fractions, sorted(values), 0.017
+        )
+
+        merged = sketch.QuantileSketch()
+        for start in range(0, len(values), 30000):
+            part = sketch.QuantileSketch()
+            for value in values[start:start + 30000]:
+                part.update(value)
+            merged.merge(part)
+        self.assertEqual(merged.count, len(values))
+        self.assert_rank_error(
+            merged.quantiles(fractions), fractions, sorted(values), 0.017
+        )
+
+    def test_weekday_sketches(self):
+        """
+        Test sketches of presence entries grouped by weekday.
+        """
+        sketches = sketch.WeekdaySketches()
+        sketches.extend(1, [28800, 28800], [28800, 32400], [57600, 61200])
+        copied = sketches.copy()
+        copied.merge(sketches)
+        self.assertEqual(sketches.quantiles([1])['days'][1], 2)
+        result = copied.quantiles([0, 1])
+        self.assertEqual(result['days'], [0, 4, 0, 0, 0, 0, 0])
+        self.assertEqual(result['presence'][1], [28800, 28800])
+        self.assertEqual(result['start'][1], [28800, 32400])
+        self.assertEqual(result['end'][0], [0, 0])
+
+    def test_weekday_values(self):
+        """
+        Test exact quantiles use the same ranks as sketches.
+        """
+        fractions = [0, 0.1, 0.5, 0.9, 1]
+        values = sketch.WeekdayValues()
+        values.extend(2, list(range(10, 0, -1)), [5, 1], [7])
+        quantiles = sketch.QuantileSketch()
+        quantiles.update_many(list(range(1, 11)))
+        result = values.quantiles(fractions)
+        self.assertEqual(result['days'], [0, 0, 10, 0, 0, 0, 0])
+        self.assertEqual(result['presence'][2], quantiles.quantiles(fractions))
+        self.assertEqual(result['start'][2], [1, 1, 1, 5, 5])
+        self.assertEqual(result['end'][1], [0] * 5)
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.write('w', '10,2013-09-10,09:39:05,17:59:52\n')
+        self.loader = utils.PresenceLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, mode, text):
+        """
+        Writes text to test CSV file.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(text)
+
+    def test_append(self):
+        """
+        Test only appended lines are parsed and merged.
+        """
+        first = self.loader.load(self.path)
+        self.assertIs(self.loader.load(self.path), first)
+
+        self.write('a', '11,2013-09-10,09:00:00,17:00:00\n11,2013-09-1')
+        with patch('presence_analyzer.utils.build_store') as build:
+            second = self.loader.load(self.path)
+            self.assertFalse(build.called)
+        self.assertItemsEqual(second.keys(), [10, 11])
+        self.assertIs(second[10], first[10])
+        self.assertEqual(len(second[11]), 1)
+
+        self.write('a', '1,09:00:00,17:00:00\n')
+        third = self.loader.load(self.path)
+        self.assertEqual(len(third[11]), 2)
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+
+    def test_non_ascii_lines(self):
+        """
+        Test quoted lines with non-ASCII text are read like other lines.
+        """
+        self.write('wb', u'user_id,date,start,end\n'
+                   u'11,2013-09-10,09:00:00,17:00:00\n'
+                   u'"Raport \u017c\xf3\u0142w",x\n'
+                   u'"12","2013-09-10","09:00:00","17:\u017c0:00"\n'
+                   u'"13","2013-09-10","09:00:00","17:00:00"\n'
+                   .encode('utf-8'))
+        with patch('presence_analyzer.utils.log') as mock_log:
+            data = self.loader.load(self.path)
+        problems = [
+            call[0][1] for call in mock_log.debug.call_args_list
+            if call[0][0].startswith('Problem with line')
+        ]
+        self.assertEqual(problems, [0, 3])
+        self.assertItemsEqual(data.keys(), [11, 13])
+        self.assertEqual(
+            utils.read_quoted_line(u'"\u017c\xf3\u0142w",x\n'),
+            [u'\u017c\xf3\u0142w', u'x'],
+        )
+
+    def test_rewritten_file(self):
+        """
+        Test truncated or rewritten file is loaded from scratch.
+        """
+        self.loader.load(self.path)
+        self.write('w', '11,2013-09-10,09:00:00,17:00:00\n')
+        self.assertItemsEqual(self.loader.load(self.path).keys(), [11])
+
+        self.write('w', '12,2013-09-10,09:00:00,17:00:00\n' * 2)
+        self.assertItemsEqual(self.loader.load(self.path).keys(), [12])
+
+        os.remove(self.path)
+        self.write('w', '13,2013-09-10,09:00:00,17:00:00\n' * 3)
+        self.assertItemsEqual(self.loader.load(self.path).keys(), [13])
+
+    def test_chunk_ranges(self):
+        """
+        Test chunks cover the file and start right after newlines.
+        """
+        text = 'user_id,date,start,end\n' + ''.join(
+            '{},2013-09-{:02d},09:00:00,17:00:00\n'.format(i % 3, i + 1)
+            for i in range(20)
+        )
+        self.write('w', text)
+        with open(self.path, 'rb') as csvfile:
+            ranges = utils.chunk_ranges(csvfile, len(text), 4)
+            self.assertEqual(len(ranges), 4)
+            self.assertEqual(utils.chunk_ranges(csvfile, 10, 4), [(0, 10)])
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(text))
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(text[start - 1], '\n')
+
+    def test_parallel_load(self):
+        """
+        Test data parsed by several workers is the same as serial result.
+        """
+        self.write('w', 'user_id,date,start,end\n' + ''.join(
+            '{},2013-09-{:02d},09:00:{:02d},17:00:00\n'.format(
+                i % 5, 30 - i % 13, i % 60
+            )
+            for i in range(200)
+        ) + 'malformed\n11,2013-09-1')
+        serial = utils.PresenceLoader()
+        expected = serial.load(self.path)
+
+        self.loader.parallel_min_size = 0
+        with patch('presence_analyzer.utils.build_store') as build:
+            data = self.loader.load(self.path, workers=3)
+            self.assertFalse(build.called)
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id, user in expected.items():
+            self.assertEqual(list(data[user_id].rows()), list(user.rows()))
+            self.assertEqual(
+                data[user_id].weekdays.intervals, user.weekdays.intervals
+            )
+        self.assertEqual(self.loader.offset, serial.offset)
+        self.assertEqual(self.loader.lines, serial.lines)
+        self.assertEqual(data.version, expected.version)
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_roundtrip(self):
+        """
+        Test loading data from snapshot instead of parsing CSV file.
+        """
+        data = utils.PresenceLoader().load(self.path, snapshot=True)
+        self.assertTrue(os.path.exists(self.path + '.snapshot'))
+
+        loader = utils.PresenceLoader()
+        with patch('presence_analyzer.utils.read_presence_rows') as read:
+            restored = loader.load(self.path, snapshot=True)
+            self.assertFalse(read.called)
+        self.assertEqual(restored.version, data.version)
+        self.assertItemsEqual(restored.keys(), data.keys())
+        for user_id in data:
+            self.assertEqual(
+                list(restored[user_id].rows()), list(data[user_id].rows())
+            )
+            self.assertEqual(
+                vars(restored[user_id].weekdays), vars(data[user_id].weekdays)
+            )
+        # columns view the mapped file instead of copying it
+        self.assertNotIsInstance(restored[10].dates, array)
+        self.assertEqual(
+            snapshot.column_bytes(restored[10].dates),
+            snapshot.column_bytes(data[10].dates),
+        )
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('10,2013-09-17,09:00:00,17:00:00\n')
+        appended = utils.PresenceLoader().load(self.path, snapshot=True)
+        self.assertEqual(len(appended[10]), 4)
+        self.assertEqual(appended[10].weekdays.counts[1], 2)
+
+    def test_snapshot_ranges(self):
+        """
+        Test date ranges of mapped columns are aggregated like loaded ones.
+        """
+        data = utils.PresenceLoader().load(self.path, snapshot=True)
+        restored = utils.PresenceLoader().load(self.path, snapshot=True)
+        first = datetime.date(2013, 9, 10).toordinal()
+        for user_id in data:
+            self.assertEqual(
+                restored[user_id].weekday_values(first, first + 2).quantiles(),
+                data[user_id].weekday_values(first, first + 2).quantiles(),
+            )
+        self.assertEqual(
+            list(store.int_array(restored[10].between(first, first).dates)),
+            [first],
+        )
+
+    def test_outdated_snapshot(self):
+        """
+        Test snapshot of rewritten file is not used.
+        """
+        utils.PresenceLoader().load(self.path, snapshot=True)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-09-17,09:00:00,17:00:00\n')
+        data = utils.PresenceLoader().load(self.path, snapshot=True)
+        self.assertItemsEqual(data.keys(), [12])
+
+    @patch('presence_analyzer.snapshot.log')
+    def test_malformed_snapshot(self, mock_log):
+        """
+        Test malformed snapshot is ignored.
+        """
+        with open(self.path + '.snapshot', 'wb') as snapshot_file:
+            snapshot_file.write(b'PRESNAP\x01' + b'\xff' * 8)
+        data = utils.PresenceLoader().load(self.path, snapshot=True)
+        self.assertTrue(mock_log.warning.called)
+        self.assertItemsEqual(data.keys(), [10, 11])
+
+
+class PresenceAnalyzerDataPlaneTestCase(unittest.TestCase):
+    """
+    Shared data plane tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        reload(utils)  # cache-cleaning
+        self.directory = tempfile.mkdtemp()
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_PLANE': None})
+        shutil.rmtree(self.directory)
+
+    def test_publish_and_attach(self):
+        """
+        Test workers attach to newest published generation.
+        """
+        self.assertIsNone(dataplane.attach(self.directory))
+
+        data = utils.PresenceLoader().load(TEST_DATA_CSV)
+        for generation in (1, 2, 3):
+            self.assertEqual(
+                dataplane.publish(self.directory, data), generation
+            )
+        self.assertItemsEqual(
+            os.listdir(self.directory),
+            ['CURRENT', 'generation-2.snapshot', 'generation-3.snapshot']
+        )
+
+        attached = dataplane.attach(self.directory)
+        self.assertEqual(attached.version, data.version)
+        self.assertEqual(list(attached[11].rows()), list(data[11].rows()))
+
+    def test_get_data_from_plane(self):
+        """
+        Test get_data() uses published data when data plane is enabled.
+        """
+        main.app.config.update({'DATA_PLANE': self.directory})
+        with patch('presence_analyzer.utils.log') as mock_log:
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+            self.assertTrue(mock_log.warning.called)
+
+        data = utils.build_store([(12, 735000, 1, 2)])
+        data.version = 'published'
+        dataplane.publish(self.directory, data)
+        utils.get_data.invalidate()
+        self.assertItemsEqual(utils.get_data().keys(), [12])
+
+    @patch('presence_analyzer.dataplane.run_loader')
+    def test_main(self, run_loader):
+        """
+        Test loader reads production configuration and needs DATA_PLANE.
+        """
+        config = main.app.config.__class__(self.directory, main.app.config)
+        with self.assertRaises(SystemExit):
+            dataplane.main(config, {})
+        self.assertFalse(run_loader.called)
+
+        dataplane.main(config, {
+            'PRESENCE_ANALYZER_DATA_PLANE': self.directory,
+            'PRESENCE_ANALYZER_DATA_CSV': 'data.csv',
+        })
+        run_loader.assert_called_once_with(
+            'data.csv', self.directory, config['CACHE_CHECK_INTERVAL'], 1
+        )
+
+
+class PresenceAnalyzerBenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark suite helpers tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_generate_data(self):
+        """
+        Test synthetic data is parsed like real data.
+        """
+        csv_path = os.path.join(self.directory, 'data.csv')
+        xml_path = os.path.join(self.directory, 'users.xml')
+        rows = benchmark.generate_csv(csv_path, 3, 1, TEST_DATA_CSV)
+        benchmark.generate_xml(xml_path, 3)
+
+        data = utils.PresenceLoader().load(csv_path)
+        self.assertItemsEqual(data.keys(), [1, 2, 3])
+        self.assertEqual(sum(len(user) for user in data.values()), rows)
+        self.assertTrue(200 * 3 < rows <= 260 * 3)
+        for user in data.values():
+            self.assertEqual(user.weekdays.counts[5:], [0, 0])
+
+        main.app.config.update({'DATA_XML': xml_path})
+        reload(utils)
+        users = utils.get_xml_users()
+        self.assertEqual(users[2]['name'], 'User 2.')
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+
+        other = os.path.join(self.directory, 'other.csv')
+        benchmark.generate_csv(other, 3, 1, TEST_DATA_CSV)
+        with open(csv_path) as first, open(other) as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_deep_sizeof(self):
+        """
+        Test size of presence store counts weekday totals and sketches.
+        """
+        data = utils.PresenceLoader().load(TEST_DATA_CSV)
+        weekdays = sum(
+            benchmark.deep_sizeof(user.weekdays) for user in data.values()
+        )
+        sketches = benchmark.deep_sizeof(data.sketches())
+        self.assertGreater(
+            benchmark.deep_sizeof(data),
+            sys.getsizeof(data) + weekdays + sketches,
+        )
+        result, traced = benchmark.live_memory(lambda: [0] * 1000)
+        self.assertEqual(len(result), 1000)
+        if traced is not None:
+            self.assertGreaterEqual(traced, sys.getsizeof(result))
+
+    def test_measure(self):
+        """
+        Test timing results and comparison with baseline.
+        """
+        result = benchmark.measure(lambda: sum(range(100)), 10, items=100)
+        self.assertEqual(result['calls'], 10)
+        self.assertTrue(result['p50_ms'] <= result['p99_ms'])
+        self.assertTrue(result['throughput'] > 0)
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 0.99), 4)
+
+        changes, regressions = benchmark.compare_results(
+            {'a': {'p50_ms': 1.5}, 'b': {'p50_ms': 1.0}, 'c': {}},
+            {'a': {'p50_ms': 1.0}, 'b': {'p50_ms': 1.05}},
+            0.1,
+        )
+        self.assertEqual([change[0] for change in changes], ['a', 'b'])
+        self.assertEqual(changes[0][3], 0.5)
+        self.assertEqual(regressions, ['a'])
+
+
+class PresenceAnalyzerPartitionsTestCase(unittest.TestCase):
+    """
+    Time partitioned data tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        for name, text in (
+                ('presence-2013-08.csv',
+                 '10,2013-08-05,09:00:00,17:00:00\n'
+                 '11,2013-08-06,08:00:00,16:00:00\n'),
+                ('presence-2013-09.csv', '10,2013-09-02,09:00:00,13:00:00\n'),
+                ('presence-2013-10.csv',
+                 '10,2013-10-07,10:00:00,12:00:00\n'
+                 '12,2013-10-08,08:00:00,09:00:00\n'),
+        ):
+            with open(os.path.join(self.directory, name), 'w') as csvfile:
+                csvfile.write(text)
+        main.app.config.update({
+            'DATA_PARTITIONS': os.path.join(self.directory, 'presence-*.csv'),
+            'DATA_XML': TEST_DATA_XML,
+        })
+        self.invalidate()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_PARTITIONS': None})
+        self.invalidate()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def invalidate():
+        """
+        Forgets cached partitions.
+        """
+        utils.listed_partitions.clear()
+        utils.joined_versions.clear()
+        utils.partition_signatures.clear()
+        for cached in (
+                utils.partition_loader,
+                utils.partition_rollup,
+                utils.join_partitions,
+                utils.get_data,
+        ):
+            cached.invalidate()
+
+    @staticmethod
+    def invalidate_signatures():
+        """
+        Forgets signatures of partition files checked recently.
+        """
+        utils.listed_partitions.clear()
+        utils.partition_signatures.clear()
+
+    def test_list_partitions(self):
+        """
+        Test partitions are ordered by dates in file names.
+        """
+        august, september, october = [
+            datetime.date(2013, month, 1).toordinal() for month in (8, 9, 10)
+        ]
+        with open(os.path.join(self.directory, 'presence-new.csv'), 'w'):
+            pass
+        with patch('presence_analyzer.partitions.log') as mock_log:
+            found = partitions.list_partitions(
+                main.app.config['DATA_PARTITIONS']
+            )
+            self.assertTrue(mock_log.warning.called)
+        self.assertEqual(
+            [(partition.first, partition.last) for partition in found],
+            [
+                (august, september - 1),
+                (september, october - 1),
+                (october, None),
+            ],
+        )
+        self.assertEqual(
+            partitions.partition_start('2012-01/presence-2013-09-15.csv'),
+            datetime.date(2013, 9, 15).toordinal(),
+        )
+        self.assertIsNone(partitions.partition_start('presence-2013-13.csv'))
+
+        self.assertEqual(
+            partitions.overlapping(found, september + 9, september + 19),
+            found[1:2],
+        )
+        self.assertEqual(
+            partitions.overlapping(found, october + 40), found[2:]
+        )
+        self.assertEqual(partitions.overlapping(found), found)
+        self.assertTrue(partitions.covers(found[1], august, october - 1))
+        self.assertFalse(partitions.covers(found[1], september + 1))
+        self.assertFalse(partitions.covers(found[2], october, october + 60))
+        self.assertTrue(partitions.covers(found[2], october))
+
+    def test_rollup(self):
+        """
+        Test rollups are read back only for the same file version.
+        """
+        path = os.path.join(self.directory, 'presence-2013-08.csv')
+        signature = utils.path_signature(path, {})
+        data = utils.load_partition(path)
+        partitions.write_rollup(path, signature, {
+            user_id: user.weekdays for user_id, user in data.items()
+        })
+        rollup = partitions.read_rollup(path, signature)
+        self.assertItemsEqual(rollup.keys(), [10, 11])
+        self.assertEqual(rollup[10].intervals, data[10].weekdays.intervals)
+        self.assertEqual(rollup[11].starts, data[11].weekdays.starts)
+
+        outdated = (path, signature[1], signature[2] + 1)
+        self.assertIsNone(partitions.read_rollup(path, outdated))
+        os.remove(partitions.rollup_path(path))
+        self.assertIsNone(partitions.read_rollup(path, signature))
+
+    def test_get_weekdays(self):
+        """
+        Test whole partitions in range are served from rollups.
+        """
+        first = datetime.date(2013, 8, 1).toordinal()
+        last = datetime.date(2013, 9, 30).toordinal()
+        weekdays = utils.get_weekdays(first, last)
+        self.assertItemsEqual(weekdays.keys(), [10, 11])
+        self.assertEqual(weekdays[10].intervals[0], 28800 + 14400)
+        self.assertEqual(sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.rollup.json')
+        ), [
+            'presence-2013-08.csv.rollup.json',
+            'presence-2013-09.csv.rollup.json',
+        ])
+
+        self.invalidate()
+        with patch('presence_analyzer.utils.load_partition') as load:
+            weekdays = utils.get_weekdays(first, last)
+            self.assertEqual(weekdays[10].intervals[0], 28800 + 14400)
+            self.assertFalse(load.called)
+
+        weekdays = utils.get_weekdays(first + 33)
+        self.assertItemsEqual(weekdays.keys(), [10, 12])
+        self.assertEqual(weekdays[10].intervals[0], 7200)
+        self.assertEqual(utils.get_weekdays()[10].counts[0], 3)
+
+    def test_get_range_data(self):
+        """
+        Test only partitions overlapping the range are loaded and joined.
+        """
+        october = datetime.date(2013, 10, 1).toordinal()
+        self.assertItemsEqual(utils.get_range_data(october).keys(), [10, 12])
+        self.assertItemsEqual(
+            utils.get_range_data(october + 40, october + 50).keys(), [10, 12]
+        )
+        self.assertEqual(len(utils.get_range_data(october - 100, 1)), 0)
+
+        data = utils.get_range_data()
+        self.assertItemsEqual(data.keys(), [10, 11, 12])
+        self.assertEqual(
+            [row[0] for row in data[10].rows()],
+            [
+                datetime.date(2013, 8, 5).toordinal(),
+                datetime.date(2013, 9, 2).toordinal(),
+                datetime.date(2013, 10, 7).toordinal(),
+            ],
+        )
+        self.assertEqual(data[10].weekdays.intervals[0], 28800 + 14400 + 7200)
+        self.assertIs(utils.get_range_data(), data)
+        self.assertIs(utils.get_data(), data)
+        self.assertEqual(
+            data.sketches().quantiles((1.0,))['presence'][0], [28800]
+        )
+
+    def test_appended_partition(self):
+        """
+        Test appends keep one join and update size of cached partition.
+        """
+        path = os.path.join(self.directory, 'presence-2013-10.csv')
+        self.assertEqual(len(utils.get_range_data()[10]), 3)
+        size = utils.partition_loader.stats['bytes']
+        for day in range(14, 17):
+            with open(path, 'a') as csvfile:
+                csvfile.write('10,2013-10-{},10:00:00,12:00:00\n'.format(day))
+            os.utime(path, (0, day))
+            self.invalidate_signatures()
+            self.assertEqual(len(utils.get_range_data()[10]), day - 10)
+        self.assertEqual(utils.join_partitions.stats['entries'], 1)
+        self.assertGreater(utils.partition_loader.stats['bytes'], size)
+
+    def test_join_stores(self):
+        """
+        Test joined stores with overlapping dates are sorted again.
+        """
+        monday = datetime.date(2013, 9, 2).toordinal()
+        joined = store.join_stores([
+            store.build_store([(1, monday + 7, 0, 60), (2, monday, 0, 30)]),
+            store.build_store([(1, monday, 0, 120)]),
+        ])
+        self.assertEqual(
+            list(joined[1].rows()), [(monday, 0, 120), (monday + 7, 0, 60)]
+        )
+        self.assertEqual(joined[1].weekdays.intervals[0], 180)
+        self.assertEqual(list(joined[2].rows()), [(monday, 0, 30)])
+
+    def test_views(self):
+        """
+        Test views read partitions of requested dates.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10?from=2013-09-01')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[1], ['Mon', 14400 + 7200])
+
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-09-01')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/api/v1/present_at?ts=2013-10-07T11:00:00')
+        self.assertEqual(
+            [entry['user_id'] for entry in json.loads(resp.data)], [10]
+        )
+        resp = self.client.get('/api/v1/top?from=2013-10-01&n=1')
+        self.assertEqual(json.loads(resp.data)['users'][0]['user_id'], 10)
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'asyncio serving needs Python 3')
+class PresenceAnalyzerAsgiTestCase(unittest.TestCase):
+    """
+    Asyncio serving mode tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        # asgi module has Python 3 syntax
+        self.asgi = importlib.import_module('presence_analyzer.asgi')
+        self.asgi.render.invalidate()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.asgi.render.invalidate()
+
+    def request(self, path, query='', headers=()):
+        """
+        Passes GET request to ASGI application.
+
+        Returns (status, dict of headers, body).
+        """
+        loop = asyncio.new_event_loop()
+        messages = []
+
+        def done(result=None):
+            """
+            Returns awaitable with given result.
+            """
+            future = loop.create_future()
+            future.set_result(result)
+            return future
+
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': query.encode('latin-1'),
+            'headers': [
+                (name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ],
+        }
+        try:
+            loop.run_until_complete(self.asgi.application(
+                scope,
+                lambda: done({'type': 'http.request', 'body': b''}),
+                lambda message: messages.append(message) or done(),
+            ))
+        finally:
+            loop.close()
+        start, body = messages
+        return (
+            start['status'],
+            {
+                name.decode('latin-1'): value.decode('latin-1')
+                for name, value in start['headers']
+            },
+            body['body'],
+        )
+
+    def test_api(self):
+        """
+        Test API responses match Flask views and are cached.
+        """
+        client = main.app.test_client()
+        for path in (
+                '/api/v1/presence_weekday/10',
+                '/api/v1/mean_time_weekday/11',
+                '/api/v1/presence_days/11',
+        ):
+            status, _, body = self.request(path, 'from=2013-09-01')
+            self.assertEqual(status, 200)
+            self.assertEqual(
+                json.loads(body.decode('utf-8')),
+                json.loads(client.get(path + '?from=2013-09-01').data),
+            )
+
+        status, headers, body = self.request('/api/v1/presence_weekday/10')
+        self.assertEqual(self.asgi.render.stats['misses'], 4)
+        self.assertEqual(
+            self.request('/api/v1/presence_weekday/10', 'junk=1')[2], body
+        )
+        self.assertEqual(self.asgi.render.stats['hits'], 1)
+
+        status, _, body = self.request(
+            '/api/v1/presence_weekday/10',
+            headers=[('if-none-match', headers['etag'])],
+        )
+        self.assertEqual((status, body), (304, b''))
+
+        status, headers, body = self.request(
+            '/api/v1/occupancy_heatmap',
+            headers=[('accept-encoding', 'gzip')],
+        )
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertIn(
+            b'slots', zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        )
+        status, cached_headers, body = self.request(
+            '/api/v1/occupancy_heatmap',
+            headers=[('if-none-match', headers['etag'])],
+        )
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(cached_headers['etag'], headers['etag'])
+
+    def test_api_quantiles_version(self):
+        """
+        Test quantiles of all users are tagged with presence version.
+        """
+        etag = self.request('/api/v1/presence_quantiles')[1]['etag']
+        self.assertEqual(etag, '"{}"'.format(utils.json_etag(
+            utils.presence_version(), '/api/v1/presence_quantiles?'
+        )))
+
+    def test_api_errors(self):
+        """
+        Test failed requests get error status and are not cached.
+        """
+        self.assertEqual(self.request('/api/v1/presence_weekday/99')[0], 404)
+        self.assertEqual(
+            self.request('/api/v1/presence_weekday/10', 'from=2013')[0], 400
+        )
+        self.assertEqual(self.request('/api/v1/top', 'n=0')[0], 400)
+        self.assertEqual(self.asgi.render.stats['entries'], 0)
+        self.assertEqual(self.request('/')[0], 302)
+
+    def test_render_in_thread_pool(self):
+        """
+        Test results are computed and serialized off the event loop.
+        """
+        threads = []
+
+        def weekday_totals(weekdays):
+            """
+            Records thread computing result.
+            """
+            threads.append(threading.current_thread())
+            return weekdays.totals()
+
+        with patch.object(views, 'weekday_totals', weekday_totals):
+            self.assertEqual(
+                self.request('/api/v1/presence_weekday/10')[0], 200
+            )
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_instrumentation(self):
+        """
+        Test stage timings of API requests.
+        """
+        status, headers, _ = self.request('/api/v1/presence_days/11')
+        self.assertNotIn('server-timing', headers)
+
+        main.app.config.update({'INSTRUMENTATION': True})
+        try:
+            status, headers, _ = self.request(
+                '/api/v1/presence_days/11', 'from=2013-09-01'
+            )
+            self.assertEqual(status, 200)
+            stages = [
+                item.split(';')[0]
+                for item in headers['server-timing'].split(', ')
+            ]
+            self.assertEqual(stages[-3:], ['aggregate', 'serialize', 'cache'])
+
+            status, headers, _ = self.request(
+                '/api/v1/presence_days/11', 'from=2013-09-01'
+            )
+            self.assertEqual(headers['server-timing'][:6], 'cache;')
+            self.assertIn(
+                'endpoint="presence_days_view",stage="aggregate"',
+                metrics.render(),
+            )
+        finally:
+            main.app.config.update({'INSTRUMENTATION': False})
 
 
 def suite():
@@ -440,6 +2458,14 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDataPlaneTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarkTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPartitionsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAsgiTestCase))
     return base_suite
 
 
@@ -3,75 +3,508 @@
 Helper functions used in views.
 """
 
+import binascii
 import csv
+import hashlib
+import heapq
+import io
 import logging
+import multiprocessing
+import os
+import sys
 import threading
+import time
 import xml.etree.cElementTree as etree
+import zlib
 
+from collections import OrderedDict
 from json import dumps
 from functools import wraps
 from datetime import datetime, timedelta
 
-from flask import Response
+from flask import Response, request
 
+from presence_analyzer import dataplane, metrics, partitions
 from presence_analyzer.main import app
+from presence_analyzer.snapshot import (
+    read_snapshot,
+    snapshot_path,
+    write_snapshot,
+)
+from presence_analyzer.store import (
+    DAY_SECONDS,
+    PresenceStore,
+    RangeWeekdays,
+    UserPresence,
+    WeekdayIndex,
+    build_store,
+    extend_columns,
+    group_columns,
+    join_stores,
+    merge_store,
+    ordinal_weekday,
+    slot_occupancy,
+    store_from_columns,
+    time_from_seconds,
+)
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def jsonify(wrapped):
+class CachedJSON(object):
     """
-    Creates a response with the JSON representation of wrapped function result.
+    Serialized JSON response body with lazily compressed gzip variant.
     """
-    @wraps(wrapped)
-    def inner(*args, **kwargs):
+
+    def __init__(self, body):
+        self.body = body
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
         """
-        This docstring will be overridden by @wraps decorator.
+        Returns body compressed with gzip.
         """
-        return Response(
-            dumps(wrapped(*args, **kwargs)),
-            mimetype='application/json'
+        if self._gzipped is None:
+            # wbits above MAX_WBITS produce gzip header and trailer
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            self._gzipped = compressor.compress(self.body) + compressor.flush()
+        return self._gzipped
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + len(self.body) + len(
+            self._gzipped or b''
         )
-    return inner
 
 
-def cache(time_to_live):
+def json_etag(data_version, full_path):
+    """
+    Returns ETag of JSON response to given URL for given data version.
+    """
+    return hashlib.sha1('{}|{}'.format(
+        data_version, full_path
+    ).encode('utf-8')).hexdigest()
+
+
+# approximate size of responses cached by every cached_jsonify() view
+RESPONSE_CACHE_BYTES = 32 * 2 ** 20
+
+
+def cached_jsonify(version, query_args=(), max_entries=1024,
+                   max_bytes=RESPONSE_CACHE_BYTES, gzip_min_size=512):
+    """
+    Creates JSON response of wrapped function result and caches it.
+
+    Serialized responses are kept per view arguments, values of query
+    arguments named in query_args, which have to be all arguments the view
+    reads, and data version returned by version(), so they are built again
+    only after data changes; other query arguments do not make new
+    entries. Responses carry strong ETag derived from the data version and
+    request URL; requests with matching If-None-Match get 304 without
+    calling wrapped function. Bodies of at least gzip_min_size bytes are
+    sent compressed to clients accepting gzip. At most max_entries
+    responses taking approximately max_bytes, with their compressed
+    variants, are kept.
+    """
+    def decorator(wrapped):
+        """
+        Create response cache for wrapped function.
+        """
+        def render(data_version, query, args, kwargs):
+            """
+            Serializes result of wrapped function.
+            """
+            with metrics.stage('aggregate'):
+                result = wrapped(*args, **dict(kwargs))
+            with metrics.stage('serialize'):
+                body = dumps(result)
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+            return CachedJSON(body)
+
+        render.__name__ = 'render_{}'.format(wrapped.__name__)
+        render = cache(max_entries=max_entries, max_bytes=max_bytes)(render)
+
+        @wraps(wrapped)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            started = metrics.start_request()
+            data_version = version()
+            etag = json_etag(data_version, request.full_path)
+            gzip_etag = etag + '-gzip'
+            if request.if_none_match.contains(gzip_etag):
+                response, etag = Response(status=304), gzip_etag
+            elif request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                key = (
+                    data_version,
+                    tuple(request.args.get(name) for name in query_args),
+                    args,
+                    tuple(sorted(kwargs.items())),
+                )
+                cached = render(*key)
+                response = Response(cached.body, mimetype='application/json')
+                if (
+                        len(cached.body) >= gzip_min_size and
+                        request.accept_encodings['gzip']
+                ):
+                    compressed = cached._gzipped is not None
+                    response.set_data(cached.gzipped)
+                    response.headers['Content-Encoding'] = 'gzip'
+                    etag = gzip_etag
+                    if not compressed:
+                        render.resize(*key)
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Accept-Encoding')
+            metrics.finish_request(started, request.endpoint, response)
+            return response
+        inner.query_args = query_args
+        return inner
+    return decorator
+
+
+def presence_version():
+    """
+    Returns version of presence data.
+
+    Of partitioned data it is derived from signatures of partition files,
+    so that it does not need all partitions loaded.
     """
-    Decorator that caches loaded data,
-    expire time is set as datetime.now() + time_to_live.
+    if app.config['DATA_PARTITIONS']:
+        return hashlib.sha1(
+            repr(presence_signature()).encode('utf-8')
+        ).hexdigest()
+    return get_data().version
+
+
+def cache(time_to_live=None, validator=None, stale_while_revalidate=False,
+          max_entries=None, max_bytes=None, sizeof=sys.getsizeof):
     """
-    lock = threading.Lock()
+    Decorator that caches loaded data.
+
+    Results are cached per positional and keyword arguments. Cached result
+    expires at datetime.now() + time_to_live, if it is set, and as soon as
+    value returned by validator() changes. Each key is loaded under its
+    own lock, so a slow load blocks only callers waiting for the same
+    result.
+
+    With stale_while_revalidate expired result is still returned while
+    exactly one background thread loads the new one; only the first load
+    of a key blocks. Otherwise expired results are purged on every load.
+
+    At most max_entries results taking approximately max_bytes, as
+    measured by sizeof(), are kept; least recently used ones are evicted
+    first and a result bigger than max_bytes is not cached at all.
 
+    Decorated function gets invalidate() method which drops all cached
+    results, forget(*args, **kwargs) dropping one of them, resize(*args,
+    **kwargs) measuring one again after it changed in place, and stats
+    dict counting hits, misses, stale results served, loads, time spent
+    loading, evictions and cached entries and bytes.
+    The stats are exposed by presence_analyzer.metrics, which also times
+    waits for the locks when instrumentation is on.
+    """
     def cache_decorator(wrapped):
         """
         Create cache for wrapped function.
         """
-        cached = {}
+        name = wrapped.__name__
+        lock = threading.Lock()
+        cached = OrderedDict()
+        key_locks = {}
+        refreshing = set()
+        stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'loads': 0,
+            'load_errors': 0,
+            'load_seconds': 0.0,
+            'last_load_seconds': 0.0,
+            'evictions': 0,
+            'entries': 0,
+            'bytes': 0,
+        }
+        metrics.registry.register_cache(name, stats)
+
+        def count(name, value=1):
+            """
+            Increases stats counter.
+            """
+            with lock:
+                stats[name] += value
+
+        def lookup(key, token):
+            """
+            Returns (cached entry or None, whether it is still fresh).
+            """
+            with metrics.timed_lock(lock, name):
+                entry = cached.pop(key, None)
+                if entry is None:
+                    return None, False
+                cached[key] = entry
+            result, expires, cached_token, _ = entry
+            fresh = (
+                (expires is None or expires > datetime.now()) and
+                cached_token == token
+            )
+            return entry, fresh
+
+        def load(key, token, args, kwargs):
+            """
+            Calls wrapped function and caches its result.
+            """
+            started = time.time()
+            try:
+                result = wrapped(*args, **kwargs)
+            except Exception:
+                count('load_errors')
+                raise
+            duration = time.time() - started
+            expires = (
+                datetime.now() + timedelta(seconds=time_to_live)
+                if time_to_live is not None else None
+            )
+            size = sizeof(result) if max_bytes is not None else 0
+            with lock:
+                stats['loads'] += 1
+                stats['load_seconds'] += duration
+                stats['last_load_seconds'] = duration
+                discard(key)
+                if not stale_while_revalidate:
+                    now = datetime.now()
+                    for old_key in [
+                            old_key
+                            for old_key, entry in cached.items()
+                            if entry[1] is not None and entry[1] <= now
+                    ]:
+                        discard(old_key)
+                if max_bytes is None or size <= max_bytes:
+                    cached[key] = (result, expires, token, size)
+                    stats['entries'] += 1
+                    stats['bytes'] += size
+                shrink()
+            return result
+
+        def shrink():
+            """
+            Evicts least recently used entries over the limits, lock has to
+            be held by caller.
+            """
+            while cached and (
+                    (max_entries is not None and
+                     stats['entries'] > max_entries) or
+                    (max_bytes is not None and stats['bytes'] > max_bytes)
+            ):
+                discard(next(iter(cached)))
+                stats['evictions'] += 1
+
+        def discard(key):
+            """
+            Removes cached entry, lock has to be held by caller.
+            """
+            entry = cached.pop(key, None)
+            if entry is not None:
+                stats['entries'] -= 1
+                stats['bytes'] -= entry[3]
+            key_lock = key_locks.get(key)
+            if key_lock is not None and not key_lock.locked():
+                del key_locks[key]
+
+        def refresh(key_lock, key, token, args, kwargs):
+            """
+            Loads new result in background thread.
+            """
+            try:
+                with key_lock:
+                    load(key, token, args, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', name)
+            finally:
+                with lock:
+                    refreshing.discard(key)
 
         @wraps(wrapped)
         def caching(*args, **kwargs):
-            with lock:
-                key = (wrapped, args)
-                if key in cached and cached[key][1] > datetime.now():
-                    return cached[key][0]
-                else:
-                    result = wrapped(*args, **kwargs)
-                    cached[key] = (
-                        result,
-                        datetime.now() + timedelta(seconds=time_to_live)
+            key = (args, tuple(sorted(kwargs.items())))
+            token = validator() if validator else None
+            entry, fresh = lookup(key, token)
+            if fresh:
+                count('hits')
+                return entry[0]
+
+            if entry is not None and stale_while_revalidate:
+                with lock:
+                    start = key not in refreshing
+                    refreshing.add(key)
+                    key_lock = key_locks.setdefault(key, threading.Lock())
+                    stats['stale'] += 1
+                if start:
+                    thread = threading.Thread(
+                        target=refresh,
+                        args=(key_lock, key, token, args, kwargs),
+                        name='cache-refresh-{}'.format(name),
                     )
-                    return result
+                    thread.daemon = True
+                    thread.start()
+                return entry[0]
+
+            with lock:
+                key_lock = key_locks.setdefault(key, threading.Lock())
+            with metrics.timed_lock(key_lock, name):
+                # other thread could load it while we were waiting
+                entry, fresh = lookup(key, token)
+                if fresh:
+                    count('hits')
+                    return entry[0]
+                count('misses')
+                return load(key, token, args, kwargs)
+
+        def invalidate():
+            """
+            Drops all cached results of wrapped function.
+            """
+            with lock:
+                for key in list(cached):
+                    discard(key)
+
+        def forget(*args, **kwargs):
+            """
+            Drops cached result of given arguments, if any.
+            """
+            with lock:
+                discard((args, tuple(sorted(kwargs.items()))))
+
+        def resize(*args, **kwargs):
+            """
+            Measures cached result of given arguments again, after it grew
+            or shrank, and evicts entries over max_bytes.
+            """
+            if max_bytes is None:
+                return
+            key = (args, tuple(sorted(kwargs.items())))
+            with lock:
+                entry = cached.get(key)
+            if entry is None:
+                return
+            size = sizeof(entry[0])
+            with lock:
+                if cached.get(key) is not entry:
+                    return
+                if size > max_bytes:
+                    discard(key)
+                    stats['evictions'] += 1
+                    return
+                cached[key] = entry[:3] + (size,)
+                stats['bytes'] += size - entry[3]
+                shrink()
+
+        caching.invalidate = invalidate
+        caching.forget = forget
+        caching.resize = resize
+        caching.stats = stats
         return caching
     return cache_decorator
 
 
-@cache(600)
+def path_signature(path, checked):
+    """
+    Returns path, modification time and size of file.
+
+    The file is checked at most once per app.config['CACHE_CHECK_INTERVAL']
+    seconds, in between last result remembered in checked dict is returned.
+    """
+    now = datetime.now()
+    interval = timedelta(seconds=app.config['CACHE_CHECK_INTERVAL'])
+    if path in checked and checked[path][0] + interval > now:
+        return checked[path][1]
+
+    try:
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime, stat.st_size)
+    except OSError:
+        signature = (path, None, None)
+    checked[path] = (now, signature)
+    return signature
+
+
+def file_signature(config_key, filename=None):
+    """
+    Creates cache validator watching file given in app.config[config_key],
+    or file of given name in directory app.config[config_key].
+
+    Validator returns path_signature() of the file.
+    """
+    checked = {}
+
+    def validator():
+        """
+        Returns signature of watched file.
+        """
+        path = app.config[config_key]
+        if filename is not None:
+            path = os.path.join(path, filename)
+        return path_signature(path, checked)
+
+    return validator
+
+
+csv_signature = file_signature('DATA_CSV')  # pylint: disable=invalid-name
+plane_signature = file_signature(  # pylint: disable=invalid-name
+    'DATA_PLANE', dataplane.CURRENT
+)
+
+
+# partitions and signatures of their files, by glob
+listed_partitions = {}  # pylint: disable=invalid-name
+partition_signatures = {}  # pylint: disable=invalid-name
+
+
+def get_partitions():
+    """
+    Returns Partitions matching glob in app.config['DATA_PARTITIONS'].
+
+    The glob is expanded at most once per CACHE_CHECK_INTERVAL seconds.
+    """
+    pattern = app.config['DATA_PARTITIONS']
+    now = datetime.now()
+    interval = timedelta(seconds=app.config['CACHE_CHECK_INTERVAL'])
+    listed = listed_partitions.get(pattern)
+    if listed is None or listed[0] + interval <= now:
+        listed = listed_partitions[pattern] = (
+            now, partitions.list_partitions(pattern)
+        )
+    return listed[1]
+
+
+def presence_signature():
+    """
+    Returns signature of presence data source.
+    """
+    if app.config['DATA_PARTITIONS']:
+        return tuple(
+            path_signature(partition.path, partition_signatures)
+            for partition in get_partitions()
+        )
+    if app.config['DATA_PLANE']:
+        return plane_signature()
+    return csv_signature()
+
+
+@cache(validator=presence_signature, stale_while_revalidate=True)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    It creates read-only PresenceStore that behaves like this structure:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -84,26 +517,611 @@ def get_data():
             },
         }
     }
+    but keeps every user's entries in compact date / start / end columns.
+
+    When app.config['DATA_PLANE'] is set, data published there by loader
+    process is mapped instead of parsing the CSV file. When
+    app.config['DATA_PARTITIONS'] is set, all partitions are joined.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    if app.config['DATA_PARTITIONS']:
+        return get_range_data()
 
+    with metrics.stage('load'):
+        if app.config['DATA_PLANE']:
+            data = dataplane.attach(app.config['DATA_PLANE'])
+            if data is not None:
+                return data
+            log.warning(
+                'No data published in %s yet', app.config['DATA_PLANE']
+            )
+
+        return presence_loader.load(
+            app.config['DATA_CSV'],
+            app.config['DATA_SNAPSHOT'],
+            app.config['INGEST_WORKERS'],
+        )
+
+
+# set once warm_up() loaded all data
+readiness = threading.Event()  # pylint: disable=invalid-name
+
+
+def warm_up():
+    """
+    Loads presence data and users directory before serving requests.
+
+    Weekday totals of every user are computed during the load; of
+    partitioned data only rollups and partitions without them are loaded.
+    Sets readiness event when done.
+    """
+    if app.config['DATA_PARTITIONS']:
+        get_weekdays()
+    else:
+        get_data()
+    get_xml_users()
+    readiness.set()
+
+
+# background warm-up started by retry_warm_up(), if any
+warm_up_thread = None  # pylint: disable=invalid-name
+warm_up_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def try_warm_up():
+    """
+    Calls warm_up(), logging instead of raising errors.
+    """
+    try:
+        warm_up()
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Warm-up failed')
+
+
+def retry_warm_up():
+    """
+    Starts warm-up in background thread, unless it already succeeded or
+    is running.
+
+    Called by readiness checks, so a process whose warm-up failed gets
+    ready as soon as data can be loaded, one attempt per check at most.
+    """
+    global warm_up_thread  # pylint: disable=global-statement,invalid-name
+    with warm_up_lock:
+        if readiness.is_set() or (
+                warm_up_thread is not None and warm_up_thread.is_alive()
+        ):
+            return
+        warm_up_thread = threading.Thread(target=try_warm_up)
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+
+
+class PresenceLoader(object):
+    """
+    Loads presence CSV file, re-reading only lines appended since last load.
+
+    The file is fully parsed again only if it was replaced, truncated or
+    its already parsed part changed.
+    """
+    # bytes before last parsed offset used to detect rewritten files
+    signature_size = 64
+    # smaller files are parsed in one process, whatever the worker count
+    parallel_min_size = 4 * 2 ** 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.identity = None
+        self.offset = 0
+        self.lines = 0
+        self.signature = b''
+        self.data = None
+
+    def load(self, path, snapshot=False, workers=1):
+        """
+        Returns presence store with current content of file.
+
+        With snapshot enabled, first load of a file tries to map binary
+        snapshot stored next to it, and every load which changed the data
+        writes the snapshot again. With more than one worker, file parsed
+        from scratch is split between that many processes.
+        """
+        with self.lock:
+            with open(path, 'rb') as csvfile:
+                stat = os.fstat(csvfile.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                if snapshot and (self.data is None or path != self.path):
+                    self.restore(path, identity)
+
+                changed = True
+                if not self.is_appended(path, identity, stat, csvfile):
+                    log.debug('Loading %s from scratch', path)
+                    self.path = path
+                    self.offset = self.lines = 0
+                    if workers > 1 and stat.st_size >= self.parallel_min_size:
+                        self.data = self.read_parallel(
+                            path, csvfile, stat.st_size, workers
+                        )
+                    else:
+                        self.data = build_store(self.read_rows(csvfile))
+                elif (stat.st_size, stat.st_mtime) != self.identity[2:]:
+                    self.data = merge_store(self.data, self.read_rows(csvfile))
+                else:
+                    changed = False
+
+                if changed:
+                    self.identity = identity + (stat.st_size, stat.st_mtime)
+                    self.signature = self.read_signature(csvfile)
+                    self.data.version = '{:x}-{:x}-{:x}'.format(
+                        stat.st_ino, self.offset, int(stat.st_mtime * 1000000)
+                    )
+                    if snapshot:
+                        self.save(path)
+            return self.data
+
+    def restore(self, path, identity):
+        """
+        Restores data and state of loader from snapshot of file.
+        """
+        restored = read_snapshot(snapshot_path(path))
+        if restored is None:
+            return
+        data, state = restored
+        if state['source'] != os.path.abspath(path):
+            return
+        if state['inode'] != identity[1]:
+            log.debug('Snapshot of %s is outdated', path)
+            return
+
+        log.debug('Loaded snapshot of %s', path)
+        self.path = path
+        self.identity = identity + (state['size'], state['mtime'])
+        self.offset = state['offset']
+        self.lines = state['lines']
+        self.signature = binascii.unhexlify(state['signature'])
+        self.data = data
+
+    def save(self, path):
+        """
+        Writes snapshot of data and state of loader.
+        """
+        try:
+            write_snapshot(snapshot_path(path), self.data, {
+                'source': os.path.abspath(path),
+                'inode': self.identity[1],
+                'size': self.identity[2],
+                'mtime': self.identity[3],
+                'offset': self.offset,
+                'lines': self.lines,
+                'signature': binascii.hexlify(self.signature).decode('ascii'),
+            })
+        except (IOError, OSError):
+            log.warning('Cannot write snapshot of %s', path, exc_info=True)
+
+    def is_appended(self, path, identity, stat, csvfile):
+        """
+        Checks if file only got new lines since last load.
+        """
+        if (
+                self.data is None or
+                path != self.path or
+                identity != self.identity[:2] or
+                stat.st_size < self.offset
+        ):
+            return False
+        return self.read_signature(csvfile) == self.signature
+
+    def read_signature(self, csvfile):
+        """
+        Reads bytes just before last parsed offset.
+        """
+        start = max(self.offset - self.signature_size, 0)
+        csvfile.seek(start)
+        return csvfile.read(self.offset - start)
+
+    def read_parallel(self, path, csvfile, size, workers):
+        """
+        Parses file in newline aligned chunks, one process per chunk.
+
+        Per-user columns of chunks are joined in file order, so the store
+        is the same as the one built from all rows in a single process.
+        """
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = [
+                pool.apply_async(read_chunk, (path, start, end))
+                for start, end in chunk_ranges(csvfile, size, workers)
+            ]
+            columns = {}
+            for chunk_columns, lines, offset in (
+                    result.get() for result in results
+            ):
+                extend_columns(columns, chunk_columns)
+                self.lines += lines
+                self.offset = max(self.offset, offset)
+        finally:
+            pool.terminate()
+            pool.join()
+        return store_from_columns(columns)
+
+    def read_rows(self, csvfile, end=None):
+        """
+        Yields presence rows of file starting at last parsed offset.
+        """
+        return read_presence_rows(self.read_lines(csvfile, end), self.lines)
+
+    def read_lines(self, csvfile, end=None):
+        """
+        Yields lines of file starting at last parsed offset.
+
+        The offset is moved past complete lines only, so a line which is
+        still being written is read again on the next load. Reading stops
+        at the first line starting at or after end offset, if given.
+        """
+        csvfile.seek(self.offset)
+        for line in csvfile:
+            if end is not None and self.offset >= end:
+                break
+            if line.endswith(b'\n'):
+                self.offset += len(line)
+                self.lines += 1
+            yield line.decode('utf-8', 'replace')
+
+
+presence_loader = PresenceLoader()  # pylint: disable=invalid-name
+
+# approximate size of cached partitions
+PARTITION_CACHE_BYTES = 512 * 2 ** 20
+
+# approximate size of cached joins of partitions
+JOIN_CACHE_BYTES = 256 * 2 ** 20
+
+
+@cache(
+    max_bytes=PARTITION_CACHE_BYTES,
+    sizeof=lambda loader: sys.getsizeof(loader.data),
+)
+def partition_loader(path):
+    """
+    Returns PresenceLoader which loaded partition file.
+
+    Every partition has its own loader and data, evicted when partitions
+    used more recently fill PARTITION_CACHE_BYTES.
+    """
+    loader = PresenceLoader()
+    loader.load(path, app.config['DATA_SNAPSHOT'])
+    return loader
+
+
+def load_partition(path):
+    """
+    Returns PresenceStore of partition file.
+
+    A cached partition is only checked for changes; lines appended to it
+    are read incrementally and its cached size is updated.
+    """
+    with metrics.stage('load'):
+        loader = partition_loader(path)
+        previous = loader.data
+        data = loader.load(path, app.config['DATA_SNAPSHOT'])
+    if data is not previous:
+        partition_loader.resize(path)
+    return data
+
+
+@cache(max_entries=1024)
+def partition_rollup(path, signature):
+    """
+    Returns {user_id: WeekdayIndex} of all entries of partition file of
+    given signature.
+
+    The rollup is read from file next to the partition; if it is missing
+    or outdated, it is taken from the loaded partition and written there.
+    """
+    with metrics.stage('load'):
+        rollup = partitions.read_rollup(path, signature)
+    if rollup is None:
+        data = load_partition(path)
+        rollup = {user_id: user.weekdays for user_id, user in data.items()}
+        partitions.write_rollup(path, signature, rollup)
+    return rollup
+
+
+# versions of partitions last joined, by their paths
+joined_versions = {}  # pylint: disable=invalid-name
+
+
+@cache(max_entries=8, max_bytes=JOIN_CACHE_BYTES)
+def join_partitions(versions):
+    """
+    Returns PresenceStore joining partitions of given (path, version)
+    pairs, in order.
+
+    Use join_latest(), which drops joins of older versions of the same
+    partitions.
+    """
+    data = join_stores([load_partition(path) for path, _ in versions])
+    data.version = hashlib.sha1(repr(versions).encode('utf-8')).hexdigest()
+    return data
+
+
+def get_range_data(first=None, last=None):
+    """
+    Returns PresenceStore with at least all entries between first and last
+    date ordinal.
+
+    With app.config['DATA_PARTITIONS'] set only partitions overlapping the
+    range are loaded, otherwise it is get_data().
+    """
+    if not app.config['DATA_PARTITIONS']:
+        return get_data()
+
+    paths = [
+        partition.path
+        for partition in partitions.overlapping(
+            get_partitions(), first, last
+        )
+    ]
+    stores = [load_partition(path) for path in paths]
+    if not stores:
+        return PresenceStore({}, 'empty')
+    if len(stores) == 1:
+        return stores[0]
+    return join_latest(tuple(
+        (path, data.version) for path, data in zip(paths, stores)
+    ))
+
+
+def join_latest(versions):
+    """
+    Returns join_partitions() of given (path, version) pairs.
+
+    Only the latest join of the same paths is kept, the previous one is
+    dropped when a partition, e.g. the newest one, changes.
+    """
+    paths = tuple(path for path, _ in versions)
+    previous = joined_versions.get(paths)
+    joined_versions[paths] = versions
+    if previous is not None and previous != versions:
+        join_partitions.forget(previous)
+    return join_partitions(versions)
+
+
+def get_weekdays(first=None, last=None):
+    """
+    Returns mapping of user_id to WeekdayIndex of dates between first and
+    last ordinal.
+
+    Of partitioned data, partitions with all dates in the range are read
+    from their rollups and only the others are loaded.
+    """
+    if not app.config['DATA_PARTITIONS']:
+        return RangeWeekdays([(get_data(), first, last)])
+
+    parts = []
+    for partition in partitions.overlapping(get_partitions(), first, last):
+        if partitions.covers(partition, first, last):
+            signature = path_signature(partition.path, partition_signatures)
+            parts.append((
+                partition_rollup(partition.path, signature), None, None
+            ))
+        else:
+            parts.append((load_partition(partition.path), first, last))
+    return RangeWeekdays(parts)
+
+
+def chunk_ranges(csvfile, size, count):
+    """
+    Splits first size bytes of file into at most count byte ranges.
+
+    Every range but the first starts right after a newline. Returns list
+    of (start, end) offsets.
+    """
+    boundaries = [0]
+    for i in range(1, count):
+        csvfile.seek(max(size * i // count - 1, boundaries[-1]))
+        csvfile.readline()
+        boundary = min(csvfile.tell(), size)
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    if size > boundaries[-1]:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def read_chunk(path, start, end):
+    """
+    Groups presence rows of lines starting between start and end offsets.
+
+    Runs in worker processes of PresenceLoader.read_parallel(). Returns
+    (per-user columns, number of complete lines, offset after last
+    complete line); line numbers in log messages count from the start of
+    the chunk.
+    """
+    loader = PresenceLoader()
+    loader.offset = start
+    with open(path, 'rb') as csvfile:
+        columns = group_columns(loader.read_rows(csvfile, end))
+    return columns, loader.lines, loader.offset
+
+
+def read_presence_rows(csvfile, start=0):
+    """
+    Yields (user_id, date ordinal, start, end) rows of CSV file.
+
+    Start and end are given in seconds since midnight. Composes
+    read_csv_rows() and convert_rows() stages; malformed lines are logged
+    and skipped.
+    """
+    return convert_rows(read_csv_rows(csvfile, start))
+
+
+def read_csv_rows(csvfile, start=0):
+    """
+    Yields (line number, fields) of CSV lines with four fields.
+
+    Line numbers are counted from start.
+    """
+    for i, line in enumerate(csvfile, start):
+        if '"' in line:
+            row = read_quoted_line(line)
+        else:
+            row = line.rstrip('\r\n').split(',')
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+        yield i, row
+
+
+def read_quoted_line(line):
+    """
+    Returns fields of CSV line with quoted fields.
+
+    The csv module of Python 2 reads only byte strings, so a unicode line
+    is read encoded to UTF-8 and its fields are decoded back.
+    """
+    if isinstance(line, str):
+        return next(csv.reader([line], delimiter=','), [])
+    return [
+        field.decode('utf-8')
+        for field in read_quoted_line(line.encode('utf-8'))
+    ]
+
+
+def convert_rows(numbered_rows):
+    """
+    Converts (line number, fields) to (user_id, date ordinal, start, end).
+
+    Fields in the usual id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS layout are
+    converted by slicing and memoized per distinct date and time text;
+    other rows go through parse_presence_row(). Malformed rows are logged
+    and skipped.
+    """
+    dates = {}
+    times = {}
+    for i, row in numbered_rows:
+        try:
+            yield int(row[0]), dates[row[1]], times[row[2]], times[row[3]]
+            continue
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            user_id = int(row[0])
+            ordinal = memoized(dates, parse_date_ordinal, row[1])
+            start = memoized(times, parse_seconds, row[2])
+            end = memoized(times, parse_seconds, row[3])
+        except ValueError:
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+                yield parse_presence_row(row)
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+        yield user_id, ordinal, start, end
+
+
+def group_by_user(rows, factory):
+    """
+    Feeds (user_id, date ordinal, start, end) rows to per-user accumulators.
+
+    Accumulators are created by factory() on first row of every user and
+    get add(ordinal, start, end) called for each row. Returns dict of
+    accumulators by user_id; rows are not kept.
+    """
+    accumulators = {}
+    for user_id, ordinal, start, end in rows:
+        try:
+            accumulator = accumulators[user_id]
+        except KeyError:
+            accumulator = accumulators[user_id] = factory()
+        accumulator.add(ordinal, start, end)
+    return accumulators
 
-    return data
+
+def load_weekday_totals(path):
+    """
+    Computes WeekdayIndex of every user straight from CSV file.
+
+    Works in memory proportional to number of users, not rows; unlike
+    get_data() repeated entries for the same day are all counted.
+    """
+    with io.open(path, 'r', encoding='utf-8', errors='replace') as csvfile:
+        return group_by_user(read_presence_rows(csvfile), WeekdayIndex)
+
+
+def memoized(memo, parse, text):
+    """
+    Returns parse(text), remembering results in memo dict.
+    """
+    try:
+        return memo[text]
+    except KeyError:
+        value = memo[text] = parse(text)
+        return value
+
+
+def parse_date_ordinal(text):
+    """
+    Converts YYYY-MM-DD text to date ordinal.
+
+    Raises ValueError for any other layout.
+    """
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        raise ValueError('Not a YYYY-MM-DD date: {!r}'.format(text))
+    year, month, day = text[:4], text[5:7], text[8:]
+    if not (year + month + day).isdigit():
+        raise ValueError('Not a YYYY-MM-DD date: {!r}'.format(text))
+    return datetime(int(year), int(month), int(day)).toordinal()
+
+
+def parse_seconds(text):
+    """
+    Converts HH:MM:SS text to amount of seconds since midnight.
+
+    Raises ValueError for any other layout or out of range values.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError('Not a HH:MM:SS time: {!r}'.format(text))
+    hours, minutes, seconds = text[:2], text[3:5], text[6:]
+    if not (hours + minutes + seconds).isdigit():
+        raise ValueError('Not a HH:MM:SS time: {!r}'.format(text))
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError('Not a HH:MM:SS time: {!r}'.format(text))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_timestamp(text):
+    """
+    Converts YYYY-MM-DDTHH:MM:SS text, also with a space instead of T, to
+    (date ordinal, seconds since midnight).
+
+    Raises ValueError for any other layout.
+    """
+    if len(text) != 19 or text[10] not in 'T ':
+        raise ValueError(
+            'Not a YYYY-MM-DDTHH:MM:SS timestamp: {!r}'.format(text)
+        )
+    return parse_date_ordinal(text[:10]), parse_seconds(text[11:])
+
+
+def parse_presence_row(row):
+    """
+    Converts CSV row to (user_id, date ordinal, start, end) with strptime.
+
+    Strict and slow path used for rows that are not in the usual layout.
+    """
+    user_id = int(row[0])
+    date = datetime.strptime(row[1], '%Y-%m-%d').date()
+    start = datetime.strptime(row[2], '%H:%M:%S').time()
+    end = datetime.strptime(row[3], '%H:%M:%S').time()
+    return (
+        user_id,
+        date.toordinal(),
+        seconds_since_midnight(start),
+        seconds_since_midnight(end),
+    )
 
 
 def group_by_weekday(items):
@@ -111,6 +1129,11 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
+    if isinstance(items, UserPresence):
+        for ordinal, start, end in items.rows():
+            result[ordinal_weekday(ordinal)].append(end - start)
+        return result
+
     for date in items:
         start = items[date]['start']
         end = items[date]['end']
@@ -130,11 +1153,16 @@ def group_start_end_by_weekday(items):
         for i in range(7)
     ]
 
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        weekdays[date.weekday()][0].append(seconds_since_midnight(start))
-        weekdays[date.weekday()][1].append(seconds_since_midnight(end))
+    if isinstance(items, UserPresence):
+        for ordinal, start, end in items.rows():
+            weekdays[ordinal_weekday(ordinal)][0].append(start)
+            weekdays[ordinal_weekday(ordinal)][1].append(end)
+    else:
+        for date in items:
+            start = items[date]['start']
+            end = items[date]['end']
+            weekdays[date.weekday()][0].append(seconds_since_midnight(start))
+            weekdays[date.weekday()][1].append(seconds_since_midnight(end))
 
     result = [
         [int(mean(day[0])), int(mean(day[1]))]
@@ -165,11 +1193,19 @@ def mean(items):
     return float(sum(items)) / len(items) if items else 0
 
 
+class UserDirectory(dict):
+    """
+    Users data indexed by user id, with version of the source file.
+    """
+    version = None
+
+
+@cache(validator=file_signature('DATA_XML'), stale_while_revalidate=True)
 def get_xml_users():
     """
     Extracts users data from xml file and groups it by id.
 
-    It creates structure like this:
+    It creates UserDirectory, a dict with structure like this:
     data = {
         'user_id': {
             'name': 'Anna K.',
@@ -180,26 +1216,62 @@ def get_xml_users():
             'avatar': intranet.stxnext.pl/api/images/users/16,
         }
     }
+    The file is parsed incrementally and every user element is dropped as
+    soon as it is read, so memory use does not grow with the XML tree.
     """
-    xml_data = etree.parse(app.config['DATA_XML'])
-    xml_data = xml_data.getroot()
-    users = xml_data[1]
-    host = xml_data[0][0].text
-    data = {}
-    for user in users:
-        user_id = int(user.get('id'))
-        avatar = user[0].text
-        name = user[1].text
-
-        data[user_id] = {'name': name, 'avatar': host + avatar}
+    path = app.config['DATA_XML']
+    with metrics.stage('load'):
+        stat = os.stat(path)
+        host = ''
+        users = None
+        data = UserDirectory()
+        for event, element in etree.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == 'users':
+                    users = element
+            elif element.tag == 'host':
+                host = element.text or ''
+            elif element.tag == 'user':
+                data[int(element.get('id'))] = {
+                    'name': element.findtext('name'),
+                    'avatar': element.findtext('avatar', ''),
+                }
+                element.clear()
+                if users is not None:
+                    users.remove(element)
 
+    for user in data.values():
+        user['avatar'] = host + user['avatar']
+    data.version = '{:x}-{:x}-{:x}'.format(
+        stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000)
+    )
     return data
 
 
+def users_version():
+    """
+    Returns version of users data.
+    """
+    return get_xml_users().version
+
+
+def presence_users_version():
+    """
+    Returns version of presence and users data together.
+    """
+    return '{}-{}'.format(presence_version(), users_version())
+
+
 def time_spent_by_day(items):
     """
     Calculate time of presence grouped by day.
     """
+    if isinstance(items, UserPresence):
+        return [
+            [str(datetime.fromordinal(ordinal).date()), (end - start) / 60]
+            for ordinal, start, end in items.rows()
+        ]
+
     result = []
     for date in items:
         day = str(date)
@@ -210,3 +1282,186 @@ def time_spent_by_day(items):
             interval(start, end) / 60,
         ])
     return result
+
+
+def parse_user_ids(text):
+    """
+    Parses comma separated user ids, e.g. '1,2,3'.
+
+    Raises ValueError for anything that is not a list of integers.
+    """
+    return sorted(set(int(user_id) for user_id in text.split(',')))
+
+
+def parse_fractions(text):
+    """
+    Parses comma separated fractions, e.g. '0.5,0.9,0.99'.
+
+    Raises ValueError for anything that is not a list of numbers between
+    0 and 1.
+    """
+    fractions = [float(fraction) for fraction in text.split(',')]
+    if not all(0 <= fraction <= 1 for fraction in fractions):
+        raise ValueError('Fractions out of range: {!r}'.format(text))
+    return fractions
+
+
+def bulk_weekday_stats(weekdays, user_ids):
+    """
+    Collects weekday statistics of many users at once.
+
+    Reads weekday totals of every user from mapping of user_id to
+    WeekdayIndex, e.g. get_weekdays() of a date range, only once. Returns
+    (stats, missing) where stats maps user_id to presence totals, mean
+    presence times and [mean start, mean end] pairs for each weekday, and
+    missing lists ids not found in weekdays.
+    """
+    stats = {}
+    missing = []
+    for user_id in user_ids:
+        if user_id not in weekdays:
+            missing.append(user_id)
+            continue
+        user_weekdays = weekdays[user_id]
+        stats[user_id] = {
+            'presence': user_weekdays.totals(),
+            'mean': user_weekdays.means(),
+            'start_end': user_weekdays.start_end_means(),
+        }
+    return stats, missing
+
+
+def total_presence(weekdays):
+    """
+    Returns total presence time in (s) of WeekdayIndex.
+    """
+    return sum(weekdays.intervals)
+
+
+def mean_presence(weekdays):
+    """
+    Returns mean presence time in (s) of a day of WeekdayIndex.
+    """
+    return float(sum(weekdays.intervals)) / sum(weekdays.counts)
+
+
+def mean_arrival(weekdays):
+    """
+    Returns mean start time in (s) of WeekdayIndex.
+    """
+    return float(sum(weekdays.starts)) / sum(weekdays.counts)
+
+
+def mean_departure(weekdays):
+    """
+    Returns mean end time in (s) of WeekdayIndex.
+    """
+    return float(sum(weekdays.ends)) / sum(weekdays.counts)
+
+
+# metrics of top_users() and whether the largest values come first
+TOP_METRICS = {
+    'presence': (total_presence, True),
+    'mean_presence': (mean_presence, True),
+    'arrival': (mean_arrival, False),
+    'departure': (mean_departure, True),
+}
+
+
+def top_users(weekdays, metric, count, largest=None):
+    """
+    Selects count users with largest, or smallest, value of given metric
+    of TOP_METRICS.
+
+    Values are computed from mapping of user_id to WeekdayIndex, e.g.
+    get_weekdays() of a date range, and heapq picks the leaders in
+    O(users log count). Users without presence are skipped; ties are
+    broken by lower user id. By default the metric's own order is used,
+    e.g. earliest arrival first. Returns list of (user_id, value) pairs.
+    """
+    compute, metric_largest = TOP_METRICS[metric]
+    if largest is None:
+        largest = metric_largest
+    # negated ids of largest values make lower ids win ties
+    sign = -1 if largest else 1
+    values = (
+        (compute(user_weekdays), sign * user_id)
+        for user_id, user_weekdays in weekdays.items()
+        if any(user_weekdays.counts)
+    )
+    select = heapq.nlargest if largest else heapq.nsmallest
+    return [
+        (sign * user_id, value)
+        for value, user_id in select(count, values)
+    ]
+
+
+def occupancy_heatmap(data, first=None, last=None, slot_minutes=15):
+    """
+    Computes mean number of people present in every time slot of every
+    weekday, for dates between first and last ordinal.
+
+    Returns dict with slot start times, number of dates of every weekday
+    with any presence and, for every weekday, mean number of presence
+    entries overlapping each slot on such a date.
+    """
+    slot_seconds = slot_minutes * 60
+    days, counts = slot_occupancy(data, first, last, slot_seconds)
+    return {
+        'slots': [
+            str(time_from_seconds(slot * slot_seconds))[:5]
+            for slot in range(len(counts[0]))
+        ],
+        'days': days,
+        'occupancy': [
+            [round(float(count) / day_count, 2) for count in weekday_counts]
+            if day_count else [0] * len(weekday_counts)
+            for day_count, weekday_counts in zip(days, counts)
+        ],
+    }
+
+
+def present_between(data, users, since, until=None):
+    """
+    Lists presence entries overlapping window from since (inclusive) to
+    until (exclusive), both (date ordinal, seconds) pairs; without until,
+    entries including since.
+
+    Every date of the window is searched in its IntervalIndex. Returns
+    dicts with user id, name from users directory, date and start / end
+    times, ordered by date and start.
+    """
+    if until is None:
+        found = [(since[0], data.intervals(since[0]).present_at(since[1]))]
+    else:
+        found = [
+            (ordinal, data.intervals(ordinal).overlapping(
+                since[1] if ordinal == since[0] else 0,
+                until[1] if ordinal == until[0] else DAY_SECONDS,
+            ))
+            for ordinal in range(since[0], until[0] + 1)
+        ]
+    return [
+        {
+            'user_id': user_id,
+            'name': users.get(user_id, {}).get('name'),
+            'date': str(datetime.fromordinal(ordinal).date()),
+            'start': str(time_from_seconds(start)),
+            'end': str(time_from_seconds(end)),
+        }
+        for ordinal, entries in found
+        for user_id, start, end in entries
+    ]
+
+
+def parse_date_range(args):
+    """
+    Parses optional 'from' and 'to' YYYY-MM-DD dates of query arguments.
+
+    Returns (first, last) date ordinals, None for a missing limit. Raises
+    ValueError for malformed dates.
+    """
+    return tuple(
+        parse_date_ordinal(args[name]) if args.get(name) else None
+        for name in ('from', 'to')
+    )
@@ -4,25 +4,182 @@ Defines views.
 """
 
 import calendar
+import json
 import logging
 
-from flask import redirect, abort
+from flask import Response, redirect, abort, request
 from flask_mako import render_template, exceptions
 
+from presence_analyzer import metrics
+from presence_analyzer.sketch import DEFAULT_FRACTIONS
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
-    jsonify,
+    cached_jsonify,
+    presence_version,
+    users_version,
     get_data,
-    mean,
-    group_by_weekday,
-    group_start_end_by_weekday,
+    get_range_data,
+    get_weekdays,
     get_xml_users,
     time_spent_by_day,
+    parse_user_ids,
+    parse_date_range,
+    parse_fractions,
+    bulk_weekday_stats,
+    occupancy_heatmap,
+    top_users,
+    TOP_METRICS,
+    parse_timestamp,
+    present_between,
+    presence_users_version,
+    readiness,
+    retry_warm_up,
 )
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# longest window of present_at queries
+MAX_WINDOW_DAYS = 31
+
+# most users listed by top view
+MAX_TOP_USERS = 1000
+
+
+def weekday_means(weekdays):
+    """
+    Returns (weekday name, mean presence) pairs of WeekdayIndex.
+    """
+    return [
+        (calendar.day_abbr[weekday], mean_interval)
+        for weekday, mean_interval in enumerate(weekdays.means())
+    ]
+
+
+def weekday_totals(weekdays):
+    """
+    Returns chart rows of total presence of WeekdayIndex.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total in enumerate(weekdays.totals())
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def weekday_start_end(weekdays):
+    """
+    Returns (weekday name, mean start, mean end) of days with presence.
+    """
+    return [
+        (calendar.day_abbr[weekday], (times[0]), times[1])
+        for weekday, times in enumerate(weekdays.start_end_means())
+        if times[0] > 0 and times[1] > 0
+    ]
+
+
+def weekday_quantiles(sketches, args):
+    """
+    Returns quantiles of WeekdaySketches at fractions given in 'q' query
+    argument, e.g. ?q=0.5,0.9.
+
+    Raises ValueError for malformed fractions.
+    """
+    fractions = (
+        parse_fractions(args['q']) if args.get('q') else DEFAULT_FRACTIONS
+    )
+    result = sketches.quantiles(fractions)
+    result['weekdays'] = list(calendar.day_abbr)
+    result['quantiles'] = list(fractions)
+    return result
+
+
+def bulk_weekdays(weekdays, args):
+    """
+    Returns weekday statistics of users chosen by query arguments, from
+    mapping of user_id to WeekdayIndex.
+
+    Raises ValueError for malformed ids.
+    """
+    ids = args.get('ids')
+    user_ids = parse_user_ids(ids) if ids else sorted(weekdays)
+    stats, missing = bulk_weekday_stats(weekdays, user_ids)
+    return {
+        'weekdays': list(calendar.day_abbr),
+        'users': stats,
+        'missing': missing,
+    }
+
+
+def parse_window(args):
+    """
+    Parses 'ts' timestamp and optional 'until' timestamp of query
+    arguments.
+
+    Returns (since, until), both (date ordinal, seconds) pairs or None for
+    missing until. Raises ValueError for malformed timestamps and empty or
+    too long windows.
+    """
+    since = parse_timestamp(args.get('ts', ''))
+    until = None
+    if args.get('until'):
+        until = parse_timestamp(args['until'])
+        if not since < until:
+            raise ValueError('Window ends before it starts')
+        if until[0] - since[0] > MAX_WINDOW_DAYS:
+            raise ValueError('Window longer than {} days'.format(
+                MAX_WINDOW_DAYS
+            ))
+    return since, until
+
+
+def top(weekdays, users, args):
+    """
+    Returns users leading in 'metric' of query arguments, from mapping of
+    user_id to WeekdayIndex.
+
+    Number of users is given by 'n', 10 by default, and 'order' can be
+    'desc' or 'asc' instead of the metric's own order. Raises ValueError
+    for unknown metric or order and malformed number.
+    """
+    metric = args.get('metric', 'presence')
+    if metric not in TOP_METRICS:
+        raise ValueError('Unknown metric: {!r}'.format(metric))
+    count = int(args.get('n', 10))
+    if not 0 < count <= MAX_TOP_USERS:
+        raise ValueError('Number of users out of range: {}'.format(count))
+    order = args.get('order')
+    if order not in (None, 'asc', 'desc'):
+        raise ValueError('Unknown order: {!r}'.format(order))
+    largest = None if order is None else order == 'desc'
+    leaders = top_users(weekdays, metric, count, largest)
+    return {
+        'metric': metric,
+        'users': [
+            {
+                'user_id': user_id,
+                'name': users.get(user_id, {}).get('name'),
+                'value': value,
+            }
+            for user_id, value in leaders
+        ],
+    }
+
+
+def users_list(users):
+    """
+    Returns id, name and avatar of users.
+    """
+    return [
+        {
+            'user_id': user,
+            'name': users[user]['name'],
+            'avatar': '/static/img/user_avatars/{}.png'.format(user)
+        }
+        for user in users
+    ]
+
 
 @app.route('/')
 def mainpage():
@@ -33,65 +190,203 @@ def mainpage():
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(presence_version, ('from', 'to'))
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+    weekdays = get_weekdays(first, last)
+    if user_id not in weekdays:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    return weekday_means(weekdays[user_id])
+
+
+@app.route('/api/v1/presence_quantiles', methods=['GET'])
+@cached_jsonify(presence_version, ('q',))
+def presence_quantiles_view():
+    """
+    Returns approximate quantiles of presence time and start and end times
+    of all users grouped by weekday.
+    """
+    try:
+        return weekday_quantiles(get_data().sketches(), request.args)
+    except ValueError:
+        log.debug('Invalid quantiles: %s', request.args)
+        abort(400)
 
-    return result
+
+@app.route('/api/v1/presence_quantiles/<int:user_id>', methods=['GET'])
+@cached_jsonify(presence_version, ('q', 'from', 'to'))
+def user_presence_quantiles_view(user_id):
+    """
+    Returns exact quantiles of presence time and start and end times of
+    given user grouped by weekday, optionally limited to from / to dates.
+    """
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+    data = get_range_data(first, last)
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    try:
+        return weekday_quantiles(
+            data[user_id].weekday_values(first, last), request.args
+        )
+    except ValueError:
+        log.debug('Invalid quantiles: %s', request.args)
+        abort(400)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(presence_version, ('from', 'to'))
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+    weekdays = get_weekdays(first, last)
+    if user_id not in weekdays:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return weekday_totals(weekdays[user_id])
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(presence_version, ('from', 'to'))
 def presence_start_end_view(user_id):
     """
     Returns the mean time interval of the user's presence grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+    weekdays = get_weekdays(first, last)
+    if user_id not in weekdays:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_start_end_by_weekday(data[user_id])
-    days = [
-        (calendar.day_abbr[weekday], (times[0]), times[1])
-        for weekday, times in enumerate(weekdays)
-        if times[0] > 0 and times[1] > 0
-    ]
+    return weekday_start_end(weekdays[user_id])
+
+
+@app.route('/api/v1/bulk/presence_weekday', methods=['GET'])
+@cached_jsonify(presence_version, ('from', 'to', 'ids'))
+def bulk_presence_weekday_view():
+    """
+    Returns weekday statistics of users given in ids parameter, e.g.
+    ?ids=1,2,3, or of all users, optionally limited to from / to dates.
+    """
+    try:
+        first, last = parse_date_range(request.args)
+        return bulk_weekdays(get_weekdays(first, last), request.args)
+    except ValueError:
+        log.debug('Invalid query: %s', request.args)
+        abort(400)
+
+
+@app.route('/api/v1/occupancy_heatmap', methods=['GET'])
+@cached_jsonify(presence_version, ('from', 'to'))
+def occupancy_heatmap_view():
+    """
+    Returns mean number of people present in every 15 minute slot of
+    every weekday, optionally limited to from / to dates.
+    """
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
 
-    return days
+    result = occupancy_heatmap(get_range_data(first, last), first, last)
+    result['weekdays'] = list(calendar.day_abbr)
+    return result
+
+
+@app.route('/api/v1/present_at', methods=['GET'])
+@cached_jsonify(presence_users_version, ('ts', 'until'))
+def present_at_view():
+    """
+    Returns users present at given time, e.g.
+    ?ts=2013-09-10T10:00:00, or overlapping window ending at 'until'.
+    """
+    try:
+        since, until = parse_window(request.args)
+    except ValueError:
+        log.debug('Invalid query: %s', request.args)
+        abort(400)
+
+    data = get_range_data(since[0], (until or since)[0])
+    return present_between(data, get_xml_users(), since, until)
+
+
+@app.route('/api/v1/top', methods=['GET'])
+@cached_jsonify(
+    presence_users_version, ('from', 'to', 'metric', 'n', 'order'),
+)
+def top_view():
+    """
+    Returns users with most presence, or leading in other metric, e.g.
+    ?metric=arrival&n=5&from=2013-09-01.
+    """
+    try:
+        first, last = parse_date_range(request.args)
+        return top(get_weekdays(first, last), get_xml_users(), request.args)
+    except ValueError:
+        log.debug('Invalid query: %s', request.args)
+        abort(400)
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_view():
+    """
+    Returns 200 once data is loaded by warm_up(), 503 before.
+
+    While not ready, warm-up is retried in background.
+    """
+    ready = readiness.is_set()
+    if not ready:
+        retry_warm_up()
+    return Response(
+        json.dumps({'ready': ready}),
+        status=200 if ready else 503,
+        mimetype='application/json',
+        headers={'Cache-Control': 'no-store'},
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns metrics in Prometheus text format, if instrumentation is on.
+    """
+    if not metrics.enabled():
+        abort(404)
+    return Response(
+        metrics.render(),
+        mimetype='text/plain; version=0.0.4',
+        headers={'Cache-Control': 'no-store'},
+    )
 
 
 @app.route('/<path:path>')
@@ -106,32 +401,29 @@ def template_router(path):
 
 
 @app.route('/api/v1/users_data', methods=['GET'])
-@jsonify
+@cached_jsonify(users_version)
 def users_data_view():
     """
     Returns users id, name and avatar.
     """
-    data = get_xml_users()
-
-    return [
-        {
-            'user_id': user,
-            'name': data[user]['name'],
-            'avatar': '/static/img/user_avatars/{}.png'.format(user)
-        }
-        for user in data
-    ]
+    return users_list(get_xml_users())
 
 
 @app.route('/api/v1/presence_days/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(presence_version, ('from', 'to'))
 def presence_days_view(user_id):
     """
     Creates list of presence days during a year for a user.
     """
-    data = get_data()
+    try:
+        first, last = parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+    data = get_range_data(first, last)
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    return time_spent_by_day(data[user_id])
+    return time_spent_by_day(data[user_id].between(first, last))
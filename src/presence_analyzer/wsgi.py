@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Production WSGI entry point.
+
+Debug mode is off and configuration is read from the environment, see
+presence_analyzer.main.configure(). Data is loaded before application is
+returned, so workers never parse it on first request; with gunicorn
+--preload it is loaded once in the master process and shared by forked
+workers. /health/ready answers 200 once warm-up succeeded.
+
+Usage: gunicorn --preload presence_analyzer.wsgi:application
+"""
+
+from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.main import app, configure
+from presence_analyzer.utils import try_warm_up
+
+
+def create_application():
+    """
+    Configures app and loads data.
+
+    When data cannot be loaded yet, the app is returned anyway, reports
+    not ready and retries the warm-up on every readiness check.
+    """
+    configure(app.config)
+    try_warm_up()
+    return app
+
+
+application = create_application()  # pylint: disable=invalid-name
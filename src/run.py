@@ -6,6 +6,7 @@ import os.path
 import logging.config
 
 from presence_analyzer.main import app
+from presence_analyzer.utils import warm_up
 import presence_analyzer.views
 
 
@@ -14,4 +15,5 @@ if __name__ == "__main__":
                                 '..', 'runtime', 'debug.ini')
     logging.config.fileConfig(ini_filename, disable_existing_loggers=False)
     port = int(os.environ.get("PORT", 5000))
+    warm_up()
     app.run(host='0.0.0.0', port=port)